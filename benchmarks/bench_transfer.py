@@ -0,0 +1,103 @@
+#!/usr/bin/python -tt
+# Raw throughput of the transfer pipeline variants over a local pipe.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+from distutils.spawn import find_executable
+import logging
+import os
+import threading
+import time
+
+import synthetic
+import transfer
+
+# name, block size, receiver command, number of stripes, programs needed.
+# The receiver stands in for the "dd of=<device>" run on the stager; %(out)s
+# is the file playing the device and %(offset)s where a stripe starts. A
+# receiver of None is the verifying receiver, transfer.receiver_cmd().
+variants = (
+    ('dd-4k', 4096,
+     'dd of=%(out)s bs=4096 conv=notrunc', 1, ()),
+    ('dd-1m', 1048576,
+     'dd of=%(out)s bs=1M iflag=fullblock conv=notrunc', 1, ()),
+    ('dd-4m', 4194304,
+     'dd of=%(out)s bs=4M iflag=fullblock conv=notrunc', 1, ()),
+    ('gzip-1', 4194304,
+     'gzip -1 -c | gzip -dc | dd of=%(out)s bs=4M iflag=fullblock '
+     'conv=notrunc', 1, ('gzip',)),
+    ('xz-0', 4194304,
+     'xz -0 -c | xz -dc | dd of=%(out)s bs=4M iflag=fullblock conv=notrunc',
+     1, ('xz',)),
+    ('lz4', 4194304,
+     'lz4 -c | lz4 -dc | dd of=%(out)s bs=4M iflag=fullblock conv=notrunc',
+     1, ('lz4',)),
+    ('zstd-1', 4194304,
+     'zstd -1 -c | zstd -dc | dd of=%(out)s bs=4M iflag=fullblock '
+     'conv=notrunc', 1, ('zstd',)),
+    ('sparse', 4194304,
+     'dd of=%(out)s bs=4M iflag=fullblock conv=sparse,notrunc', 1, ()),
+    ('striped-4', 4194304,
+     'dd of=%(out)s bs=4M iflag=fullblock seek=%(offset)s oflag=seek_bytes '
+     'conv=notrunc', 4, ()),
+    ('verify', 4194304, None, 1, ('python',)),
+    ('verify-striped-4', 4194304, None, 4, ('python',)),
+)
+
+# fraction of the synthetic image left as holes
+sparsities = (0.0, 0.5, 0.9)
+
+def send(image, out, block, receiver, stripes):
+    """send image to out through receiver in stripes; returns seconds taken"""
+    size = os.path.getsize(image)
+    # stripes start on block boundaries
+    step = (size // stripes + block - 1) // block * block
+    xfers = []
+    for offset in range(0, size, step):
+        if receiver is None:
+            cmd = transfer.receiver_cmd(out, block=block)
+        else:
+            cmd = receiver % {'out': out, 'offset': offset}
+        xfers.append(transfer.Transfer(image, cmd, block=block,
+            interval=3600, retries=0, offset=offset,
+            length=min(step, size - offset), verify=receiver is None,
+            logger=logging.getLogger('bench')))
+    threads = [threading.Thread(target=x.run) for x in xfers]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.time() - start
+    if sum([x.sent for x in xfers]) != size:
+        raise RuntimeError('%s did not send the whole image' % receiver)
+    return seconds
+
+def run(workdir, size, repeat):
+    """
+    Time every available variant against each synthetic image. Returns a
+    dict of benchmark name to results.
+    """
+    results = {}
+    out = os.path.join(workdir, 'received.img')
+    for sparsity in sparsities:
+        image = synthetic.make_image(os.path.join(workdir,
+            'sparse-%d.raw' % (sparsity * 100)), size, sparsity)
+        for name, block, receiver, stripes, needs in variants:
+            if [n for n in needs if not find_executable(n)]:
+                continue
+            best = None
+            for i in range(repeat):
+                if os.path.exists(out):
+                    os.remove(out)
+                seconds = send(image, out, block, receiver, stripes)
+                if best is None or seconds < best:
+                    best = seconds
+            results['transfer/%s/sparse-%d' % (name, sparsity * 100)] = {
+                'seconds': best, 'mbps': size / 1048576.0 / best}
+        os.remove(image)
+    if os.path.exists(out):
+        os.remove(out)
+    return results
@@ -0,0 +1,103 @@
+#!/usr/bin/python -tt
+# End-to-end upload_region timings against the fake EC2 backend.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import ConfigParser
+import logging
+import optparse
+import os
+import time
+
+import fake_ec2
+import synthetic
+import uploader
+
+here = os.path.dirname(os.path.abspath(__file__))
+config = os.path.join(here, '..', 'upload', 'uploader.conf')
+
+# scenario name and number of regions uploaded to at once
+scenarios = (
+    ('1-region', 1),
+    ('all-regions', None),
+)
+
+class NullPublisher(object):
+    """keeps benchmark AMIs off the message bus"""
+
+    def publish(self, topic, msg):
+        pass
+
+    def close(self):
+        pass
+
+def setup(workdir):
+    """
+    point uploader at a config, logdir and journal directory of our own;
+    returns the regions
+    """
+    cfg = ConfigParser.ConfigParser()
+    cfg.read(config)
+    cfg.set('DEFAULT', 'logdir', os.path.join(workdir, 'logs'))
+    cfg.set('DEFAULT', 'journal_dir', os.path.join(workdir, 'runs'))
+    cfg.set('DEFAULT', 'analysis_dir', os.path.join(workdir, 'analysis'))
+    cfg.set('DEFAULT', 'aki', 'aki-fake')
+    cfg.set('DEFAULT', 'quiet', 'True')
+    cfg.set('DEFAULT', 'debug', 'False')
+    cfg.set('DEFAULT', 'progress_interval', '3600')
+    for region in cfg.sections():
+        cfg.set(region, 'stage_ami', 'ami-fake')
+    uploader.opts = optparse.Values({'config': cfg, 'regions': cfg.sections()})
+    uploader.mainlog = logging.getLogger('bench')
+    uploader.publisher = NullPublisher()
+    return cfg.sections()
+
+def fake_regions(workdir, regions):
+    """
+    Give uploader a fresh fake backend for each of regions; returns them by
+    region
+    """
+    backends = {}
+    uploader.ec2_cache.clear()
+    for region in regions:
+        backends[region] = fake_ec2.FakeEC2Connection(region,
+            stage_amis=['ami-fake'])
+        uploader.ec2_cache[region] = fake_ec2.FakeEC2Obj(region,
+            backend=backends[region],
+            logfile=os.path.join(workdir, 'logs', 'fake-%s.log' % region))
+    return backends
+
+def upload(workdir, image, regions):
+    """
+    Upload image to regions on fresh fake backends. Returns wall-clock
+    seconds, the slowest region's virtual seconds and the API calls made.
+    """
+    backends = fake_regions(workdir, regions)
+    job = uploader.UploadJob(image, regions=regions)
+    start = time.time()
+    uploader.upload_all(job)
+    seconds = time.time() - start
+    if job.errors:
+        raise RuntimeError('upload failed: %s' % job.errors)
+    return (seconds, max([b._clock.now() for b in backends.values()]),
+            sum([sum(b.calls.values()) for b in backends.values()]))
+
+def run(workdir, size, repeat):
+    """Time each scenario; returns a dict of benchmark name to results"""
+    all_regions = setup(workdir)
+    image = synthetic.make_image(os.path.join(workdir,
+        'Fedora-20-bench-x86_64-1.raw'), size, 0.5)
+    results = {}
+    for name, count in scenarios:
+        regions = all_regions[:count or len(all_regions)]
+        best = None
+        for i in range(repeat):
+            seconds, virtual, calls = upload(workdir, image, regions)
+            if best is None or seconds < best[0]:
+                best = (seconds, virtual, calls)
+        results['upload/%s' % name] = {'seconds': best[0],
+            'virtual_seconds': best[1], 'api_calls': best[2]}
+    os.remove(image)
+    return results
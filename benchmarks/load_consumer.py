@@ -0,0 +1,422 @@
+#!/usr/bin/python -tt
+# Load test of the fedmsg consumer: replay a storm of bus messages into the
+# Nommer and measure how it keeps up.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import imp
+import json
+import logging
+from optparse import OptionParser
+import os
+import Queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+here = os.path.dirname(os.path.abspath(__file__))
+consumer_dir = os.path.join(here, '..', 'fedmsg')
+sys.path.insert(0, os.path.join(here, '..', 'upload'))
+sys.path.insert(0, consumer_dir)
+
+import bench_upload
+import synthetic
+import uploader
+
+# the topic Nommer hands to upload_image.main()
+upload_topic = 'fedoraproject.org.prod.SOMETHING'
+
+#
+# Classes
+#
+
+class Record(object):
+    """what happened to one delivery of a message"""
+    __slots__ = ('msg_id', 'published', 'enqueued', 'started', 'ended',
+                 'error', 'dropped')
+
+    def __init__(self, msg_id, published):
+        self.msg_id = msg_id
+        self.published = published
+        self.enqueued = None
+        self.started = None
+        self.ended = None
+        self.error = None
+        self.dropped = False
+
+
+class Hub(object):
+    """
+    Stands in for the moksha hub: messages land on a queue of queue_size
+    (0 for no limit) and workers threads hand them to the consumer one at a
+    time. A message that can not be queued within timeout is dropped, as a
+    hub whose consumer has fallen behind would.
+    """
+
+    def __init__(self, consumer, workers=1, queue_size=0, timeout=5):
+        self.consumer = consumer
+        self.queue = Queue.Queue(queue_size)
+        self.timeout = timeout
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work,
+                        name='hub-%s' % i) for i in range(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def deliver(self, message, record):
+        try:
+            self.queue.put((message, record), timeout=self.timeout)
+        except Queue.Full:
+            record.dropped = True
+        record.enqueued = time.time()
+
+    def _work(self):
+        while True:
+            message, record = self.queue.get()
+            self.lock.acquire()
+            self.busy += 1
+            self.lock.release()
+            record.started = time.time()
+            try:
+                self.consumer.consume(message)
+            except Exception as e:
+                record.error = '%s: %s' % (e.__class__.__name__, e)
+            record.ended = time.time()
+            self.lock.acquire()
+            self.busy -= 1
+            self.lock.release()
+            self.queue.task_done()
+
+
+class Koji(object):
+    """stands in for koji.ClientSession, answering after latency seconds"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def getTaskInfo(self, task_id, request=False):
+        time.sleep(self.latency)
+        return {'id': task_id, 'state': 2, 'method': 'createImage',
+                'request': []}
+
+
+class ImageStore(object):
+    """
+    Stands in for upload_image.get_image(), which is still a placeholder:
+    asks the Koji stand-in about the message's task and "downloads" its
+    image, a hard link to one synthetic image, into directory. Counts the
+    jobs started for each message ID.
+    """
+
+    def __init__(self, directory, template, koji):
+        self.directory = directory
+        self.template = template
+        self.koji = koji
+        self.names = {}
+        self.fetches = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, message):
+        body = message['body']
+        self.koji.getTaskInfo(body['msg'].get('task_id'), request=True)
+        self.lock.acquire()
+        try:
+            msg_id = body['msg_id']
+            self.fetches[msg_id] = self.fetches.get(msg_id, 0) + 1
+            name = self.names.setdefault(msg_id, 'Fedora-20-Load-x86_64-%s' %
+                (len(self.names) + 1))
+            path = os.path.join(self.directory, '%s.raw' % name)
+            if os.path.exists(path):
+                os.remove(path)
+            os.link(self.template, path)
+        finally:
+            self.lock.release()
+        return path
+
+
+class Bus(object):
+    """stands in for the fedmsg module upload_image publishes through"""
+
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic=None, modname=None, msg=None):
+        self.lock.acquire()
+        self.messages.append((time.time(), topic, msg))
+        self.lock.release()
+
+
+class ConsumerHub(object):
+    """the hub a Nommer is made with, with the database left off"""
+
+    def __init__(self):
+        self.config = {'datanommer.enabled': False}
+
+#
+# Functions
+#
+
+def get_options():
+    usage = """
+    Replay bus messages into the Nommer consumer (fedmsg/__init__.py) at a
+    set rate and report how it copes: how long handing a message to the hub
+    took, how deep its queue got, how long each job took from publication to
+    done, and which messages were dropped or ran more than once. Koji, the
+    image store, the uploader daemon's EC2 and the bus are local stand-ins;
+    everything from Nommer.consume() to the uploader daemon and the mirror
+    is the real code.
+
+    Messages are synthetic unless --replay gives a file of recorded ones, a
+    JSON object per line as datagrepper returns them.
+
+    Usage: %prog [options]"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--count', type='int', default=100,
+        help='Synthetic messages to send (default: %default)')
+    parser.add_option('-r', '--rate', type='float', default=5.0,
+        help='Messages sent per second, 0 for all at once '
+        '(default: %default)')
+    parser.add_option('--replay', help='Send the recorded messages in this '
+        'file instead of synthetic ones')
+    parser.add_option('--keep-topics', action='store_true', default=False,
+        help='Leave the topics of replayed messages alone instead of '
+        'making them all upload requests')
+    parser.add_option('-d', '--duplicates', type='float', default=0.0,
+        help='Fraction of messages the bus delivers twice '
+        '(default: %default)')
+    parser.add_option('-w', '--workers', type='int', default=1,
+        help='Hub threads consuming messages (default: %default)')
+    parser.add_option('-q', '--queue-size', type='int', default=0,
+        help='Messages the hub queues before dropping, 0 for no limit '
+        '(default: %default)')
+    parser.add_option('--region', action='append', default=[],
+        dest='regions', help='Upload to this region, may be used more than '
+        'once (default: the first region of uploader.conf)')
+    parser.add_option('-s', '--size', type='int', default=4,
+        help='Size of the synthetic image in MB (default: %default)')
+    parser.add_option('--koji-latency', type='float', default=0.05,
+        help='Seconds each Koji call takes (default: %default)')
+    parser.add_option('-i', '--interval', type='float', default=1.0,
+        help='Seconds between queue depth samples (default: %default)')
+    parser.add_option('-t', '--timeout', type='float', default=3600,
+        help='Seconds to wait for the queue to drain (default: %default)')
+    parser.add_option('-l', '--log', help='Write the log of the consumer '
+        'and the uploader to this file')
+    parser.add_option('-o', '--output', help='Also write the report, with '
+        'the queue depth samples, to this JSON file')
+    opts, args = parser.parse_args()
+    if len(args) != 0:
+        parser.error('No arguments expected')
+    return opts
+
+def load_nommer():
+    """import fedmsg/__init__.py, which is installed as datanommer's"""
+    return imp.load_source('nommer', os.path.join(consumer_dir,
+        '__init__.py'))
+
+def synthetic_messages(count):
+    for i in range(count):
+        yield {'topic': upload_topic, 'msg_id': str(uuid.uuid4()),
+               'timestamp': time.time(), 'msg': {'task_id': 1000 + i}}
+
+def recorded_messages(path, keep_topics):
+    for line in open(path):
+        if not line.strip():
+            continue
+        body = json.loads(line)
+        body.setdefault('msg_id', str(uuid.uuid4()))
+        body.setdefault('msg', {})
+        if not keep_topics:
+            body['topic'] = upload_topic
+        yield body
+
+def send(hub, bodies, rate, duplicates, seed=0):
+    """
+    Publish bodies to hub, rate a second; duplicates of them are delivered
+    again a second later. Returns the Records of every delivery.
+    """
+    chooser = random.Random(seed)
+    records = []
+    later = []
+    start = time.time()
+    for i, body in enumerate(bodies):
+        if rate:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.time()
+        while later and later[0][0] <= now:
+            records.append(deliver(hub, later.pop(0)[1]))
+        records.append(deliver(hub, body))
+        if chooser.random() < duplicates:
+            later.append((now + 1, body))
+    for when, body in later:
+        time.sleep(max(when - time.time(), 0))
+        records.append(deliver(hub, body))
+    return records
+
+def deliver(hub, body):
+    record = Record(body['msg_id'], time.time())
+    hub.deliver({'topic': body['topic'], 'body': body}, record)
+    return record
+
+def sample(hub, interval, samples, done):
+    """record (seconds, queued, being consumed) every interval until done"""
+    start = time.time()
+    while not done.is_set():
+        samples.append((time.time() - start, hub.queue.qsize(), hub.busy))
+        done.wait(interval)
+
+def percentiles(values, points=(50, 90, 99)):
+    """nearest-rank percentiles of values, plus the max"""
+    values = sorted(values)
+    if not values:
+        return dict([('p%s' % p, None) for p in points] + [('max', None)])
+    result = dict([('p%s' % p, values[min(len(values) - 1,
+        int(len(values) * p / 100.0))]) for p in points])
+    result['max'] = values[-1]
+    return result
+
+def report(records, samples, store, bus, seconds):
+    """the figures of a run, as a dict"""
+    by_id = {}
+    for r in records:
+        by_id.setdefault(r.msg_id, []).append(r)
+    published = set([os.path.basename(name) for when, topic, msg in
+                     bus.messages for name in msg if name != 'sha256'])
+    latencies = []
+    dropped = []
+    failed = []
+    ignored = []
+    for msg_id, deliveries in by_id.items():
+        done = [r for r in deliveries if r.ended is not None and not r.error]
+        name = store.names.get(msg_id)
+        if done and name is None:
+            # consumed, but not a message that starts an upload
+            ignored.append(msg_id)
+            continue
+        if not done or '%s.raw' % name not in published:
+            if [r for r in deliveries if r.error]:
+                failed.append(msg_id)
+            else:
+                dropped.append(msg_id)
+            continue
+        latencies.append(min([r.ended for r in done]) -
+                         min([r.published for r in deliveries]))
+    return {
+        'seconds': seconds,
+        'messages': len(by_id),
+        'deliveries': len(records),
+        'completed': len(latencies),
+        'dropped': len(dropped),
+        'failed': len(failed),
+        'ignored': len(ignored),
+        'duplicated_jobs': len([n for n in store.fetches.values() if n > 1]),
+        'enqueue_latency': percentiles([r.enqueued - r.published
+                                        for r in records]),
+        'queue_wait': percentiles([r.started - r.enqueued for r in records
+                                   if r.started is not None]),
+        'job_latency': percentiles(latencies),
+        'max_queue_depth': max([q for t, q, b in samples] or [0]),
+        'mean_queue_depth': sum([q for t, q, b in samples]) /
+                            float(max(len(samples), 1)),
+        'errors': sorted(set([r.error for r in records if r.error])),
+        'samples': samples,
+    }
+
+def print_report(result):
+    print 'messages %(messages)s, deliveries %(deliveries)s, ' \
+        'completed %(completed)s in %(seconds).1fs' % result
+    print 'dropped %(dropped)s, failed %(failed)s, ignored %(ignored)s, ' \
+        'duplicated jobs %(duplicated_jobs)s' % result
+    print '%-16s %10s %10s %10s %10s' % ('seconds', 'p50', 'p90', 'p99',
+        'max')
+    for name in ('enqueue_latency', 'queue_wait', 'job_latency'):
+        p = result[name]
+        print '%-16s %10s %10s %10s %10s' % tuple([name] + [
+            p[k] is None and '-' or '%.3f' % p[k]
+            for k in ('p50', 'p90', 'p99', 'max')])
+    print 'queue depth: max %(max_queue_depth)s, ' \
+        'mean %(mean_queue_depth).1f' % result
+    for error in result['errors']:
+        print 'error: %s' % error
+
+if __name__ == '__main__':
+    opts = get_options()
+    if opts.log:
+        logging.basicConfig(filename=opts.log, level=logging.INFO,
+            format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    else:
+        logging.getLogger().addHandler(logging.NullHandler())
+    workdir = tempfile.mkdtemp(prefix='consumer-load-')
+    try:
+        regions = bench_upload.setup(workdir)
+        uploader.opts.config.set('DEFAULT', 'analysis_dir',
+            os.path.join(workdir, 'analysis'))
+        # upload_image.py reads the uploader's config on its own
+        conf = os.path.join(workdir, 'uploader.conf')
+        f = open(conf, 'w')
+        try:
+            uploader.opts.config.write(f)
+        finally:
+            f.close()
+        bench_upload.fake_regions(workdir, opts.regions or regions[:1])
+        uploader.opts.regions = opts.regions or regions[:1]
+        socket_path = os.path.join(workdir, 'uploader.sock')
+        server = threading.Thread(target=uploader.serve, args=(socket_path,),
+            name='uploader')
+        server.daemon = True
+        server.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.1)
+
+        nommer = load_nommer()
+        for directory in ('store', 'mirror'):
+            os.makedirs(os.path.join(workdir, directory))
+        store = ImageStore(os.path.join(workdir, 'store'),
+            synthetic.make_image(os.path.join(workdir, 'template.raw'),
+            opts.size * 1048576, 0.5), Koji(opts.koji_latency))
+        bus = Bus()
+        nommer.upload_image.get_image = store.fetch
+        nommer.upload_image.fedmsg = bus
+        nommer.upload_image.uploader_socket = socket_path
+        nommer.upload_image.mirror_dir = os.path.join(workdir, 'mirror')
+        nommer.upload_image.uploader_conf = conf
+        hub = Hub(nommer.Nommer(ConsumerHub()), opts.workers,
+            opts.queue_size)
+
+        if opts.replay:
+            bodies = recorded_messages(opts.replay, opts.keep_topics)
+        else:
+            bodies = synthetic_messages(opts.count)
+        samples = []
+        done = threading.Event()
+        sampler = threading.Thread(target=sample,
+            args=(hub, opts.interval, samples, done))
+        sampler.start()
+        start = time.time()
+        records = send(hub, bodies, opts.rate, opts.duplicates)
+        while hub.queue.unfinished_tasks and \
+                time.time() - start < opts.timeout:
+            time.sleep(0.1)
+        seconds = time.time() - start
+        done.set()
+        sampler.join()
+        result = report(records, samples, store, bus, seconds)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if opts.output:
+        f = open(opts.output, 'w')
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/python -tt
+# Run the upload pipeline benchmarks and compare them against a baseline.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import json
+from optparse import OptionParser
+import os
+import shutil
+import sys
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'upload'))
+
+import bench_transfer
+import bench_upload
+
+suites = {
+    'transfer': bench_transfer,
+    'upload': bench_upload,
+}
+
+def get_options():
+    usage = """
+    Benchmark the upload pipeline without touching AWS. The upload suite runs
+    upload_region end to end against the fake EC2 backend; the transfer
+    suite measures raw throughput of the transfer pipeline variants over a
+    local pipe, using synthetic images of different sparsity. Results are
+    written as JSON and compared against the baseline; a benchmark taking
+    more than tolerance longer than its baseline fails the run.
+
+    Usage: %prog [options]"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-b', '--baseline',
+        default=os.path.join(here, 'baseline.json'),
+        help='Baseline to compare against (default: %default)')
+    parser.add_option('-o', '--output', default='bench-results.json',
+        help='Where to write the results (default: %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help='Runs per benchmark, the best one counts (default: %default)')
+    parser.add_option('-s', '--size', type='int', default=128,
+        help='Size of the synthetic images in MB (default: %default)')
+    parser.add_option('-S', '--suite', action='append', default=[],
+        dest='suites', help='Only run this suite, may be used more than once')
+    parser.add_option('-t', '--tolerance', type='float', default=0.25,
+        help='Allowed slowdown over the baseline (default: %default)')
+    parser.add_option('-u', '--update-baseline', action='store_true',
+        default=False, help='Save the results as the new baseline')
+    opts, args = parser.parse_args()
+    if len(args) != 0:
+        parser.error('No arguments expected')
+    for suite in opts.suites:
+        if suite not in suites:
+            parser.error('No such suite: %s' % suite)
+    if not opts.suites:
+        opts.suites = sorted(suites)
+    if not opts.update_baseline and not os.path.exists(opts.baseline):
+        parser.error('There is no baseline at %s, run with -u to make one' %
+            opts.baseline)
+    return opts
+
+def compare(results, baseline, tolerance):
+    """print results next to the baseline; returns the regressed names"""
+    regressed = []
+    print '%-40s %10s %10s %8s' % ('benchmark', 'seconds', 'baseline', 'change')
+    for name in sorted(results):
+        now = results[name]['seconds']
+        base = baseline.get(name, {}).get('seconds')
+        if base is None:
+            print '%-40s %10.3f %10s %8s' % (name, now, '-', 'new')
+            continue
+        change = (now - base) / base
+        flag = ''
+        if change > tolerance:
+            flag = ' REGRESSED'
+            regressed.append(name)
+        print '%-40s %10.3f %10.3f %+7.0f%%%s' % (name, now, base,
+            change * 100, flag)
+    return regressed
+
+if __name__ == '__main__':
+    opts = get_options()
+    workdir = tempfile.mkdtemp(prefix='upload-bench-')
+    results = {}
+    try:
+        for suite in opts.suites:
+            results.update(suites[suite].run(workdir, opts.size * 1048576,
+                opts.repeat))
+    finally:
+        shutil.rmtree(workdir)
+
+    f = open(opts.output, 'w')
+    json.dump({'size_mb': opts.size, 'results': results}, f, indent=2,
+        sort_keys=True)
+    f.close()
+
+    baseline = {}
+    if os.path.exists(opts.baseline):
+        stored = json.load(open(opts.baseline))
+        if stored.get('size_mb') != opts.size:
+            print 'Baseline was taken with %s MB images, not comparing' % \
+                stored.get('size_mb')
+        else:
+            baseline = stored['results']
+    regressed = compare(results, baseline, opts.tolerance)
+
+    if opts.update_baseline:
+        shutil.copy(opts.output, opts.baseline)
+        print 'Saved the results as the baseline in %s' % opts.baseline
+    elif regressed:
+        print '%s benchmark(s) regressed' % len(regressed)
+        sys.exit(1)
@@ -0,0 +1,32 @@
+#!/usr/bin/python -tt
+# Synthetic disk images for the benchmarks.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import os
+import random
+
+def make_image(path, size, sparsity=0.0, block=1048576, seed=0):
+    """
+    Write a raw image of size bytes to path. A sparsity fraction of its
+    blocks are left as holes (reading back as zeros), chosen with seed so
+    the layout is the same every time; the rest hold random data, which
+    does not compress. Returns path.
+    """
+    chooser = random.Random(seed)
+    f = open(path, 'wb')
+    try:
+        written = 0
+        while written < size:
+            n = min(block, size - written)
+            if chooser.random() < sparsity:
+                f.seek(n, os.SEEK_CUR)
+            else:
+                f.write(os.urandom(n))
+            written += n
+        f.truncate(size)
+    finally:
+        f.close()
+    return path
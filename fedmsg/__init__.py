@@ -33,7 +33,7 @@ class Nommer(fedmsg.consumers.FedmsgConsumer):
 
     def consume(self, message):
         #Edited for our purposes
-        log.debug("Nomming %r" % message)
+        log.debug("Nomming %r", message)
         #TODO: Find/make correct topic
         if message['topic'] == 'fedoraproject.org.prod.SOMETHING':
             upload_image.main(message)
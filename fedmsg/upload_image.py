@@ -1,12 +1,26 @@
 #!/usr/bin/python
 
+import ConfigParser
 import fedmsg
+import json
 import koji
+import logging
 import os
-import shutil
+import socket
 import sys
 
+import analysis
+import mirror
+
 mod = 'cloud-image-uploader'
+#Where uploader.py --daemon listens for jobs
+uploader_socket = '/var/run/cloud-uploader/uploader.sock'
+#The uploader's config, for where it keeps the analysis of each image
+uploader_conf = '/etc/uploader.conf'
+#Where finished images are published
+mirror_dir = '/mnt/alt.fedoraproject.org/pub/alt/cloud'
+
+log = logging.getLogger("fedmsg")
 
 def main(message):
     
@@ -15,17 +29,20 @@ def main(message):
     #Convert from qcow2 to raw
     if location.endswith('.qcow2'):
         newLocation = location[:6] + '.raw'
-        os.system('qemu-img convert %s %s' % (location, (newLocation)))
+        #Write around the page cache (O_DIRECT) so a multi-GB image does not
+        #push the rest of the host out of it; not every filesystem can
+        if os.system('qemu-img convert -t none %s %s' % (location, newLocation)) != 0:
+            os.system('qemu-img convert %s %s' % (location, (newLocation)))
         topic = 'image.qcow2.complete'
     else:
         newLocation = location
         topic = 'image.rawxz.complete'
     if message['topic'] == 'fedoraproject.org.prod.SOMETHING':
         #Upload to EC2
-        os.system('uploader.py %s' % (newLocation))
+        upload_ec2(newLocation)
         #fedmsg is inside uploader.py so no need to broadcast here
 
-    move_image(newLocation, topic)
+    move_image([newLocation], topic)
 
 def get_image(message):
     #The message should have a koji task ID, from that we can get some data
@@ -36,12 +53,67 @@ def get_image(message):
     location = 0
     return location
 
-def move_image(location, top):
-    #Copy file(s) to right location
-    moveLocation = '/mnt/alt.fedoraproject.org/pub/alt/cloud'
-    shutil.move(location, moveLocation)
+def upload_ec2(location):
+    """
+    Hand an image to the uploader daemon and wait for it to finish, logging
+    its progress as it goes. Returns the per-region results the daemon sends
+    back. If no daemon is running we fall back to running uploader.py.
+    """
+    if not os.path.exists(uploader_socket):
+        log.warning('No uploader daemon at %s, running uploader.py',
+            uploader_socket)
+        os.system('uploader.py %s' % (location))
+        return {}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(uploader_socket)
+    stream = sock.makefile('rw')
+    try:
+        stream.write(json.dumps({'image': location}) + '\n')
+        stream.flush()
+        for line in stream:
+            event = json.loads(line)
+            if event['event'] == 'error':
+                log.error('Uploader could not upload %s: %s', location,
+                    event['error'])
+                return {}
+            elif event['event'] == 'done':
+                for region, error in event['errors'].items():
+                    log.error('Upload of %s to %s failed: %s',
+                        location, region, error)
+                return event['results']
+            log.info('Uploader: %s %s %s', event.get('region'),
+                event['event'], event.get('name'))
+    finally:
+        stream.close()
+        sock.close()
+    log.error('Uploader went away while uploading %s', location)
+    return {}
+
+def move_image(locations, top):
+    #Move file(s) to right location, all at once, and list them in its
+    #CHECKSUM. Digests come from the sidecar the uploader left, or from the
+    #copy itself, so no image is read just for them.
+    moveLocation = mirror_dir
+    analysis_dir, chunk = analysis_opts()
+    digests, errors = mirror.publish(locations, moveLocation, logger=log,
+        analysis_dir=analysis_dir, chunk=chunk)
+    if not digests:
+        return
     #fedmsg tells that this exists
-    fedmsg.publish(topic=top, modname=mod, msg={os.path.basename(location): moveLocation})
+    msg = dict([(name, moveLocation) for name in digests])
+    msg['sha256'] = digests
+    fedmsg.publish(topic=top, modname=mod, msg=msg)
+
+def analysis_opts():
+    """
+    The analysis_dir and verify_chunk of the uploader's config, so the
+    sidecars it left are used; the analysis defaults if it has none
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(uploader_conf)
+    defaults = config.defaults()
+    return (defaults.get('analysis_dir') or None,
+        int(defaults.get('verify_chunk') or analysis.default_chunk))
 
 def update_site(location):
     """Have to work on this"""
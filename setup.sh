@@ -28,9 +28,9 @@ cp fedmsg/fedmsg_check.sh upload/uploader.conf upload/boto.cfg /etc/
 if [ ! -d "/usr/lib/python2.7/site-packages/uploading_scripts" ]; then
     mkdir /usr/lib/python2.7/site-packages/uploading_scripts
 fi
-cp upload/fedora_ec2.py README.txt  /usr/lib/python2.7/site-packages/uploading_scripts/
+cp upload/analysis.py upload/fedora_ec2.py upload/grants.py upload/inventory.py upload/journal.py upload/logs.py upload/metrics.py upload/mirror.py upload/planner.py upload/publisher.py upload/reader.py upload/timeline.py upload/transfer.py README.txt  /usr/lib/python2.7/site-packages/uploading_scripts/
 
-cp upload/uploader.py /bin/
+cp upload/uploader.py upload/grants.py upload/inventory.py takedown/delete_ami.py takedown/sweep_orphans.py /bin/
 
 #Moves systemd in
 cp fedmsgd/* /lib/systemd/system/
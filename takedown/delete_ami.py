@@ -1,58 +1,255 @@
-import fedora_ec2
+#!/usr/bin/python -tt
+# Take down AMIs in all regions, along with the snapshots behind them
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import ConfigParser
+import fnmatch
+from optparse import OptionParser
 import os
-import subprocess
-import sys 
+import Queue
+import sys
+import threading
+
+import fedora_ec2
+import inventory
+import logs
+
+#
+# Constants
+#
+
+mainlog = None
+opts = None
+inv = None
+report = []
+report_lock = threading.Lock()
 
+#
+# Functions
+#
 
 def get_options():
     usage = """
-    Removes old AMIs that are no longer needed.
+    Removes old AMIs that are no longer needed. AMIs are picked by name, using
+    shell-style wildcards, and/or by a retention policy: with --keep N only
+    the N newest AMIs of each Platform-PlatVersion-Spin-Arch are kept. Every
+    configured region is searched at once; the chosen AMIs are de-registered
+    and the snapshots backing them deleted in parallel. With --inventory the
+    AMIs are picked from the local inventory (see inventory.py) instead of
+    listing them in every region.
 
-    Usage: %prog [options] Region AMI-ID"""
+    Usage: %prog [options] [AMI-name-pattern ...]"""
     parser = OptionParser(usage=usage)
-    parser.add_option('-t', '--time', help='Timeframe to remove?',
-        default=False, action='store_true')
+    parser.add_option('-c', '--config', help='Add a config file',
+        default=['/etc/uploader.conf'], action='append')
+    parser.add_option('-d', '--dry-run', action='store_true', default=False,
+        help='Only report what would be taken down')
+    parser.add_option('-i', '--inventory', action='store_true',
+        default=False, help='Pick AMIs from the local inventory')
+    parser.add_option('-j', '--jobs', type='int', default=4,
+        help='Snapshots deleted at once in each region (default: %default)')
+    parser.add_option('-k', '--keep', type='int', default=None,
+        help='Keep the N newest AMIs of each spin, take down the rest')
+    parser.add_option('-r', '--region', action='append', default=[],
+        dest='regions', help='Only look in a specific region. May be used '
+        'more than once.')
     global opts
     opts, args = parser.parse_args()
-    if len(args) != 2:
-        Script_Error("Incorrect Arguments")
-    opts.region = sys.args[0]
-    opts.ID = sys.args[1]
-    return
+    if len(args) == 0 and opts.keep is None:
+        parser.error('Give AMI name patterns, --keep, or both')
+    if opts.keep is not None and opts.keep < 0:
+        parser.error('--keep can not be negative')
+    opts.patterns = args
+    parse_config()
+    return opts
 
 def setup_log():
     """set up the main logger"""
     global mainlog
-    format = logging.Formatter("[%(asctime)s %(name)s %(levelname)s]: %(message)s")
     logname = 'takedown'
-    logdir = get_opt('logdir')
-    if not os.path.exists(logdir):
-        os.makedirs(logdir)
-    if os.path.exists(os.path.join(logdir, logname + '.log')):
-        os.remove(os.path.join(logdir, logname + '.log'))
-    mainlog = logging.getLogger(logname)
-    if get_opt('debug') == 'True':
-        mainlog.setLevel(logging.DEBUG)
-    else:
-        mainlog.setLevel(logging.INFO)
-    file_handler = logging.FileHandler(os.path.join(logdir, logname + '.log'))
-    file_handler.setFormatter(format)
-    mainlog.addHandler(file_handler)
-    if not get_opt('quiet') == 'True':
-        stdout_handler = logging.StreamHandler(sys.stdout)
-        stdout_handler.setFormatter(format)
-        mainlog.addHandler(stdout_handler)
-
-def take_down():
-    ec2 = fedora_ec2.EC2Obj(region=opts.region, debug=get_opt('debug'),
-        logfile=os.path.join(get_opt('logdir'), 'takedown-%s-%s.log' % (opts.region,opts.ID)),
+    mainlog = logs.get_logger(logname, os.path.join(get_opt('logdir'),
+        logname + '.log'), debug=get_opt('debug') == 'True',
+        quiet=get_opt('quiet') == 'True')
+
+def parse_config():
+    config = ConfigParser.ConfigParser()
+    success = config.read(opts.config)
+    if len(success) == 0:
+        raise fedora_ec2.Fedora_EC2Error('Could not parse a config file!')
+    if len(opts.regions) == 0:
+        opts.regions = config.sections()
+    opts.config = config
+
+def get_opt(name, region='DEFAULT'):
+    """
+    Return a region specific option, if it is defined, otherwise take the
+    default.
+    """
+    try:
+        return opts.config.get(region, name)
+    except ConfigParser.NoOptionError:
+        try:
+            return opts.config.get('DEFAULT', name)
+        except ConfigParser.NoOptionError:
+            raise fedora_ec2.Fedora_EC2Error('No option defined: %s' % name)
+
+def spin(name):
+    """
+    the Platform-PlatVersion-Spin-Arch an AMI name belongs to, and its
+    variant, or None
+    """
+    m = fedora_ec2.parse_ami_name(name)
+    if not m:
+        return None
+    return (m.group('plat'), m.group('platver'), m.group('prod'),
+            m.group('arch'), m.group('variant'))
+
+def age_key(ami):
+    """sort key putting older AMIs first"""
+    m = fedora_ec2.parse_ami_name(ami.get('name') or '')
+    build = 0
+    if m:
+        build = int(m.group('i'))
+    return (ami.get('creationDate') or '', build, ami.get('name'))
+
+def pick_amis(amis):
+    """
+    Return the AMIs to take down out of all AMIs in a region: those matching
+    a name pattern, minus the newest opts.keep of each spin when keeping.
+    """
+    if opts.patterns:
+        amis = [a for a in amis if [p for p in opts.patterns
+                if fnmatch.fnmatchcase(a.get('name') or '', p)]]
+    if opts.keep is None:
+        return amis
+    spins = {}
+    for ami in amis:
+        key = spin(ami.get('name') or '')
+        if key is None:
+            # not one of ours to age out
+            continue
+        spins.setdefault(key, []).append(ami)
+    doomed = []
+    for key, members in spins.items():
+        members.sort(key=age_key)
+        doomed.extend(members[:max(len(members) - opts.keep, 0)])
+    return doomed
+
+def from_inventory(row):
+    """an inventory AMI row in the shape pick_amis expects"""
+    return {'id': row['id'], 'name': row['name'],
+        'creationDate': row['created'],
+        'snapshots': [s for s in (row['snapshots'] or '').split(',') if s]}
+
+def backing_snaps(ami):
+    """the snapshot IDs in an AMI's block device mapping"""
+    return ami['snapshots']
+
+def delete_snaps(ec2, snaps):
+    """delete snapshots with opts.jobs threads; returns those that failed"""
+    work = Queue.Queue()
+    for snap in snaps:
+        work.put(snap)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                snap = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                ec2.delete_snap(snap)
+            except Exception as e:
+                mainlog.error('[%s] could not delete %s: %s',
+                    ec2.region, snap, e)
+                failed.append(snap)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(opts.jobs, len(snaps)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
+
+def take_down(region):
+    """Find, de-register and clean up the AMIs to take down in a region"""
+    ec2 = fedora_ec2.EC2Obj(region=region, debug=get_opt('debug'),
+        logfile=os.path.join(get_opt('logdir'), 'takedown-%s.log' % region),
         quiet=get_opt('quiet'))
-    #need some sort of identifier
-    destroyed = ec2.deregister_ami(opts.ID)
-    return destroyed
+    if inv is not None:
+        amis = [from_inventory(r) for r in inv.amis(region=region)]
+    else:
+        amis = ec2.get_my_amis()
+    doomed = pick_amis(amis)
+    # variants of an upload share their snapshot, and --keep may keep one
+    # variant of it while taking down another
+    doomed_ids = set([ami['id'] for ami in doomed])
+    in_use = set()
+    for ami in amis:
+        if ami['id'] not in doomed_ids:
+            in_use.update(backing_snaps(ami))
+    snaps = []
+    for ami in doomed:
+        ami_snaps = [s for s in backing_snaps(ami) if s not in in_use]
+        add_report(region, ami['id'], ami.get('name'), ami_snaps)
+        if opts.dry_run:
+            continue
+        ec2.deregister_ami(ami['id'])
+        snaps.extend([s for s in ami_snaps if s not in snaps])
+    # snapshots can only go once nothing registered uses them
+    failed = delete_snaps(ec2, snaps)
+    if inv is not None and not opts.dry_run:
+        inv.forget('amis', region, [ami['id'] for ami in doomed])
+        inv.forget('snaps', region, [s for s in snaps if s not in failed])
+    mainlog.info('[%s] took down %s AMI(s) and %s snapshot(s)',
+        region, len(doomed), len(snaps) - len(failed))
+
+def take_down_thread(region):
+    """thread body for take_down; one region failing must not stop the rest"""
+    logs.tag(region)
+    try:
+        take_down(region)
+    except Exception:
+        mainlog.exception('[%s] takedown failed', region)
+        add_report(region, None, None, [])
+
+def add_report(region, ami_id, name, snaps):
+    report_lock.acquire()
+    report.append((region, ami_id, name, snaps))
+    report_lock.release()
 
 if __name__ == '__main__':
     opts = get_options()
     setup_log()
+    if opts.inventory:
+        inv = inventory.Inventory(get_opt('inventory'), logger=mainlog)
 
-    destroyed = take_down()
+    threads = []
+    for region in opts.regions:
+        mainlog.info('spawning thread for %s', region)
+        threads.append(threading.Thread(target=take_down_thread,
+            args=(region,), name=region))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if opts.dry_run:
+        print 'Would take down:'
+    else:
+        print 'Took down:'
+    failed = False
+    for region, ami_id, name, snaps in sorted(report):
+        if ami_id is None:
+            print '  %-15s FAILED, see the logs' % region
+            failed = True
+        else:
+            print '  %-15s %-14s %s (%s)' % (region, ami_id, name,
+                ', '.join(snaps) or 'no snapshots')
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,256 @@
+#!/usr/bin/python -tt
+# Reclaim what failed uploads left behind in all regions
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import ConfigParser
+from optparse import OptionParser
+import os
+import Queue
+import sys
+import threading
+import time
+
+import fedora_ec2
+import logs
+
+#
+# Constants
+#
+
+mainlog = None
+opts = None
+report = []
+report_lock = threading.Lock()
+
+# what is reclaimed, in the order find_orphans returns it
+kinds = ('instance', 'volume', 'AMI', 'snapshot')
+
+# instance states still worth terminating
+live_states = ['pending', 'running', 'stopping', 'stopped']
+
+#
+# Functions
+#
+
+def get_options():
+    usage = """
+    Find and reclaim what uploads left behind, in every configured region at
+    once. uploader.py tags all it creates with its run ID. Stager instances
+    and volumes whose expiry has passed are terminated and deleted, as are
+    snapshots and AMIs older than scratch_ttl hours whose upload never
+    finished. With --run, everything unfinished of that run is reclaimed
+    right away, expired or not. Finished AMIs and their snapshots are never
+    touched; see delete_ami.py for those.
+
+    Usage: %prog [options]"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--config', help='Add a config file',
+        default=['/etc/uploader.conf'], action='append')
+    parser.add_option('-d', '--dry-run', action='store_true', default=False,
+        help='Only report what would be reclaimed')
+    parser.add_option('-j', '--jobs', type='int', default=4,
+        help='Resources reclaimed at once in each region (default: %default)')
+    parser.add_option('-r', '--region', action='append', default=[],
+        dest='regions', help='Only look in a specific region. May be used '
+        'more than once.')
+    parser.add_option('--run', help='Reclaim what this run left, now')
+    global opts
+    opts, args = parser.parse_args()
+    if len(args) != 0:
+        parser.error('No arguments expected')
+    parse_config()
+    return opts
+
+def setup_log():
+    """set up the main logger"""
+    global mainlog
+    logname = 'sweep'
+    mainlog = logs.get_logger(logname, os.path.join(get_opt('logdir'),
+        logname + '.log'), debug=get_opt('debug') == 'True',
+        quiet=get_opt('quiet') == 'True')
+
+def parse_config():
+    config = ConfigParser.ConfigParser()
+    success = config.read(opts.config)
+    if len(success) == 0:
+        raise fedora_ec2.Fedora_EC2Error('Could not parse a config file!')
+    if len(opts.regions) == 0:
+        opts.regions = config.sections()
+    opts.config = config
+
+def get_opt(name, region='DEFAULT'):
+    """
+    Return a region specific option, if it is defined, otherwise take the
+    default.
+    """
+    try:
+        return opts.config.get(region, name)
+    except ConfigParser.NoOptionError:
+        try:
+            return opts.config.get('DEFAULT', name)
+        except ConfigParser.NoOptionError:
+            raise fedora_ec2.Fedora_EC2Error('No option defined: %s' % name)
+
+def iso(when):
+    """a time as EC2 writes them, to the second, so they compare as strings"""
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when))
+
+def ours(res):
+    """True if res was made by the run we are after (any run without --run)"""
+    return opts.run is None or res.tags.get(fedora_ec2.run_tag) == opts.run
+
+def expired(res, now):
+    """True if a scratch resource may go"""
+    if opts.run is not None:
+        return True
+    return (res.tags.get(fedora_ec2.expires_tag) or '9999')[:19] < now
+
+def abandoned(res, created, cutoff):
+    """True if a snapshot or AMI belongs to an upload that never finished"""
+    if res.tags.get(fedora_ec2.complete_tag):
+        return False
+    if opts.run is not None:
+        return True
+    return (created or '9999')[:19] < cutoff
+
+def find_orphans(ec2, now):
+    """
+    List what uploads left in a region, one filtered Describe call per kind,
+    and return the (instances, volumes, AMIs, snapshots) to reclaim
+    """
+    tagged = {'tag-key': fedora_ec2.run_tag}
+    cutoff = iso(time.time() - 3600 * float(get_opt('scratch_ttl',
+        ec2.region)))
+    insts = [i for i in ec2.iter_insts(dict(tagged,
+             **{'instance-state-name': live_states}))
+             if ours(i) and expired(i, now)]
+    doomed = set([i.id for i in insts])
+    # a volume still attached to a stager we keep has to stay too
+    vols = [v for v in ec2.iter_vols(tagged) if ours(v) and expired(v, now)
+            and (v.instance is None or v.instance in doomed)]
+    amis = []
+    kept = set()
+    for ami in ec2.iter_amis(tagged):
+        if ours(ami) and abandoned(ami, ami.creationDate, cutoff):
+            amis.append(ami)
+        else:
+            kept.update(ami.snapshots)
+    snaps = [s for s in ec2.iter_snaps(tagged) if ours(s) and
+             abandoned(s, s.start_time, cutoff) and s.id not in kept]
+    return insts, vols, amis, snaps
+
+def in_parallel(ec2, what, func, items):
+    """call func on every item with opts.jobs threads; returns the failed"""
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(item.id)
+            except Exception as e:
+                mainlog.error('[%s] could not reclaim %s %s: %s',
+                    ec2.region, what, item.id, e)
+                failed.append(item)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(opts.jobs, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
+
+def sweep(region):
+    """Find and reclaim the orphans of a region"""
+    ec2 = fedora_ec2.EC2Obj(region=region, debug=get_opt('debug'),
+        logfile=os.path.join(get_opt('logdir'), 'sweep-%s.log' % region),
+        quiet=get_opt('quiet'))
+    found = dict(zip(kinds, find_orphans(ec2, iso(time.time()))))
+    if opts.dry_run:
+        for what in kinds:
+            for res in found[what]:
+                add_report(region, what, res, False)
+        return
+
+    def kill(inst_id):
+        ec2.kill_inst(inst_id, wait=True)
+
+    failed = {}
+
+    def chain(steps):
+        for what, func in steps:
+            failed[what] = in_parallel(ec2, what, func, found[what])
+
+    # stagers have to be gone before their volumes come free, and AMIs
+    # before their snapshots; the two chains run side by side
+    chains = [threading.Thread(target=chain, args=([('instance', kill),
+              ('volume', ec2.delete_vol)],)),
+              threading.Thread(target=chain, args=([('AMI',
+              ec2.deregister_ami), ('snapshot', ec2.delete_snap)],))]
+    for t in chains:
+        t.start()
+    for t in chains:
+        t.join()
+    for what in kinds:
+        for res in found[what]:
+            add_report(region, what, res, res in failed[what])
+    mainlog.info('[%s] reclaimed %s', region, ', '.join(['%s %s(s)' %
+        (len(found[what]) - len(failed[what]), what) for what in kinds]))
+
+def sweep_thread(region):
+    """thread body for sweep; one region failing must not stop the rest"""
+    logs.tag(region)
+    try:
+        sweep(region)
+    except Exception:
+        mainlog.exception('[%s] sweep failed', region)
+        add_report(region, None, None, True)
+
+def add_report(region, what, res, failed):
+    report_lock.acquire()
+    report.append((region, what, res, failed))
+    report_lock.release()
+
+if __name__ == '__main__':
+    opts = get_options()
+    setup_log()
+
+    threads = []
+    for region in opts.regions:
+        mainlog.info('spawning thread for %s', region)
+        threads.append(threading.Thread(target=sweep_thread, args=(region,),
+            name=region))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if opts.dry_run:
+        print 'Would reclaim:'
+    else:
+        print 'Reclaimed:'
+    failed = False
+    for region, what, res, res_failed in sorted(report,
+            key=lambda r: (r[0], r[1], r[2] and r[2].id)):
+        if what is None:
+            print '  %-15s FAILED, see the logs' % region
+            failed = True
+            continue
+        status = ''
+        if res_failed:
+            status = ' FAILED'
+            failed = True
+        print '  %-15s %-8s %-14s run %s%s' % (region, what, res.id,
+            res.tags.get(fedora_ec2.run_tag), status)
+    if failed:
+        sys.exit(1)
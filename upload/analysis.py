@@ -0,0 +1,230 @@
+#!/usr/bin/python -tt
+# One pass over an image for everything we want to know about its contents:
+# where its data is, the digest of each chunk and of the whole. The result is
+# kept in a sidecar file and reused until the image changes.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from reader import ImageReader
+
+# bumped whenever the sidecar format changes, so old ones are redone
+version = 1
+
+# where sidecars go when the caller does not say
+default_dir = '/var/lib/cloud-uploader/analysis'
+
+# bytes per hashed chunk, as the verify_chunk option of uploader.conf
+default_chunk = 268435456
+
+# bytes read at a time, and the granularity of the extent map; read_size
+# must be a multiple of extent_block
+read_size = 16777216
+extent_block = 1048576
+
+# realpath -> {chunk: Analysis} of what this process already has
+_cache = {}
+# realpath -> the lock held while that image is analyzed
+_locks = {}
+_lock = threading.Lock()
+
+#
+# Classes
+#
+
+class Analysis(object):
+    """
+    What one pass over an image found. key is (path, device, inode, size,
+    mtime) of the image when it was read; digest is the SHA-256 of all of it
+    and hashes the SHA-256 of each chunk bytes, in order. extents lists the
+    (offset, length) ranges holding anything but zeros, to extent_block
+    bytes.
+    """
+
+    def __init__(self, key, chunk, digest, hashes, extents,
+                 block=extent_block):
+        self.key = tuple(key)
+        self.chunk = chunk
+        self.digest = digest
+        self.hashes = hashes
+        self.extents = extents
+        self.block = block
+
+    @property
+    def size(self):
+        return self.key[3]
+
+    def data_bytes(self):
+        """how many bytes of the image are not zeros"""
+        return sum([length for offset, length in self.extents])
+
+    def chunk_digests(self, offset, length):
+        """
+        The chunk digests of a range, as transfer.chunk_digests() would
+        compute them. The range has to start on a chunk boundary and end on
+        one or at the end of the image; None is returned otherwise.
+        """
+        end = offset + length
+        if offset % self.chunk or (end % self.chunk and end != self.size):
+            return None
+        return self.hashes[offset // self.chunk:
+                           (end + self.chunk - 1) // self.chunk]
+
+    def dump(self):
+        """the sidecar contents; the hashes are one string to keep it small"""
+        return {'version': version, 'key': list(self.key),
+            'chunk': self.chunk, 'block': self.block, 'digest': self.digest,
+            'hashes': ''.join(self.hashes), 'extents': self.extents}
+
+    @classmethod
+    def load(cls, data):
+        hashes = data['hashes']
+        return cls(data['key'], data['chunk'], data['digest'],
+            [hashes[i:i + 64] for i in range(0, len(hashes), 64)],
+            [tuple(e) for e in data['extents']], data['block'])
+
+#
+# Functions
+#
+
+def image_key(path):
+    """what the analysis of an image at path is valid for"""
+    info = os.stat(path)
+    return (path, info.st_dev, info.st_ino, info.st_size, info.st_mtime)
+
+def sidecar_path(directory, path, chunk):
+    """where the sidecar of the image at path is kept in directory"""
+    return os.path.join(directory, '%s-%s-%s.json' % (os.path.basename(path),
+        hashlib.sha1(path).hexdigest()[:12], chunk))
+
+def scan(path, chunk=default_chunk):
+    """
+    Read the image at path once, start to end, and return its Analysis. The
+    key is taken before reading and checked again after, so an image that
+    changed underneath us raises an IOError rather than giving a mix.
+    """
+    key = image_key(path)
+    whole = hashlib.sha256()
+    part = hashlib.sha256()
+    filled = 0
+    hashes = []
+    extents = []
+    zeros = '\0' * extent_block
+    pos = 0
+    f = ImageReader(path, block=read_size)
+    try:
+        while True:
+            buf = f.read()
+            if not len(buf):
+                break
+            whole.update(buf)
+            rest = buf
+            while rest:
+                take = min(len(rest), chunk - filled)
+                part.update(rest[:take])
+                rest = rest[take:]
+                filled += take
+                if filled == chunk:
+                    hashes.append(part.hexdigest())
+                    part = hashlib.sha256()
+                    filled = 0
+            for i in range(0, len(buf), extent_block):
+                piece = buf[i:i + extent_block]
+                if piece == zeros[:len(piece)]:
+                    continue
+                if extents and extents[-1][0] + extents[-1][1] == pos + i:
+                    extents[-1] = (extents[-1][0], extents[-1][1] + len(piece))
+                else:
+                    extents.append((pos + i, len(piece)))
+            pos += len(buf)
+    finally:
+        f.close()
+    if filled:
+        hashes.append(part.hexdigest())
+    if image_key(path) != key or pos != key[3]:
+        raise IOError('%s changed while it was being analyzed' % path)
+    return Analysis(key, chunk, whole.hexdigest(), hashes, extents)
+
+def load(sidecar, key, chunk):
+    """the Analysis in a sidecar file if it is still good for key, else None"""
+    try:
+        data = json.load(open(sidecar))
+    except (IOError, ValueError):
+        return None
+    if data.get('version') != version or data.get('chunk') != chunk or \
+            tuple(data.get('key', ())) != tuple(key):
+        return None
+    try:
+        return Analysis.load(data)
+    except (KeyError, TypeError):
+        return None
+
+def save(sidecar, result):
+    """write a sidecar through a temporary file, so readers never see half"""
+    directory = os.path.dirname(sidecar)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp = '%s.tmp.%s' % (sidecar, os.getpid())
+    f = open(tmp, 'w')
+    try:
+        json.dump(result.dump(), f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp, sidecar)
+
+def analyze(path, directory=None, chunk=default_chunk, logger=None):
+    """
+    Return the Analysis of the image at path, from this process, from its
+    sidecar in directory or, if neither matches the image as it is now, by
+    reading it. Threads asking about the same image at once wait for the
+    one that reads it. Not being able to write the sidecar only costs a
+    reread next time, so it is logged and otherwise ignored.
+    """
+    logger = logger or logging.getLogger('upload')
+    directory = directory or default_dir
+    path = os.path.realpath(path)
+    _lock.acquire()
+    lock = _locks.setdefault(path, threading.Lock())
+    _lock.release()
+    lock.acquire()
+    try:
+        found = cached(path, directory, chunk)
+        if found is None:
+            sidecar = sidecar_path(directory, path, chunk)
+            logger.info('analyzing %s', path)
+            found = scan(path, chunk)
+            logger.info('%s: sha256 %s, %s of %s bytes hold data', path,
+                found.digest, found.data_bytes(), found.size)
+            try:
+                save(sidecar, found)
+            except (IOError, OSError) as e:
+                logger.warning('could not write %s: %s', sidecar, e)
+            _cache.setdefault(path, {})[chunk] = found
+        return found
+    finally:
+        lock.release()
+
+def cached(path, directory=None, chunk=default_chunk):
+    """
+    The Analysis of the image at path if this process or its sidecar has
+    one that is still good, else None; never reads the image
+    """
+    directory = directory or default_dir
+    path = os.path.realpath(path)
+    key = image_key(path)
+    found = _cache.get(path, {}).get(chunk)
+    if found is not None and found.key == key:
+        return found
+    found = load(sidecar_path(directory, path, chunk), key, chunk)
+    if found is not None:
+        _cache.setdefault(path, {})[chunk] = found
+    return found
@@ -0,0 +1,640 @@
+#!/usr/bin/python -tt
+# An in-process stand-in for EC2, for exercising the uploader without AWS.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import fnmatch
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+import fedora_ec2
+
+# virtual seconds each state change takes; 'api' is charged for every call
+default_latencies = {
+    'api': 0.2,
+    'boot': 60,
+    'ssh': 40,
+    'volume_create': 10,
+    'attach': 10,
+    'detach': 10,
+    'snapshot': 300,
+    'terminate': 30,
+}
+
+# resource IDs are unique across all fake regions, like the real ones
+_ids = itertools.count(1)
+
+def _modify(permissions, operation, user_ids, groups):
+    """add or remove user IDs and groups of a launch or volume permission"""
+    for key, values in (('user_ids', user_ids), ('groups', groups)):
+        for v in values or []:
+            if operation == 'add' and v not in permissions[key]:
+                permissions[key].append(v)
+            elif operation == 'remove' and v in permissions[key]:
+                permissions[key].remove(v)
+
+#
+# Classes
+#
+
+class VirtualClock(object):
+    """
+    Time that only moves when someone sleeps or makes an API call. Pass
+    sleep() to an EC2Obj in place of time.sleep and the wait loops finish
+    instantly while still seeing the latencies play out in order.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self._lock.acquire()
+        self._now += seconds
+        self._lock.release()
+
+
+class FakeEC2ResponseError(Exception):
+    """looks enough like boto's EC2ResponseError for our error handling"""
+
+    def __init__(self, status, reason, error_code):
+        Exception.__init__(self, '%s %s: %s' % (status, reason, error_code))
+        self.status = status
+        self.reason = reason
+        self.error_code = error_code
+
+
+class ResultSet(list):
+    """boto hands back lists that can carry attributes; EC2Obj relies on it"""
+    next_token = None
+
+
+class _Tagged(object):
+    """
+    Something that can be tagged and found with Describe filters. filters
+    maps the EC2 filter names supported to the attribute they look at.
+    """
+    filters = {}
+
+    def __init__(self, connection, id):
+        self.connection = connection
+        self.id = id
+        self.tags = {}
+
+    def matches(self, filters):
+        """True if we pass all of filters; values may use * and ? wildcards"""
+        for name, values in (filters or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            if name == 'tag-key':
+                have = self.tags.keys()
+            elif name.startswith('tag:'):
+                have = [self.tags.get(name[4:])]
+            elif name in self.filters:
+                have = [getattr(self, self.filters[name])]
+            else:
+                raise FakeEC2ResponseError(400, 'Bad Request',
+                    'InvalidParameterValue')
+            if not [h for h in have for v in values if h is not None and
+                    fnmatch.fnmatchcase(str(h), str(v))]:
+                return False
+        return True
+
+
+class _Resource(_Tagged):
+    """
+    Something with a state that moves on by itself once the virtual clock
+    passes the time set in _transition(). update() asks the connection, like
+    boto does, so the call is counted and charged.
+    """
+
+    def __init__(self, connection, id):
+        _Tagged.__init__(self, connection, id)
+        self._next = None
+
+    def _transition(self, state, target, latency):
+        self._set_state(state)
+        self._next = (self.connection._clock.now() + latency, target)
+
+    def _advance(self, now):
+        if self._next is not None and now >= self._next[0]:
+            target = self._next[1]
+            self._next = None
+            self._set_state(target)
+
+    def _set_state(self, state):
+        raise NotImplementedError
+
+
+class FakeInstance(_Resource):
+    filters = {'instance-id': 'id', 'image-id': 'image_id',
+               'instance-state-name': 'state', 'launch-time': 'launch_time',
+               'key-name': 'key_name'}
+
+    def __init__(self, connection, id, image_id, instance_type, key_name,
+                 placement, kernel):
+        _Resource.__init__(self, connection, id)
+        self.launch_time = connection._iso_now()
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.key_name = key_name
+        self.placement = placement
+        self.kernel = kernel
+        self.dns_name = ''
+        self.state = None
+        self.ssh_at = None
+
+    def _set_state(self, state):
+        self.state = state
+        if state == 'running':
+            self.dns_name = '%s.%s.compute.fake' % (self.id,
+                self.connection.region)
+            self.ssh_at = (self.connection._clock.now() +
+                self.connection.latencies['ssh'])
+            if self.connection.images[self.image_id].name in \
+                    self.connection.unbootable:
+                self.ssh_at = float('inf')
+        elif state == 'terminated':
+            # EBS volumes it had attached are let go
+            for vol in self.connection.volumes.values():
+                if vol.attach_data.instance_id == self.id:
+                    vol._set_state('detached')
+
+    def update(self):
+        self.connection.get_all_instances([self.id])
+        return self.state
+
+
+class FakeReservation(object):
+
+    def __init__(self, connection, id, instances):
+        self.connection = connection
+        self.id = id
+        self.instances = instances
+
+
+class FakeAttachment(object):
+
+    def __init__(self):
+        self.instance_id = None
+        self.device = None
+        self.status = None
+        self.attach_time = None
+
+
+class FakeVolume(_Resource):
+    filters = {'volume-id': 'id', 'status': 'status',
+               'create-time': 'create_time', 'snapshot-id': 'snapshot_id'}
+
+    def __init__(self, connection, id, size, zone, snapshot_id):
+        _Resource.__init__(self, connection, id)
+        self.create_time = connection._iso_now()
+        self.size = size
+        self.zone = zone
+        self.snapshot_id = snapshot_id
+        self.status = None
+        self.attach_data = FakeAttachment()
+
+    def _set_state(self, state):
+        if state in ('attaching', 'attached'):
+            self.status = 'in-use'
+            self.attach_data.status = state
+        elif state == 'detaching':
+            self.attach_data.status = state
+        elif state == 'detached':
+            self.status = 'available'
+            self.attach_data = FakeAttachment()
+        else:
+            self.status = state
+
+    def update(self):
+        self.connection.get_all_volumes([self.id])
+        return self.status
+
+    def attachment_state(self):
+        return self.attach_data.status
+
+    def create_snapshot(self, description=None):
+        return self.connection.create_snapshot(self.id, description)
+
+
+class FakeSnapshot(_Resource):
+    filters = {'snapshot-id': 'id', 'volume-id': 'volume_id',
+               'status': 'status', 'start-time': 'start_time',
+               'description': 'description'}
+
+    def __init__(self, connection, id, volume_id, description):
+        _Resource.__init__(self, connection, id)
+        self.start_time = connection._iso_now()
+        self.volume_id = volume_id
+        self.volume_size = connection.volumes[volume_id].size
+        # boto sends whatever it is given as a string
+        if description is not None:
+            description = str(description)
+        self.description = description
+        self.status = None
+        self.volume_permissions = {'groups': [], 'user_ids': []}
+
+    def _set_state(self, state):
+        self.status = state
+
+    def update(self):
+        self.connection.get_all_snapshots([self.id])
+        return self.status
+
+
+class FakeConsoleOutput(object):
+    """what get_console_output hands back"""
+
+    def __init__(self, instance_id, output):
+        self.instance_id = instance_id
+        self.output = output
+
+
+class FakeAttribute(object):
+    """what get_image_attribute hands back; attrs holds the permissions"""
+
+    def __init__(self, permissions):
+        self.attrs = dict([(k, list(v)) for k, v in permissions.items() if v])
+
+
+class FakeImage(_Tagged):
+    filters = {'image-id': 'id', 'name': 'name', 'state': 'state',
+               'architecture': 'architecture'}
+
+    def __init__(self, connection, id, name, architecture, owner_id='self',
+                 kernel_id=None, root_device_name=None, block_device_map=None,
+                 description=None):
+        _Tagged.__init__(self, connection, id)
+        self.name = name
+        self.architecture = architecture
+        self.owner_id = owner_id
+        self.kernel_id = kernel_id
+        self.root_device_name = root_device_name
+        self.block_device_mapping = block_device_map
+        self.description = description
+        self.virtualization_type = 'paravirtual'
+        self.state = 'available'
+        self.creationDate = connection._iso_now()
+        self.launch_permissions = {'groups': [], 'user_ids': []}
+
+
+class FakeKeyPair(_Tagged):
+    filters = {'key-name': 'name'}
+
+    def __init__(self, connection, name):
+        _Tagged.__init__(self, connection, name)
+        self.name = name
+
+
+class FakeSecurityGroup(_Tagged):
+    filters = {'group-name': 'name'}
+
+    def __init__(self, connection, name):
+        _Tagged.__init__(self, connection, 'sg-%08x' % next(_ids))
+        self.name = name
+
+
+class FakeEC2Connection(object):
+    """
+    One region of a fake EC2. Implements the subset of boto's EC2Connection
+    that EC2Obj uses. Every call costs latencies['api'] virtual seconds, and
+    with probability throttle fails with RequestLimitExceeded. Pass seed to
+    get the same throttling on every run.
+
+    stage_amis registers the given AMI IDs up front so they can be booted
+    (AKI IDs may be given there too). key_pairs and groups are the SSH key
+    pairs and security groups the region has. Instances of the images named
+    in unbootable never get as far as SSH or a login prompt.
+    If workdir is set, anything written to an attached device through
+    FakeEC2Obj.ssh_cmd lands in workdir/<volume id>.img; otherwise it goes
+    to /dev/null.
+    """
+
+    def __init__(self, region='us-east-1', latencies=None, throttle=0.0,
+                 seed=0, clock=None, stage_amis=(), workdir=None,
+                 key_pairs=(), groups=('Default',), unbootable=()):
+        self.region = region
+        self.unbootable = set(unbootable)
+        self.latencies = default_latencies.copy()
+        if latencies:
+            self.latencies.update(latencies)
+        self.throttle = throttle
+        self._random = random.Random(seed)
+        self._clock = clock or VirtualClock()
+        self.workdir = workdir
+        self.calls = {}
+        self._lock = threading.RLock()
+        self.instances = {}
+        self.reservations = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.images = {}
+        for ami in stage_amis:
+            self.images[ami] = FakeImage(self, ami, ami, 'x86_64')
+        self.key_pairs = dict([(k, FakeKeyPair(self, k)) for k in key_pairs])
+        self.groups = dict([(g, FakeSecurityGroup(self, g)) for g in groups])
+
+    def _new_id(self, prefix):
+        return '%s-%08x' % (prefix, next(_ids))
+
+    def _call(self, action):
+        """charge, count and maybe throttle an API call"""
+        self._lock.acquire()
+        try:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            self._clock.sleep(self.latencies['api'])
+            if self.throttle and self._random.random() < self.throttle:
+                raise FakeEC2ResponseError(503, 'Service Unavailable',
+                    'RequestLimitExceeded')
+            now = self._clock.now()
+            for coll in (self.instances, self.volumes, self.snapshots):
+                for res in coll.values():
+                    res._advance(now)
+        finally:
+            self._lock.release()
+
+    def _iso_now(self):
+        """the virtual time, formatted the way EC2 reports times"""
+        return time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+            time.gmtime(self._clock.now()))
+
+    def _lookup(self, coll, ids, code, filters=None):
+        if not ids:
+            found = coll.values()
+        else:
+            try:
+                found = [coll[i] for i in ids]
+            except KeyError:
+                raise FakeEC2ResponseError(400, 'Bad Request', code)
+        return ResultSet([r for r in found if r.matches(filters)])
+
+    # regions
+
+    def get_all_regions(self, region_names=None):
+        self._call('get_all_regions')
+        return ResultSet([self.region])
+
+    # images
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self._call('get_all_images')
+        return self._lookup(self.images, image_ids, 'InvalidAMIID.NotFound',
+            filters)
+
+    def register_image(self, name=None, description=None, image_location=None,
+                       architecture=None, kernel_id=None, ramdisk_id=None,
+                       root_device_name=None, block_device_map=None,
+                       virtualization_type='paravirtual'):
+        self._call('register_image')
+        if [i for i in self.images.values() if i.name == name]:
+            raise FakeEC2ResponseError(400, 'Bad Request',
+                'InvalidAMIName.Duplicate')
+        ami = FakeImage(self, self._new_id('ami'), name, architecture,
+            kernel_id=kernel_id, root_device_name=root_device_name,
+            block_device_map=block_device_map, description=description)
+        ami.virtualization_type = virtualization_type
+        self.images[ami.id] = ami
+        return ami.id
+
+    def deregister_image(self, image_id, delete_snapshot=False):
+        self._call('deregister_image')
+        self._lookup(self.images, [image_id], 'InvalidAMIID.NotFound')
+        del self.images[image_id]
+        return True
+
+    def modify_image_attribute(self, image_id, attribute='launchPermission',
+                               operation='add', user_ids=None, groups=None):
+        self._call('modify_image_attribute')
+        ami = self._lookup(self.images, [image_id], 'InvalidAMIID.NotFound')[0]
+        _modify(ami.launch_permissions, operation, user_ids, groups)
+        return True
+
+    def get_image_attribute(self, image_id, attribute='launchPermission'):
+        self._call('get_image_attribute')
+        ami = self._lookup(self.images, [image_id], 'InvalidAMIID.NotFound')[0]
+        return FakeAttribute(ami.launch_permissions)
+
+    # key pairs and security groups
+
+    def get_all_key_pairs(self, keynames=None, filters=None):
+        self._call('get_all_key_pairs')
+        return self._lookup(self.key_pairs, keynames,
+            'InvalidKeyPair.NotFound', filters)
+
+    def get_all_security_groups(self, groupnames=None, group_ids=None,
+                                filters=None):
+        self._call('get_all_security_groups')
+        return self._lookup(self.groups, groupnames,
+            'InvalidGroup.NotFound', filters)
+
+    # instances
+
+    def run_instances(self, image_id, instance_type='m1.small', key_name=None,
+                      placement=None, security_groups=None, kernel_id=None):
+        self._call('run_instances')
+        self._lookup(self.images, [image_id], 'InvalidAMIID.NotFound')
+        inst = FakeInstance(self, self._new_id('i'), image_id, instance_type,
+            key_name, placement, kernel_id)
+        inst._transition('pending', 'running', self.latencies['boot'])
+        res = FakeReservation(self, self._new_id('r'), [inst])
+        self.instances[inst.id] = inst
+        self.reservations[inst.id] = res
+        return res
+
+    def get_all_instances(self, instance_ids=None, filters=None,
+                          max_results=None, next_token=None):
+        self._call('get_all_instances')
+        insts = self._lookup(self.instances, instance_ids,
+            'InvalidInstanceID.NotFound', filters)
+        insts.sort(key=lambda i: i.id)
+        start = int(next_token or 0)
+        end = len(insts)
+        if max_results:
+            end = min(start + max_results, end)
+        page = ResultSet([self.reservations[i.id] for i in insts[start:end]])
+        if end < len(insts):
+            page.next_token = str(end)
+        return page
+
+    def get_console_output(self, instance_id):
+        self._call('get_console_output')
+        inst = self._lookup(self.instances, [instance_id],
+            'InvalidInstanceID.NotFound')[0]
+        if inst.ssh_at == float('inf'):
+            output = 'Kernel panic - not syncing: VFS: Unable to mount root fs'
+        elif inst.state == 'running' and self._clock.now() >= inst.ssh_at:
+            output = ('Fedora release 20\nKernel on an x86_64\n\n'
+                'localhost login: ')
+        else:
+            output = None
+        return FakeConsoleOutput(instance_id, output)
+
+    def terminate_instances(self, instance_ids=None):
+        self._call('terminate_instances')
+        insts = self._lookup(self.instances, instance_ids,
+            'InvalidInstanceID.NotFound')
+        for inst in insts:
+            inst._transition('shutting-down', 'terminated',
+                self.latencies['terminate'])
+        return insts
+
+    # volumes
+
+    def create_volume(self, size, zone, snapshot=None):
+        self._call('create_volume')
+        vol = FakeVolume(self, self._new_id('vol'), size, zone, snapshot)
+        vol._transition('creating', 'available',
+            self.latencies['volume_create'])
+        self.volumes[vol.id] = vol
+        return vol
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        self._call('get_all_volumes')
+        return self._lookup(self.volumes, volume_ids, 'InvalidVolume.NotFound',
+            filters)
+
+    def attach_volume(self, volume_id, instance_id, device):
+        self._call('attach_volume')
+        vol = self._lookup(self.volumes, [volume_id],
+            'InvalidVolume.NotFound')[0]
+        if vol.status != 'available':
+            raise FakeEC2ResponseError(400, 'Bad Request',
+                'IncorrectState')
+        vol.attach_data.instance_id = instance_id
+        vol.attach_data.device = device
+        vol.attach_data.attach_time = self._clock.now()
+        vol._transition('attaching', 'attached', self.latencies['attach'])
+        return True
+
+    def detach_volume(self, volume_id, instance_id=None):
+        self._call('detach_volume')
+        vol = self._lookup(self.volumes, [volume_id],
+            'InvalidVolume.NotFound')[0]
+        vol._transition('detaching', 'detached', self.latencies['detach'])
+        return True
+
+    def delete_volume(self, volume_id):
+        self._call('delete_volume')
+        vol = self._lookup(self.volumes, [volume_id],
+            'InvalidVolume.NotFound')[0]
+        if vol.status == 'in-use':
+            raise FakeEC2ResponseError(400, 'Bad Request', 'VolumeInUse')
+        del self.volumes[volume_id]
+        return True
+
+    # snapshots
+
+    def create_snapshot(self, volume_id, description=None):
+        self._call('create_snapshot')
+        self._lookup(self.volumes, [volume_id], 'InvalidVolume.NotFound')
+        snap = FakeSnapshot(self, self._new_id('snap'), volume_id, description)
+        snap._transition('pending', 'completed', self.latencies['snapshot'])
+        self.snapshots[snap.id] = snap
+        return snap
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        self._call('get_all_snapshots')
+        return self._lookup(self.snapshots, snapshot_ids,
+            'InvalidSnapshot.NotFound', filters)
+
+    def modify_snapshot_attribute(self, snapshot_id,
+                                  attribute='createVolumePermission',
+                                  operation='add', user_ids=None, groups=None):
+        self._call('modify_snapshot_attribute')
+        snap = self._lookup(self.snapshots, [snapshot_id],
+            'InvalidSnapshot.NotFound')[0]
+        _modify(snap.volume_permissions, operation, user_ids, groups)
+        return True
+
+    def get_snapshot_attribute(self, snapshot_id,
+                               attribute='createVolumePermission'):
+        self._call('get_snapshot_attribute')
+        snap = self._lookup(self.snapshots, [snapshot_id],
+            'InvalidSnapshot.NotFound')[0]
+        return FakeAttribute(snap.volume_permissions)
+
+    def delete_snapshot(self, snapshot_id):
+        self._call('delete_snapshot')
+        self._lookup(self.snapshots, [snapshot_id], 'InvalidSnapshot.NotFound')
+        for ami in self.images.values():
+            if snapshot_id in [d.snapshot_id for d in
+                               (ami.block_device_mapping or {}).values()]:
+                raise FakeEC2ResponseError(400, 'Bad Request',
+                    'InvalidSnapshot.InUse')
+        del self.snapshots[snapshot_id]
+        return True
+
+    # tags
+
+    def create_tags(self, resource_ids, tags):
+        self._call('create_tags')
+        for res_id in resource_ids:
+            for coll in (self.instances, self.volumes, self.snapshots,
+                         self.images):
+                if res_id in coll:
+                    coll[res_id].tags.update(tags)
+                    break
+            else:
+                raise FakeEC2ResponseError(400, 'Bad Request',
+                    'InvalidID')
+        return True
+
+    # the stager's disks
+
+    def device_file(self, instance_id, device):
+        """where a write to device on instance_id ends up locally"""
+        if self.workdir is None:
+            return os.devnull
+        for vol in self.volumes.values():
+            if (vol.attach_data.instance_id == instance_id and
+                    vol.attach_data.device == device):
+                return os.path.join(self.workdir, '%s.img' % vol.id)
+        raise fedora_ec2.Fedora_EC2Error('Nothing attached at %s on %s' %
+            (device, instance_id))
+
+
+class FakeEC2Obj(fedora_ec2.EC2Obj):
+    """
+    An EC2Obj talking to a FakeEC2Connection on a virtual clock. SSH to a
+    stager works once it has been running for latencies['ssh'] virtual
+    seconds, and commands sent to it with ssh_cmd run locally, writing
+    devices to the files FakeEC2Connection.device_file picks.
+    """
+
+    def __init__(self, region='us-east-1', backend=None, **kwargs):
+        if backend is None:
+            backend = FakeEC2Connection(region)
+        self.backend = backend
+        kwargs.setdefault('quiet', 'True')
+        fedora_ec2.EC2Obj.__init__(self, region=region, conn=backend,
+            sleep=backend._clock.sleep, **kwargs)
+
+    def get_ssh_opts(self, path=None):
+        return ''
+
+    def ssh_banner(self, instance, port=22, timeout=5):
+        inst = self.backend.instances[instance['id']]
+        return inst.state == 'running' and \
+            self.backend._clock.now() >= inst.ssh_at
+
+    def ssh_cmd(self, instance, cmd, path=None):
+        inst_id = instance['id']
+        return re.sub(r'/dev/sd[a-z]+[0-9]*',
+            lambda m: self.backend.device_file(inst_id, m.group(0)), cmd)
+
+    def run_ssh(self, instance, cmd, path=None):
+        inst = self.backend.instances[instance['id']]
+        if inst.state != 'running' or self.backend._clock.now() < inst.ssh_at:
+            raise fedora_ec2.Fedora_EC2Error('ssh: connect to host %s: Connection refused'
+                % inst.dns_name)
+        return self.run_cmd(self.ssh_cmd(instance, cmd, path), retry=0)
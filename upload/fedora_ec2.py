@@ -5,13 +5,16 @@
 #          Sam Kottler <shk@redhat.com>
 #
 
-import logging
 import os
 import re
+import socket
 import subprocess
-import sys
 import time
 
+import logs
+import metrics
+import timeline
+
 try:
     import boto
     from boto.ec2.connection import EC2Connection
@@ -37,10 +40,44 @@ We're smart enough to drop the .raw if you are using the filename, which is the
 default behavior. If you do not like using the filename, you can use --name to
 forcibly set the name to parse. Do not include .raw if you use --name."""
 
+# tags put on everything the uploader creates, so what a failed run leaves
+# behind can be found and swept up; see takedown/sweep_orphans.py
+run_tag = 'cloud-uploader:run'
+role_tag = 'cloud-uploader:role'
+expires_tag = 'cloud-uploader:expires'
+complete_tag = 'cloud-uploader:complete'
+variant_tag = 'cloud-uploader:variant'
+
+# what a console shows once an image has booted far enough to log in to
+boot_marker = re.compile(r'login: *$|Cloud-init v\. \S+ finished', re.M)
+
 def check_name(name):
     """verify the name of the image matches expectations"""
     return re.match(r'(?P<plat>[^-]+)-(?P<platver>[^-]+)-(?:(?P<prod>[^-]+)-(?:(?P<prodver>[^-]+)-)?)?(?P<arch>[^-]+)-(?P<i>\d+)$', name)
 
+def parse_ami_name(name):
+    """
+    like check_name, for the names of AMIs we registered: those of variants
+    end in -<variant>, which the variant group holds
+    """
+    return re.match(r'(?P<plat>[^-]+)-(?P<platver>[^-]+)-(?:(?P<prod>[^-]+)-(?:(?P<prodver>[^-]+)-)?)?(?P<arch>[^-]+)-(?P<i>\d+)(?:-(?P<variant>[a-z][a-z0-9]*))?$', name)
+
+def _drain(results):
+    """
+    Yield the items of a boto result list, letting go of each one as it is
+    handed out so a big listing is not held twice while it is converted
+    """
+    results.reverse()
+    while results:
+        yield results.pop()
+
+def _tags(obj):
+    """a plain dict of a boto object's tags, or None if it has none"""
+    tags = getattr(obj, 'tags', None)
+    if not tags:
+        return None
+    return dict(tags)
+
 
 #
 # Classes
@@ -50,6 +87,58 @@ class Fedora_EC2Error(Exception):
     """Custom exception for this library"""
     pass
 
+class Record(object):
+    """
+    A compact entry of an account listing, holding only the fields we use
+    instead of a copy of the boto object's __dict__. Fields are attributes,
+    but rec['id'] and rec.get('name') work too, like the dicts these used to
+    be. tags is None for untagged resources.
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' %
+            (name, getattr(self, name)) for name in self.__slots__]))
+
+class AMIRecord(Record):
+    """an AMI; snapshots lists the snapshot IDs in its block device mapping"""
+    __slots__ = ('region', 'id', 'name', 'architecture', 'creationDate',
+                 'state', 'kernel_id', 'root_device_name', 'snapshots', 'tags')
+
+class SnapRecord(Record):
+    """a snapshot"""
+    __slots__ = ('region', 'id', 'volume_id', 'volume_size', 'status',
+                 'start_time', 'description', 'tags')
+
+class VolRecord(Record):
+    """an EBS volume; instance is what it is attached to, if anything"""
+    __slots__ = ('region', 'id', 'size', 'zone', 'status', 'create_time',
+                 'snapshot_id', 'instance', 'tags')
+
+class InstRecord(Record):
+    """an instance"""
+    __slots__ = ('region', 'id', 'image_id', 'state', 'launch_time',
+                 'key_name', 'instance_type', 'placement', 'dns_name', 'tags')
+
 class EC2Obj(object):
     """
     An object that encapsulates useful information that is specific to RCM's
@@ -61,7 +150,7 @@ class EC2Obj(object):
     _devs.update([('/dev/sd' + chr(i), None) for i in range(104, 111)])
 
     def __init__(self, region='US', cred=None, quiet=False, logfile=None,
-                 debug=False):
+                 debug=False, conn=None, sleep=None):
         """
         Constructor; useful options to the object are interpreted here.
         EC2Objs are region specific and we want to support a script
@@ -73,47 +162,39 @@ class EC2Obj(object):
         quiet: Do not print to stdout
         logfile: path to write the log for use of this object
         debug: enable debug output
+        conn: use this region connection instead of making one with boto,
+              see fake_ec2
+        sleep: use this instead of time.sleep in the wait loops
         """
         # logging
-        format = logging.Formatter("[%(asctime)s %(name)s %(levelname)s]: %(message)s")
         if logfile == None:
             logfile = '%s.%s.log' % (__name__, EC2Obj._instances)
         logname = os.path.basename(logfile)
         if logname.endswith('.log'):
             logname = logname[:-4]
-        logdir = os.path.dirname(logfile)
-        if logdir != '' and not os.path.exists(logdir):
-            os.makedirs(logdir)
-        if os.path.exists(os.path.join(logdir,logname+'.log')):
-            os.remove(os.path.join(logdir,logname+'.log'))
-        self.logger = logging.getLogger(logname)
-        if debug == 'True':
-            self.logger.setLevel(logging.DEBUG)
-        else:
-            self.logger.setLevel(logging.INFO)
-        file_handler = logging.FileHandler(logfile)
-        file_handler.setFormatter(format)
-        self.logger.addHandler(file_handler)
-        if not quiet == 'True':
-            stdout_handler = logging.StreamHandler(sys.stdout)
-            stdout_handler.setFormatter(format)
-            self.logger.addHandler(stdout_handler)
+        self.logger = logs.get_logger(logname, logfile,
+            debug=debug == 'True', quiet=quiet == 'True')
 
         # object initialization
-        if os.path.exists('/etc/boto.cfg'):
-            self.conn = EC2Connection()
-        else:
-            Fedora_EC2Error('No boto.cfg file')
         self.region = self.alias_region(region)
-        regionconn = self.conn.get_all_regions(self.region)
-        self.conn = EC2Connection(region=regionconn[0])
+        if conn == None:
+            if os.path.exists('/etc/boto.cfg'):
+                conn = EC2Connection()
+            else:
+                Fedora_EC2Error('No boto.cfg file')
+            regionconn = conn.get_all_regions(self.region)
+            conn = EC2Connection(region=regionconn[0])
+        self.conn = metrics.InstrumentedConnection(conn, self.region)
+        if sleep == None:
+            sleep = time.sleep
+        self._sleep = sleep
         self.rurl = 'http://ec2.%s.amazonaws.com' % self.region
-        self.logger.debug('Region: %s' % self.region)
+        self.logger.debug('Region: %s', self.region)
         self.def_zone = '%sa' % self.region
         self.def_group = 'Default'
         self.id = EC2Obj._instances
         self._att_devs = {}
-        self.logger.debug('Initialized EC2Obj #%s' % EC2Obj._instances)
+        self.logger.debug('Initialized EC2Obj #%s', EC2Obj._instances)
         EC2Obj._instances += 1
 
 
@@ -138,7 +219,7 @@ class EC2Obj(object):
             # these are what we want, do nothing
             pass
         else:
-            self.logger.warn('Unrecognized region: %s' % region)
+            self.logger.warn('Unrecognized region: %s', region)
             #Set to east by default
             region = 'us-east-1'
         return region
@@ -166,17 +247,18 @@ class EC2Obj(object):
 
         info = res.__dict__
 
-        self.logger.debug('Retrieved image info: %s' % info)
+        self.logger.debug('Retrieved image info: %s', info)
         return info
 
     def deregister_ami(self, ami_id):
         """De-Register an AMI. Returns the ID of the AMI"""
         self.conn.deregister_image(ami_id, delete_snapshot=False)
-        self.logger.info('De-Registered an AMI: %s' % ami_id)
+        self.logger.info('De-Registered an AMI: %s', ami_id)
         return ami_id
 
     def start_ami(self, ami, aki=None, ari=None, wait=False, zone=None,
-                  group=None, keypair=None, disk=True):
+                  group=None, keypair=None, disk=True, tags=None,
+                  span='boot'):
         """
         Start the designated AMI. This function does not guarantee success. See
         inst_info to verify an instance started successfully.
@@ -188,6 +270,8 @@ class EC2Obj(object):
             - zone: the availability zone to start in
             - group: the security group to start the instance in
             - keypair: SSH key pair to log in with
+            - tags: a dict of tags to put on the instance as soon as it exists
+            - span: the timeline stage the boot counts towards
         Returns a dictionary describing the instance, see inst_info().
         """
         ami_info = self.ami_info(ami)
@@ -204,16 +288,20 @@ class EC2Obj(object):
         else:
             self._log_error('Unsupported arch: %s' % ami_info['architecture'])
 
-        reservation = self.conn.run_instances(ami, instance_type=size, key_name=keypair,
-                placement=zone, security_groups=group, kernel_id=aki)
-        instance = reservation.instances[0]
+        with timeline.span(span):
+            reservation = self.conn.run_instances(ami, instance_type=size,
+                    key_name=keypair, placement=zone, security_groups=group,
+                    kernel_id=aki)
+            instance = reservation.instances[0]
+            if tags:
+                self.add_tags([instance.id], tags)
 
-        if wait:
-            info = self.wait_inst_status(instance.id, 'running')
-        else:
-            info = self.inst_info(instance.id)
+            if wait:
+                info = self.wait_inst_status(instance.id, 'running')
+            else:
+                info = self.inst_info(instance.id)
         self._att_devs[info['id']] = EC2Obj._devs.copy()
-        self.logger.info('Started an instance of %s: %s' % (ami, instance.id))
+        self.logger.info('Started an instance of %s: %s', ami, instance.id)
         return info
 
     def inst_info(self, inst_id):
@@ -243,7 +331,7 @@ class EC2Obj(object):
         info2 = inst_info.__dict__
         info.update(info2)
 
-        self.logger.debug('Retrieved instance info: %s' % info)
+        self.logger.debug('Retrieved instance info: %s', info)
         return info
 
     def get_url(self, id):
@@ -251,7 +339,7 @@ class EC2Obj(object):
         info = self.inst_info(id)
 
         if info['dns_name'] == '':
-            self.logger.warning('Sought URL for %s but it is not defined' % id)
+            self.logger.warning('Sought URL for %s but it is not defined', id)
         return info['dns_name']
 
     def wait_inst_status(self, instance, status, tries=0, interval=20):
@@ -277,9 +365,9 @@ class EC2Obj(object):
                 return info
             if instance.update() == 'terminated':
                 self._log_error('%s is in the terminated state!' % instance.id)
-            self.logger.info('Try #%s: %s is not %s, sleeping %s seconds' %
-                (timer, instance.id, status, interval))
-            time.sleep(interval)
+            self.logger.info('Try #%s: %s is not %s, sleeping %s seconds',
+                timer, instance.id, status, interval)
+            self._sleep(interval)
             timer += 1
         self._log_error('Timeout exceeded for %s to be %s' % (instance.id, status))
 
@@ -298,11 +386,21 @@ class EC2Obj(object):
         except IndexError:
             self._log_error('No free device names left for %s' % inst_id)
         self._att_devs[inst_id][dev] = vol_id
-        self.logger.debug('taking %s to attach %s to %s' %
-            (dev, vol_id, inst_id))
+        self.logger.debug('taking %s to attach %s to %s',
+            dev, vol_id, inst_id)
         return dev
 
 
+    def claim_dev(self, inst_id, vol_id, dev):
+        """
+        Note that vol_id is attached to inst_id as dev already, so it can be
+        detached with detach_vol() even if another process attached it
+        """
+        if self._att_devs.get(inst_id) == None:
+            self._att_devs[inst_id] = EC2Obj._devs.copy()
+        if vol_id not in self._att_devs[inst_id].values():
+            self._att_devs[inst_id][dev] = vol_id
+
     def _release_dev(self, inst_id, vol_id):
         """
         Internal method to release a device name back into the pool when
@@ -315,12 +413,12 @@ class EC2Obj(object):
         dev = [d for d in self._att_devs[inst_id].keys()
             if self._att_devs[inst_id][d] == vol_id].pop()
         self._att_devs[inst_id][dev] = None
-        self.logger.debug('releasing %s from %s for %s' %
-            (dev, inst_id, vol_id))
+        self.logger.debug('releasing %s from %s for %s',
+            dev, inst_id, vol_id)
         return dev
 
 
-    def create_vol(self, size, zone=None, wait=False, snap=None):
+    def create_vol(self, size, zone=None, wait=False, snap=None, tags=None):
         """
         Create an EBS volume of the given size in region/zone. If size == 0,
         do not explicitly set a size; this may be useful with "snap", which
@@ -329,18 +427,22 @@ class EC2Obj(object):
         This function does not guarantee success, you should check with
         vol_available() to ensure it was created successfully. If wait is set
         to True, we will wait for the volume to be available before returning;
-        returns a dictionary describing the volume, see vol_info().
+        returns a dictionary describing the volume, see vol_info(). tags is a
+        dict of tags to put on the volume as soon as it exists.
         """
         if zone == None:
             zone = self.def_zone
         if size == 0 and snap == None:
             raise Fedora_EC2Error('No size or snapshot defined')
-        volume = self.conn.create_volume(size, zone, snapshot=snap)
-        if wait:
-            info = self.wait_vol_status(volume.id, 'available')
-        else:
-            info = self.vol_info(volume.id)
-        self.logger.info('Created an EBS volume: %s' % volume.id)
+        with timeline.span('volume_create'):
+            volume = self.conn.create_volume(size, zone, snapshot=snap)
+            if tags:
+                self.add_tags([volume.id], tags)
+            if wait:
+                info = self.wait_vol_status(volume.id, 'available')
+            else:
+                info = self.vol_info(volume.id)
+        self.logger.info('Created an EBS volume: %s', volume.id)
         return info
 
     def attach_vol(self, inst_id, vol_id, wait=False, dev=None):
@@ -358,15 +460,16 @@ class EC2Obj(object):
         else:
             if not dev.startswith('/dev/sd'):
                 self._log_error('Not a valid device name: %s' % dev)
-        check = self.conn.get_all_volumes([vol_id])[0]
-        if check.status == 'in-use':
-            raise Fedora_EC2Error('Volume is already attached')
-        self.conn.attach_volume(vol_id, inst_id, dev)
-        if wait:
-            info = self.wait_vol_attach_status(vol_id, 'attached')
-        else:
-            info = self.vol_info(vol_id)
-        self.logger.info('attached %s to %s' % (vol_id, inst_id))
+        with timeline.span('attach'):
+            check = self.conn.get_all_volumes([vol_id])[0]
+            if check.status == 'in-use':
+                raise Fedora_EC2Error('Volume is already attached')
+            self.conn.attach_volume(vol_id, inst_id, dev)
+            if wait:
+                info = self.wait_vol_attach_status(vol_id, 'attached')
+            else:
+                info = self.vol_info(vol_id)
+        self.logger.info('attached %s to %s', vol_id, inst_id)
         return info
 
     def detach_vol(self, inst_id, vol_id, wait=False):
@@ -377,13 +480,14 @@ class EC2Obj(object):
         True will make the method wait until the volume is detached before
         returning. Returns a dictionary describing the volume, see vol_info().
         """
-        self.conn.detach_volume(vol_id, inst_id)
-        if wait:
-            info = self.wait_vol_attach_status(vol_id, None)
-        else:
-            info = self.vol_info(vol_id)
+        with timeline.span('detach'):
+            self.conn.detach_volume(vol_id, inst_id)
+            if wait:
+                info = self.wait_vol_attach_status(vol_id, None)
+            else:
+                info = self.vol_info(vol_id)
         self._release_dev(inst_id, vol_id)
-        self.logger.info('Detached %s from %s' % (vol_id, inst_id))
+        self.logger.info('Detached %s from %s', vol_id, inst_id)
         return info
 
     def vol_info(self, id):
@@ -417,7 +521,7 @@ class EC2Obj(object):
             info['attach_status'] = str(vol.attach_data.status)
             info['attach_time'] = str(vol.attach_data.attach_time)
 
-        self.logger.debug('Retrieved volume info: %s' % info)
+        self.logger.debug('Retrieved volume info: %s', info)
         return info
 
     def wait_vol_status(self, vol_id, status, tries=0, interval=20):
@@ -441,9 +545,9 @@ class EC2Obj(object):
                 return info
             if vol.update() == 'deleting':
                 raise RuntimeError, '%s is being deleted!' % vol.id
-            self.logger.info('Try #%s: %s not %s, sleeping %s seconds' %
-                (timer, vol_id, status, interval))
-            time.sleep(interval)
+            self.logger.info('Try #%s: %s not %s, sleeping %s seconds',
+                timer, vol_id, status, interval)
+            self._sleep(interval)
             timer += 1
         self._log_error('Timeout exceeded waiting for %s to be %s' %
             (vol_id, status))
@@ -468,26 +572,30 @@ class EC2Obj(object):
             if vol.attachment_state() == status:
                 info = self.vol_info(vol_id)
                 return info
-            self.logger.info('Try #%s: %s not %s, sleeping %s seconds' %
-                (timer, vol_id, print_status, interval))
-            time.sleep(interval)
+            self.logger.info('Try #%s: %s not %s, sleeping %s seconds',
+                timer, vol_id, print_status, interval)
+            self._sleep(interval)
             timer += 1
         self._log_error('Timeout exceeded waiting for %s to be %s' %
             (vol_id, status))
 
-    def take_snap(self, vol_id, wait=False):
+    def take_snap(self, vol_id, wait=False, tags=None):
         """
         Snapshot a detached volume, returns the snapshot ID. If wait is set to
         True, return once the snapshot is created. Returns a dictionary
-        that describes the snapshot.
-        """
-        vol = self.conn.get_all_volumes([vol_id])[0]
-        snap = vol.create_snapshot([vol_id])
-        if wait:
-            info = self.wait_snap_status(snap.id, 'completed')
-        else:
-            info = self.snap_info(snap.id)
-        self.logger.info('snapshot %s taken' % snap.id)
+        that describes the snapshot. tags is a dict of tags to put on the
+        snapshot as soon as it exists.
+        """
+        with timeline.span('snapshot'):
+            vol = self.conn.get_all_volumes([vol_id])[0]
+            snap = vol.create_snapshot([vol_id])
+            if tags:
+                self.add_tags([snap.id], tags)
+            if wait:
+                info = self.wait_snap_status(snap.id, 'completed')
+            else:
+                info = self.snap_info(snap.id)
+        self.logger.info('snapshot %s taken', snap.id)
         return info
 
     def snap_info(self, snap_id):
@@ -502,7 +610,7 @@ class EC2Obj(object):
         snaps = self.conn.get_all_snapshots([snap_id])[0]
         info = snaps.__dict__
 
-        self.logger.debug('Retrieved snapshot info: %s' % info)
+        self.logger.debug('Retrieved snapshot info: %s', info)
         return info
 
     def wait_snap_status(self, snap_id, status, tries=0, interval=20):
@@ -521,28 +629,30 @@ class EC2Obj(object):
             if snap.status == status:
                 info = self.snap_info(snap_id)
                 return info
-            self.logger.info('Try #%s: %s is not %s, sleeping %s seconds' %
-                (timer, snap_id, status, interval))
-            time.sleep(interval)
+            self.logger.info('Try #%s: %s is not %s, sleeping %s seconds',
+                timer, snap_id, status, interval)
+            self._sleep(interval)
             timer += 1
         self._log_error('Timeout exceeded for %s to be %s' % (snap_id, status))
 
     def register_snap(self, snap_id, arch, name, aki=None, desc=None, ari=None,
-                      pub=True, disk=False):
+                      pub=True, disk=False, tags=None, virt=None):
         """
         Register an EBS volume snapshot as an AMI. Returns the AMI ID. An arch,
         snapshot ID, and name for the AMI must be provided. Optionally
         a description, AKI ID, ARI ID and billing code may be specified too.
-        disk is whether or not we are registering a disk image.
+        disk is whether or not we are registering a disk image. tags is a dict
+        of tags to put on the AMI as soon as it exists. virt is the
+        virtualization type, paravirtual or hvm; hvm AMIs need no AKI.
         """
-        self.logger.info('Registering snap: %s' % (snap_id))
+        self.logger.info('Registering snap: %s', snap_id)
         snap = self.conn.get_all_snapshots([snap_id])[0]
         #Makes block device map
         ebs = EBSBlockDeviceType()
         ebs.snapshot_id = snap_id
         block_map = BlockDeviceMapping()
 
-        if aki == None:
+        if aki == None and virt != 'hvm':
             raise Fedora_EC2Error('Need to specify an AKI')
         if disk:
             disk = '/dev/sda=%s' % snap_id
@@ -552,13 +662,21 @@ class EC2Obj(object):
             root = '/dev/sda1'
         block_map[root] = ebs
 
-        ami_id = self.conn.register_image(name=name, description=desc,
-              image_location = '', architecture=arch, kernel_id=aki,
-              ramdisk_id=ari,root_device_name=root, block_device_map=block_map)
+        with timeline.span('register'):
+            extra = {}
+            if virt is not None:
+                # only newer boto knows it
+                extra['virtualization_type'] = virt
+            ami_id = self.conn.register_image(name=name, description=desc,
+                  image_location = '', architecture=arch, kernel_id=aki,
+                  ramdisk_id=ari,root_device_name=root, block_device_map=block_map,
+                  **extra)
+            if tags:
+                self.add_tags([ami_id], tags)
 
         if not ami_id.startswith('ami-'):
             self._log_error('Could not register an AMI')
-        self.logger.info('Registered an AMI: %s' % ami_id)
+        self.logger.info('Registered an AMI: %s', ami_id)
         return ami_id
 
     def delete_snap(self, snap_id):
@@ -567,7 +685,8 @@ class EC2Obj(object):
         Delete an EBS volume snapshot. Returns the ID of the snapshot that was
         deleted.
         """
-        self.logger.info('Deleted a snapshot: %s' % snap_id)
+        self.conn.delete_snapshot(snap_id)
+        self.logger.info('Deleted a snapshot: %s', snap_id)
         return snap_id
 
     def delete_vol(self, vol_id):
@@ -578,7 +697,7 @@ class EC2Obj(object):
         Returns the id of the volume that was deleted.
         """
         self.conn.delete_volume(vol_id)
-        self.logger.info('Deleted a volume: %s' % vol_id)
+        self.logger.info('Deleted a volume: %s', vol_id)
         return vol_id
 
     def kill_inst(self, inst_id, wait=False):
@@ -594,70 +713,173 @@ class EC2Obj(object):
             inst_info = self.wait_inst_status(inst_id, 'terminated')
         else:
             inst_info = self.inst_info(inst_id)
-        self.logger.info('Killed an instance: %s' % inst_id)
+        self.logger.info('Killed an instance: %s', inst_id)
         return inst_info
 
     def make_public(self, ami):
         """
         Make an AMI publicly launchable. Should be used for Hourly images only!
         """
-        self.conn.modify_image_attribute(ami, attribute='launchPermission',
-            operation='add', user_ids=None, groups=['all'])
-        self.logger.info('%s is now public!' % ami)
+        with timeline.span('grant'):
+            self.conn.modify_image_attribute(ami, attribute='launchPermission',
+                operation='add', user_ids=None, groups=['all'])
+        self.logger.info('%s is now public!', ami)
+
+    def grant_access(self, ami, ids=(), groups=(), snaps=(),
+                     operation='add'):
+        """
+        Let the AWS accounts in ids, and the groups in groups ('all' makes it
+        public), launch an AMI, all in one call. The accounts may also create
+        volumes from the snapshots in snaps, one call per snapshot. With
+        operation='remove' the same permissions are taken away instead.
+        """
+        ids = list(ids)
+        groups = list(groups)
+        if not ids and not groups:
+            return
+        with timeline.span('grant'):
+            self.conn.modify_image_attribute(ami,
+                attribute='launchPermission', operation=operation,
+                user_ids=ids or None, groups=groups or None)
+            if ids:
+                for snap in snaps:
+                    self.conn.modify_snapshot_attribute(snap,
+                        attribute='createVolumePermission',
+                        operation=operation, user_ids=ids)
+        self.logger.info('%s launch permission on %s for %s', operation, ami,
+            ', '.join(ids + groups))
+
+    def launch_perms(self, ami):
+        """Return the sets of (account IDs, groups) that may launch an AMI"""
+        attrs = self.conn.get_image_attribute(ami,
+            attribute='launchPermission').attrs
+        return set(attrs.get('user_ids', [])), set(attrs.get('groups', []))
+
+    def add_tags(self, ids, tags):
+        """Tag the given resources (AMIs, snapshots, ...) with a dict of tags"""
+        self.conn.create_tags(ids, tags)
+        self.logger.debug('Tagged %s with %s', ', '.join(ids), tags)
+
+    def iter_insts(self, filters=None, page_size=1000):
+        """
+        Yield an InstRecord for every instance this account owns, asking EC2
+        for page_size of them at a time. filters is passed on to EC2 to only
+        list matching instances.
+        """
+        token = None
+        while True:
+            kwargs = {'filters': filters}
+            if page_size:
+                kwargs.update(max_results=page_size, next_token=token)
+            page = self.conn.get_all_instances(**kwargs)
+            token = getattr(page, 'next_token', None)
+            for res in _drain(page):
+                for inst in res.instances:
+                    yield InstRecord(region=self.region, id=inst.id,
+                        image_id=inst.image_id, state=inst.state,
+                        launch_time=inst.launch_time, key_name=inst.key_name,
+                        instance_type=inst.instance_type,
+                        placement=inst.placement, dns_name=inst.dns_name,
+                        tags=_tags(inst))
+            if not token:
+                return
+
+    def iter_amis(self, filters=None):
+        """
+        Yield an AMIRecord for every AMI this account owns; AKIs and ARIs are
+        left out. filters is passed on to EC2 to only list matching AMIs.
+        Unlike iter_insts this can not page: boto's get_all_images takes no
+        max_results or next_token, so EC2 sends every AMI in one answer.
+        """
+        for image in _drain(self.conn.get_all_images(owners='self',
+                            filters=filters)):
+            if image.id is None or not image.id.startswith('ami-'):
+                continue
+            snaps = []
+            for dev in (image.block_device_mapping or {}).values():
+                if getattr(dev, 'snapshot_id', None):
+                    snaps.append(dev.snapshot_id)
+            yield AMIRecord(region=self.region, id=image.id, name=image.name,
+                architecture=image.architecture,
+                creationDate=getattr(image, 'creationDate', None),
+                state=image.state, kernel_id=image.kernel_id,
+                root_device_name=image.root_device_name, snapshots=snaps,
+                tags=_tags(image))
+
+    def iter_snaps(self, filters=None):
+        """
+        Yield a SnapRecord for every snapshot this account owns. filters is
+        passed on to EC2 to only list matching snapshots. As with iter_amis,
+        boto's get_all_snapshots can not page, so they come in one answer.
+        """
+        for snap in _drain(self.conn.get_all_snapshots(owner='self',
+                           filters=filters)):
+            yield SnapRecord(region=self.region, id=snap.id,
+                volume_id=snap.volume_id,
+                volume_size=getattr(snap, 'volume_size', None),
+                status=snap.status, start_time=snap.start_time,
+                description=snap.description, tags=_tags(snap))
+
+    def iter_vols(self, filters=None):
+        """
+        Yield a VolRecord for every EBS volume this account owns. filters is
+        passed on to EC2 to only list matching volumes.
+        """
+        for vol in _drain(self.conn.get_all_volumes(filters=filters)):
+            attach = getattr(vol, 'attach_data', None)
+            yield VolRecord(region=self.region, id=vol.id, size=vol.size,
+                zone=vol.zone, status=vol.status, create_time=vol.create_time,
+                snapshot_id=vol.snapshot_id,
+                instance=attach and attach.instance_id or None,
+                tags=_tags(vol))
+
+    def get_my_insts(self, filters=None):
+        """Return a list of InstRecords, see iter_insts"""
+        mine = list(self.iter_insts(filters))
+        self.logger.debug('Retrieved %s instance(s)', len(mine))
+        return mine
 
-    def get_my_insts(self):
-        """
-        Return a list of dicts that describe all running instances this account
-        owns. See inst_info for a description of the dict.
-        """
-        mine = []
-        instances = self.conn.get_all_instances()
-        info = {}
-        info2 = {}
-        for inst in instances:
-            data = inst.instances[0]
-            info = inst.__dict__
-            info2 = data.__dict__
-            info.update(info2)
-            mine.append(info)
-            info = {}
-            info2 = {}
-            self.logger.debug('Retrieved instance info: %s' % info)
+    def get_my_amis(self, filters=None):
+        """Return a list of AMIRecords, see iter_amis"""
+        mine = list(self.iter_amis(filters))
+        self.logger.debug('Retrieved %s AMI(s)', len(mine))
         return mine
 
-    def get_my_amis(self):
-        """
-        Return a list of dicts that describe all AMIs this account owns. See
-        ami_info for a description of the dict; there is one difference though.
-        The snapid field may contain a list of snapshots in the blockmapping
-        for an image. It does not take just the first one.
-        """
-        image_list = self.conn.get_all_images(owners='self')
+    def get_my_snaps(self, filters=None):
+        """Return a list of SnapRecords, see iter_snaps"""
+        mine = list(self.iter_snaps(filters))
+        self.logger.debug('Retrieved %s snapshot(s)', len(mine))
+        return mine
 
-        mine = []
-        info = {'snapid': []}
-        for image in image_list:
-            info = image.__dict__
-            if info.get('id') != None and info.get('id').startswith('ami-'):
-                # we don't want AKIs or ARIs
-                mine.append(info.copy())
-                info = {'snapid': []}
-        self.logger.debug(str(mine))
+    def get_my_vols(self, filters=None):
+        """Return a list of VolRecords, see iter_vols"""
+        mine = list(self.iter_vols(filters))
+        self.logger.debug('Retrieved %s volume(s)', len(mine))
         return mine
 
-    def get_my_snaps(self):
+    def find_images(self, ids):
         """
-        Return a list of dicts that describe all snapshots owned by this
-        account. See snap_info for a description of the dict.
+        Return {ID: state} for those of the AMIs, AKIs and ARIs in ids that
+        exist, whoever owns them. One call, however many IDs.
         """
-        all_snaps = self.conn.get_all_snapshots(owner='self')
-        mine = []
-        for snap in all_snaps:
-            info = {}
-            info = snap.__dict__
-            mine.append(info.copy())
-        self.logger.debug('Retrieved my snapshots: %s' % mine)
-        return mine
+        if not ids:
+            return {}
+        images = self.conn.get_all_images(filters={'image-id': list(ids)})
+        return dict([(i.id, i.state) for i in images])
+
+    def find_keypairs(self, names):
+        """Return the set of the SSH key pairs in names that exist"""
+        if not names:
+            return set()
+        return set([k.name for k in self.conn.get_all_key_pairs(
+            filters={'key-name': list(names)})])
+
+    def find_groups(self, names):
+        """Return the set of the security groups in names that exist"""
+        if not names:
+            return set()
+        return set([g.name for g in self.conn.get_all_security_groups(
+            filters={'group-name': list(names)})])
 
     # utility methods
 
@@ -665,23 +887,23 @@ class EC2Obj(object):
         """
         Run a command and collect the output and return value.
         """
-        self.logger.debug('Command: %s' % cmd)
+        self.logger.debug('Command: %s', cmd)
         while retry > -1:
             proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                     stderr=subprocess.STDOUT, shell=True)
             ret = proc.wait()
             output = proc.stdout.read().strip()
-            self.logger.debug('Return code: %s' % ret)
-            self.logger.debug('Output: %s' % output)
+            self.logger.debug('Return code: %s', ret)
+            self.logger.debug('Output: %s', output)
             if ret != 0:
-                self.logger.error('Command had a bad exit code: %s' % ret)
-                self.logger.error('Command run: %s' % cmd)
-                self.logger.error('Output:\n%s' % output)
-                self.logger.info('%s retries left, sleeping...' % retry)
+                self.logger.error('Command had a bad exit code: %s', ret)
+                self.logger.error('Command run: %s', cmd)
+                self.logger.error('Output:\n%s', output)
+                self.logger.info('%s retries left, sleeping...', retry)
                 retry -= 1
                 if retry < 0:
                     raise Fedora_EC2Error('Command failed, see logs for output')
-                time.sleep(10)
+                self._sleep(10)
             else:
                 self.logger.debug('command successful')
                 retry = -1
@@ -693,8 +915,48 @@ class EC2Obj(object):
         self.logger.error(msg)
         raise Fedora_EC2Error(msg)
 
+    def console_output(self, inst_id):
+        """what an instance has written to its console so far, or ''"""
+        return self.conn.get_console_output(inst_id).output or ''
+
+    def wait_boot(self, instance, timeout=600, interval=10, port=22):
+        """
+        Wait until an instance has booted: its sshd answers on port, or its
+        console shows a login prompt or cloud-init finishing. Neither needs
+        a key or an account on the image, and each poll is a single connect
+        and API call. Returns 'ssh' or 'console', whichever showed it first;
+        raises a Fedora_EC2Error if neither did within timeout seconds.
+        """
+        waited = 0
+        with timeline.span('verify'):
+            while True:
+                if self.ssh_banner(instance, port):
+                    return 'ssh'
+                if boot_marker.search(self.console_output(instance['id'])):
+                    return 'console'
+                if waited >= timeout:
+                    break
+                self._sleep(interval)
+                waited += interval
+        self._log_error('%s did not boot within %s seconds' %
+            (instance['id'], timeout))
+
     # SSH-specific methods
 
+    def ssh_banner(self, instance, port=22, timeout=5):
+        """True if an instance answers on port with an SSH banner"""
+        if not instance.get('dns_name'):
+            return False
+        try:
+            conn = socket.create_connection((str(instance['dns_name']), port),
+                timeout)
+            try:
+                return conn.recv(64).startswith('SSH-')
+            finally:
+                conn.close()
+        except (socket.error, socket.timeout):
+            return False
+
     def get_ssh_opts(self, path=None):
         """return ssh options we want to use throughout this script"""
         if path != None:
@@ -709,12 +971,15 @@ class EC2Obj(object):
                    '-o "PreferredAuthentications publickey"'
         return ssh_opts
 
-    def run_ssh(self, instance, cmd, path=None):
-        """ssh to an instance and run a command"""
+    def ssh_cmd(self, instance, cmd, path=None):
+        """return the command line that runs cmd on an instance over ssh"""
         ssh_opts = self.get_ssh_opts(path)
         ssh_host = 'root@%s' % str(instance['dns_name'])
-        return self.run_cmd('ssh %s %s "%s"' % (ssh_opts, ssh_host, cmd),
-            retry=0)
+        return 'ssh %s -C %s "%s"' % (ssh_opts, ssh_host, cmd)
+
+    def run_ssh(self, instance, cmd, path=None):
+        """ssh to an instance and run a command"""
+        return self.run_cmd(self.ssh_cmd(instance, cmd, path), retry=0)
 
     def wait_ssh(self, instance, tries=15, interval=20, path=None):
         """
@@ -726,13 +991,14 @@ class EC2Obj(object):
         if tries == 0:
             forever = True
         timer = 1
-        while timer <= tries or forever:
-            try:
-                return self.run_ssh(instance, 'true', path)
-            except Fedora_EC2Error:
-                self.logger.warning('SSH failed, sleeping for %s seconds' %
-                    interval)
-                time.sleep(interval)
-                timer += 1
+        with timeline.span('ssh_wait'):
+            while timer <= tries or forever:
+                try:
+                    return self.run_ssh(instance, 'true', path)
+                except Fedora_EC2Error:
+                    self.logger.warning('SSH failed, sleeping for %s seconds',
+                        interval)
+                    self._sleep(interval)
+                    timer += 1
         raise Fedora_EC2Error('Could not SSH in after %s tries' % tries)
 
@@ -0,0 +1,237 @@
+#!/usr/bin/python -tt
+# Launch permissions of our AMIs: granted to the configured accounts as each
+# upload finishes, and brought in line with uploader.conf for every AMI in
+# the inventory when the list of accounts changes.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import ConfigParser
+from optparse import OptionParser
+import os
+import Queue
+import sys
+import threading
+
+import fedora_ec2
+import inventory
+import logs
+
+#
+# Constants
+#
+
+mainlog = None
+opts = None
+inv = None
+report = []
+report_lock = threading.Lock()
+
+#
+# Functions
+#
+
+def wanted(ids):
+    """
+    The (account IDs, groups) an ids setting of uploader.conf asks for:
+    "public" is the group all, anything else a comma separated list of
+    account IDs
+    """
+    ids = ids.strip()
+    if ids == '':
+        raise fedora_ec2.Fedora_EC2Error('Insert AWS IDs or "public"')
+    if ids == 'public':
+        return set(), set(['all'])
+    return set([i.strip() for i in ids.split(',') if i.strip()]), set()
+
+def set_perms(ec2, ami, snaps, users, groups, current=None):
+    """
+    Give the accounts in users and the groups in groups launch permission on
+    ami, and the accounts volume permission on the snapshots in snaps, with
+    one modify call for the AMI and one per snapshot. current is the
+    (users, groups) that have permission now; anyone in it we do not want
+    loses it, and it is left out for an AMI that was just registered.
+
+    The outcome is checked with a single read of the AMI's permissions; a
+    Fedora_EC2Error is raised if it is not what we asked for. Returns the
+    (users, groups) added and those removed.
+    """
+    have_users, have_groups = current or (set(), set())
+    added = (users - have_users, groups - have_groups)
+    removed = (have_users - users, have_groups - groups)
+    ec2.grant_access(ami, sorted(added[0]), sorted(added[1]), snaps)
+    ec2.grant_access(ami, sorted(removed[0]), sorted(removed[1]), snaps,
+        operation='remove')
+    got_users, got_groups = ec2.launch_perms(ami)
+    missing = (users - got_users) | (groups - got_groups)
+    extra = set()
+    if current is not None:
+        extra = (got_users - users) | (got_groups - groups)
+    if missing or extra:
+        raise fedora_ec2.Fedora_EC2Error('Launch permission of %s is wrong; '
+            'missing: %s, not wanted: %s' % (ami,
+            ', '.join(sorted(missing)) or 'none',
+            ', '.join(sorted(extra)) or 'none'))
+    return added, removed
+
+def get_options():
+    usage = """
+    Bring the launch permissions of every AMI in the inventory in line with
+    the ids setting of uploader.conf, every configured region at once:
+    accounts (or the group all, for "public") that are missing are added,
+    with volume permission on the AMI's snapshots, and any others are
+    removed. Run inventory.py sync first so the inventory is current.
+
+    Usage: %prog [options]"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--config', help='Add a config file',
+        default=['/etc/uploader.conf'], action='append')
+    parser.add_option('-d', '--dry-run', action='store_true', default=False,
+        help='Only report what would change')
+    parser.add_option('-j', '--jobs', type='int', default=4,
+        help='AMIs handled at once in each region (default: %default)')
+    parser.add_option('-n', '--name', help='Only AMIs with names matching '
+        'this shell-style pattern')
+    parser.add_option('-r', '--region', action='append', default=[],
+        dest='regions', help='Only use a specific region. May be used more '
+        'than once.')
+    global opts
+    opts, args = parser.parse_args()
+    if len(args) != 0:
+        parser.error('No arguments expected')
+    parse_config()
+    return opts
+
+def setup_log():
+    """set up the main logger"""
+    global mainlog
+    logname = 'grants'
+    mainlog = logs.get_logger(logname, os.path.join(get_opt('logdir'),
+        logname + '.log'), debug=get_opt('debug') == 'True',
+        quiet=get_opt('quiet') == 'True')
+
+def parse_config():
+    config = ConfigParser.ConfigParser()
+    success = config.read(opts.config)
+    if len(success) == 0:
+        raise fedora_ec2.Fedora_EC2Error('Could not parse a config file!')
+    if len(opts.regions) == 0:
+        opts.regions = config.sections()
+    opts.config = config
+
+def get_opt(name, region='DEFAULT'):
+    """
+    Return a region specific option, if it is defined, otherwise take the
+    default.
+    """
+    try:
+        return opts.config.get(region, name)
+    except ConfigParser.NoOptionError:
+        try:
+            return opts.config.get('DEFAULT', name)
+        except ConfigParser.NoOptionError:
+            raise fedora_ec2.Fedora_EC2Error('No option defined: %s' % name)
+
+def sync_region(region):
+    """Bring the launch permissions of a region's AMIs in line"""
+    ec2 = fedora_ec2.EC2Obj(region=region, debug=get_opt('debug'),
+        logfile=os.path.join(get_opt('logdir'), 'grants-%s.log' % region),
+        quiet=get_opt('quiet'))
+    users, groups = wanted(get_opt('ids', region))
+    work = Queue.Queue()
+    # AMIs of unfinished uploads, e.g. ones that failed to boot, are left
+    # alone until the sweeper takes them down
+    for ami in inv.amis(region=region, name=opts.name, state='available',
+                        complete=1):
+        work.put(ami)
+
+    def worker():
+        while True:
+            try:
+                ami = work.get_nowait()
+            except Queue.Empty:
+                return
+            snaps = [s for s in (ami['snapshots'] or '').split(',') if s]
+            try:
+                current = ec2.launch_perms(ami['id'])
+                if current == (users, groups):
+                    add_report(region, ami, None, None, False)
+                elif opts.dry_run:
+                    add_report(region, ami, (users - current[0],
+                        groups - current[1]), (current[0] - users,
+                        current[1] - groups), False)
+                else:
+                    added, removed = set_perms(ec2, ami['id'], snaps, users,
+                        groups, current)
+                    add_report(region, ami, added, removed, False)
+            except Exception as e:
+                mainlog.error('[%s] could not sync %s: %s', region,
+                    ami['id'], e)
+                add_report(region, ami, None, None, True)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(opts.jobs, work.qsize()))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def sync_thread(region):
+    """thread body for sync_region; one region failing must not stop the rest"""
+    logs.tag(region)
+    try:
+        sync_region(region)
+    except Exception:
+        mainlog.exception('[%s] grant sync failed', region)
+        add_report(region, None, None, None, True)
+
+def add_report(region, ami, added, removed, failed):
+    report_lock.acquire()
+    report.append((region, ami, added, removed, failed))
+    report_lock.release()
+
+def changes(added, removed):
+    """+ and - list of what a sync changed on an AMI"""
+    return ' '.join(['+%s' % p for p in sorted(added[0] | added[1])] +
+                    ['-%s' % p for p in sorted(removed[0] | removed[1])])
+
+if __name__ == '__main__':
+    opts = get_options()
+    setup_log()
+    inv = inventory.Inventory(get_opt('inventory'), logger=mainlog)
+
+    threads = []
+    for region in opts.regions:
+        mainlog.info('spawning thread for %s', region)
+        threads.append(threading.Thread(target=sync_thread, args=(region,),
+            name=region))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    inv.close()
+
+    if opts.dry_run:
+        print 'Would change:'
+    else:
+        print 'Changed:'
+    failed = False
+    unchanged = 0
+    for region, ami, added, removed, ami_failed in sorted(report,
+            key=lambda r: (r[0], r[1] and r[1]['id'])):
+        if ami_failed:
+            failed = True
+            if ami is None:
+                print '  %-15s FAILED, see the logs' % region
+            else:
+                print '  %-15s %-14s FAILED, see the logs' % (region,
+                    ami['id'])
+        elif added is None:
+            unchanged += 1
+        else:
+            print '  %-15s %-14s %s' % (region, ami['id'],
+                changes(added, removed))
+    print '%s AMI(s) already right' % unchanged
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,459 @@
+#!/usr/bin/python -tt
+# A local, indexed inventory of our AMIs, snapshots and instances in every
+# region, so "what do we have where" does not mean listing everything again.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import calendar
+import ConfigParser
+import logging
+from optparse import OptionParser
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import fedora_ec2
+import logs
+
+#
+# Constants
+#
+
+mainlog = None
+opts = None
+
+# kinds of resources kept, and what they are listed with
+kinds = ('amis', 'snaps', 'insts')
+
+schema = """
+create table if not exists amis (
+    region text not null,
+    id text not null,
+    name text,
+    plat text,
+    platver text,
+    prod text,
+    prodver text,
+    arch text,
+    build integer,
+    digest text,
+    created text,
+    state text,
+    snapshots text,
+    complete integer,
+    primary key (region, id)
+);
+create index if not exists amis_name on amis (name);
+create index if not exists amis_spin on amis (plat, platver, prod, arch);
+create index if not exists amis_digest on amis (digest);
+create index if not exists amis_created on amis (created);
+
+create table if not exists snaps (
+    region text not null,
+    id text not null,
+    volume_id text,
+    size integer,
+    status text,
+    created text,
+    digest text,
+    description text,
+    primary key (region, id)
+);
+create index if not exists snaps_digest on snaps (digest);
+create index if not exists snaps_created on snaps (created);
+create index if not exists snaps_status on snaps (status);
+
+create table if not exists insts (
+    region text not null,
+    id text not null,
+    image_id text,
+    state text,
+    created text,
+    key_name text,
+    primary key (region, id)
+);
+create index if not exists insts_created on insts (created);
+create index if not exists insts_state on insts (state);
+
+create table if not exists sync (
+    region text not null,
+    kind text not null,
+    watermark text,
+    synced real,
+    primary key (region, kind)
+);
+"""
+
+#
+# Classes
+#
+
+class Inventory(object):
+    """
+    AMIs, snapshots and instances of all regions in a SQLite database.
+    sync() refreshes it from EC2, every region at once; the query methods
+    only look at the database.
+
+    EC2 can not list images by creation time, but we own few enough of them
+    that every sync lists all of ours, which also notices de-registered
+    ones. Snapshots and instances are many, so only those created since the
+    last sync (the watermark) are listed, using day wildcards on start-time
+    and launch-time, along with the ones that were still pending or running
+    last time. A region whose watermark is older than max_days, or a sync
+    with full=True, lists everything again; that is also how snapshots
+    deleted behind our back eventually drop out.
+    """
+    max_days = 31
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger('inventory')
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+        # inventories from before AMIs had a complete column; the next sync
+        # fills it in, as it lists every AMI
+        cols = [r['name'] for r in self.db.execute('pragma table_info(amis)')]
+        if 'complete' not in cols:
+            self.db.execute('alter table amis add column complete integer')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # syncing
+
+    def sync(self, ec2s, full=False):
+        """
+        Refresh the inventory from a list of EC2Objs, one per region, all at
+        once. Returns a dict of region to the exception that made its sync
+        fail; the other regions are still stored.
+        """
+        fetched = {}
+        failed = {}
+
+        def fetch(ec2):
+            try:
+                fetched[ec2.region] = self._fetch(ec2, full)
+            except Exception as e:
+                self.logger.exception('[%s] inventory sync failed',
+                    ec2.region)
+                failed[ec2.region] = e
+
+        threads = [threading.Thread(target=fetch, args=(ec2,),
+                   name=ec2.region) for ec2 in ec2s]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # all writes happen here, one transaction per region
+        for region, found in fetched.items():
+            self._store(region, found)
+        return failed
+
+    def _fetch(self, ec2, full):
+        """list what changed in a region since the last sync"""
+        found = {'amis': (True, [_ami_row(a) for a in ec2.iter_amis()])}
+        for kind, lister, key, stale in (
+                ('snaps', ec2.iter_snaps, 'start-time', "status = 'pending'"),
+                ('insts', ec2.iter_insts, 'launch-time',
+                 "state not in ('terminated', 'shutting-down')")):
+            days = None
+            if not full:
+                days = self._days_since(ec2.region, kind)
+            if days is None:
+                rows = [_row(kind, r) for r in lister()]
+                found[kind] = (True, rows)
+                self.logger.info('[%s] listed all %s %s',
+                    ec2.region, len(rows), kind)
+                continue
+            rows = [_row(kind, r) for r in lister({key: days})]
+            # unfinished ones may have moved on or gone; ask about them again
+            ids = self._ids(kind, ec2.region, stale)
+            known = set([r['id'] for r in rows])
+            if ids:
+                id_key = {'snaps': 'snapshot-id', 'insts': 'instance-id'}[kind]
+                again = [_row(kind, r) for r in lister({id_key: ids})]
+                rows.extend([r for r in again if r['id'] not in known])
+                gone = set(ids) - set([r['id'] for r in again])
+            else:
+                gone = set()
+            found[kind] = (False, rows, gone)
+            self.logger.info('[%s] %s %s new or changed, %s gone',
+                ec2.region, len(rows), kind, len(gone))
+        return found
+
+    def _days_since(self, region, kind):
+        """
+        day wildcards covering the watermark's day up to today, or None if
+        there is no usable watermark and everything must be listed
+        """
+        rows = self._query('select watermark from sync where region = ? '
+            'and kind = ?', (region, kind))
+        if not rows or not rows[0]['watermark']:
+            return None
+        # not strptime, which is not safe to first call from threads
+        year, month, day = rows[0]['watermark'][:10].split('-')
+        start = calendar.timegm((int(year), int(month), int(day), 0, 0, 0))
+        days = []
+        day = start
+        while day <= max(time.time(), start):
+            days.append(time.strftime('%Y-%m-%d*', time.gmtime(day)))
+            day += 86400
+        if len(days) > self.max_days:
+            return None
+        return days
+
+    def _ids(self, kind, region, where):
+        return [r['id'] for r in self._query('select id from %s where '
+            'region = ? and %s' % (kind, where), (region,))]
+
+    def _query(self, sql, args=()):
+        """run a select; the connection is shared by the sync threads"""
+        self.lock.acquire()
+        try:
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    def _store(self, region, found):
+        """write what _fetch found for a region and move its watermarks on"""
+        self.lock.acquire()
+        try:
+            with self.db:
+                for kind in kinds:
+                    result = found[kind]
+                    complete, rows = result[0], result[1]
+                    if complete:
+                        self.db.execute('delete from %s where region = ?' %
+                            kind, (region,))
+                    else:
+                        self.db.executemany('delete from %s where region = ? '
+                            'and id = ?' % kind, [(region, i)
+                            for i in result[2]])
+                    self._insert(kind, region, rows)
+                    old = self.db.execute('select watermark from sync where '
+                        'region = ? and kind = ?', (region, kind)).fetchone()
+                    marks = [r['created'] for r in rows if r['created']]
+                    if old is not None and old['watermark'] and not complete:
+                        marks.append(old['watermark'])
+                    self.db.execute('insert or replace into sync (region, '
+                        'kind, watermark, synced) values (?, ?, ?, ?)',
+                        (region, kind, marks and max(marks) or None,
+                        time.time()))
+        finally:
+            self.lock.release()
+
+    def _insert(self, kind, region, rows):
+        if not rows:
+            return
+        cols = sorted(rows[0])
+        self.db.executemany('insert or replace into %s (region, %s) values '
+            '(?, %s)' % (kind, ', '.join(cols), ', '.join(['?'] * len(cols))),
+            [[region] + [r[c] for c in cols] for r in rows])
+
+    def forget(self, kind, region, ids):
+        """drop resources we just deleted ourselves, without a sync"""
+        self.lock.acquire()
+        try:
+            with self.db:
+                self.db.executemany('delete from %s where region = ? and '
+                    'id = ?' % kind, [(region, i) for i in ids])
+        finally:
+            self.lock.release()
+
+    # queries
+
+    def _select(self, kind, where, order):
+        clauses = []
+        args = []
+        for col, value in where:
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                clauses.append('%s in (%s)' % (col, ', '.join(['?'] *
+                    len(value))))
+                args.extend(value)
+            elif col == 'name' and ('*' in value or '?' in value):
+                clauses.append('name glob ?')
+                args.append(value)
+            else:
+                clauses.append('%s = ?' % col)
+                args.append(value)
+        sql = 'select * from %s' % kind
+        if clauses:
+            sql += ' where ' + ' and '.join(clauses)
+        return [dict(r) for r in self._query(sql + ' order by ' + order,
+            args)]
+
+    def amis(self, region=None, name=None, plat=None, platver=None, prod=None,
+             arch=None, digest=None, state=None, complete=None):
+        """
+        AMIs matching all the given fields, oldest first. name may use shell
+        wildcards; region may be a list. complete=1 leaves out AMIs of
+        uploads that never finished, such as those that failed to boot.
+        """
+        return self._select('amis', (('region', region), ('name', name),
+            ('plat', plat), ('platver', platver), ('prod', prod),
+            ('arch', arch), ('digest', digest), ('state', state),
+            ('complete', complete)), 'created, build, name')
+
+    def snaps(self, region=None, digest=None, status=None, volume_id=None):
+        """snapshots matching all the given fields, oldest first"""
+        return self._select('snaps', (('region', region), ('digest', digest),
+            ('status', status), ('volume_id', volume_id)), 'created, id')
+
+    def insts(self, region=None, image_id=None, state=None):
+        """instances matching all the given fields, oldest first"""
+        return self._select('insts', (('region', region),
+            ('image_id', image_id), ('state', state)), 'created, id')
+
+    def synced(self):
+        """dict of (region, kind) to the time it was last synced"""
+        return dict([((r['region'], r['kind']), r['synced'])
+            for r in self._query('select * from sync')])
+
+#
+# Functions
+#
+
+def _tag(res, key):
+    return (res.get('tags') or {}).get(key)
+
+def _ami_row(ami):
+    """
+    the amis row for an AMIRecord; AMIs without a run tag were not made by
+    uploader.py, or before it tagged them, and count as complete
+    """
+    m = fedora_ec2.parse_ami_name(ami.get('name') or '')
+    fields = {}
+    if m:
+        fields = m.groupdict()
+    return {'id': ami['id'], 'name': ami.get('name'),
+        'plat': fields.get('plat'), 'platver': fields.get('platver'),
+        'prod': fields.get('prod'), 'prodver': fields.get('prodver'),
+        'arch': fields.get('arch') or ami.get('architecture'),
+        'build': fields.get('i') and int(fields['i']),
+        'digest': _tag(ami, 'sha256'), 'created': ami.get('creationDate'),
+        'state': ami.get('state'), 'snapshots': ','.join(ami['snapshots']),
+        'complete': int(not _tag(ami, fedora_ec2.run_tag) or
+                        _tag(ami, fedora_ec2.complete_tag) == 'True')}
+
+def _snap_row(snap):
+    """the snaps row for a SnapRecord"""
+    return {'id': snap['id'], 'volume_id': snap.get('volume_id'),
+        'size': snap.get('volume_size'), 'status': snap.get('status'),
+        'created': snap.get('start_time'), 'digest': _tag(snap, 'sha256'),
+        'description': snap.get('description')}
+
+def _inst_row(inst):
+    """the insts row for an InstRecord"""
+    return {'id': inst['id'], 'image_id': inst.get('image_id'),
+        'state': inst.get('state'), 'created': inst.get('launch_time'),
+        'key_name': inst.get('key_name')}
+
+def _row(kind, res):
+    return {'snaps': _snap_row, 'insts': _inst_row}[kind](res)
+
+def get_options():
+    usage = """
+    Keep a local inventory of the AMIs, snapshots and instances we own in
+    every configured region. "sync" refreshes it from EC2, all regions at
+    once and only asking for what changed unless --full is given; "amis",
+    "snaps" and "insts" list what it holds without touching EC2.
+
+    Usage: %prog [options] sync|amis|snaps|insts"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--config', help='Add a config file',
+        default=['/etc/uploader.conf'], action='append')
+    parser.add_option('-d', '--digest', help='Only list this image digest')
+    parser.add_option('-f', '--full', action='store_true', default=False,
+        help='List everything again instead of just what changed')
+    parser.add_option('-n', '--name', help='Only list AMIs with names '
+        'matching this shell-style pattern')
+    parser.add_option('-r', '--region', action='append', default=[],
+        dest='regions', help='Only use a specific region. May be used more '
+        'than once.')
+    global opts
+    opts, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ('sync',) + kinds:
+        parser.error('Give one of sync, amis, snaps or insts')
+    opts.command = args[0]
+    parse_config()
+    return opts
+
+def setup_log():
+    """set up the main logger"""
+    global mainlog
+    logname = 'inventory'
+    mainlog = logs.get_logger(logname, os.path.join(get_opt('logdir'),
+        logname + '.log'), debug=get_opt('debug') == 'True',
+        quiet=get_opt('quiet') == 'True')
+
+def parse_config():
+    config = ConfigParser.ConfigParser()
+    success = config.read(opts.config)
+    if len(success) == 0:
+        raise fedora_ec2.Fedora_EC2Error('Could not parse a config file!')
+    if len(opts.regions) == 0:
+        opts.regions = config.sections()
+    opts.config = config
+
+def get_opt(name, region='DEFAULT'):
+    """
+    Return a region specific option, if it is defined, otherwise take the
+    default.
+    """
+    try:
+        return opts.config.get(region, name)
+    except ConfigParser.NoOptionError:
+        try:
+            return opts.config.get('DEFAULT', name)
+        except ConfigParser.NoOptionError:
+            raise fedora_ec2.Fedora_EC2Error('No option defined: %s' % name)
+
+if __name__ == '__main__':
+    opts = get_options()
+    setup_log()
+    inv = Inventory(get_opt('inventory'), logger=mainlog)
+
+    if opts.command == 'sync':
+        ec2s = [fedora_ec2.EC2Obj(region=region, debug=get_opt('debug'),
+            logfile=os.path.join(get_opt('logdir'), 'inventory-%s.log' %
+            region), quiet=get_opt('quiet')) for region in opts.regions]
+        start = time.time()
+        failed = inv.sync(ec2s, full=opts.full)
+        mainlog.info('synced %s region(s) in %.1f seconds',
+            len(ec2s) - len(failed), time.time() - start)
+        for region, e in sorted(failed.items()):
+            print '%-15s FAILED: %s' % (region, e)
+        inv.close()
+        if failed:
+            sys.exit(1)
+        sys.exit(0)
+
+    if opts.command == 'amis':
+        rows = inv.amis(region=opts.regions, name=opts.name,
+            digest=opts.digest)
+        for r in rows:
+            print '%-15s %-14s %-24s %-10s %s' % (r['region'], r['id'],
+                r['created'], r['state'], r['name'])
+    elif opts.command == 'snaps':
+        rows = inv.snaps(region=opts.regions, digest=opts.digest)
+        for r in rows:
+            print '%-15s %-14s %-24s %-10s %s' % (r['region'], r['id'],
+                r['created'], r['status'], r['description'] or '')
+    else:
+        rows = inv.insts(region=opts.regions)
+        for r in rows:
+            print '%-15s %-12s %-24s %-13s %s' % (r['region'], r['id'],
+                r['created'], r['state'], r['image_id'])
+    inv.close()
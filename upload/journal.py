@@ -0,0 +1,115 @@
+#!/usr/bin/python -tt
+# Per-run journal of how far each region of an upload got, so a killed
+# upload can be picked up where it stopped.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import json
+import os
+import re
+import threading
+
+import fedora_ec2
+
+# the stages of a region in the order they complete
+stages = ('booted', 'volume', 'attached', 'transferring', 'transferred',
+          'detached', 'snapshotted', 'registered', 'verified', 'granted',
+          'done')
+# run IDs as UploadJob makes them: start time and a bit of a uuid
+run_id_pattern = re.compile(r'\d{8}T\d{6}-[0-9a-f]{8}$')
+
+#
+# Classes
+#
+
+class Journal(object):
+    """
+    The state of every region of one run, kept in <directory>/<run ID>.json.
+    job holds what is needed to rebuild the upload job (image, name, size,
+    ...). Each region maps to a dict with the last stage it completed and the
+    IDs of what it made on the way (instance, volume, device, offset,
+    snapshot, ami, sha256).
+
+    Every record() rewrites the file through a temporary file, fsync and
+    rename, so a crash leaves either the old or the new journal, never half
+    of one.
+    """
+
+    def __init__(self, directory, run_id, job=None, regions=None):
+        self.path = os.path.join(directory, '%s.json' % run_id)
+        self.run_id = run_id
+        self.job = job or {}
+        self.regions = regions or {}
+        self.lock = threading.Lock()
+
+    def state(self, region):
+        """a copy of what is known about a region"""
+        self.lock.acquire()
+        try:
+            return dict(self.regions.get(region, {}))
+        finally:
+            self.lock.release()
+
+    def record(self, region, stage, **fields):
+        """note that region completed stage, with the IDs it produced"""
+        self.lock.acquire()
+        try:
+            state = self.regions.setdefault(region, {})
+            state.update(fields)
+            state['stage'] = stage
+            self._save()
+        finally:
+            self.lock.release()
+
+    def reset(self, region):
+        """forget a region's progress, so it starts over"""
+        self.lock.acquire()
+        try:
+            self.regions.pop(region, None)
+            self._save()
+        finally:
+            self.lock.release()
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp = '%s.tmp' % self.path
+        f = open(tmp, 'w')
+        try:
+            json.dump({'run_id': self.run_id, 'job': self.job,
+                'regions': self.regions}, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+#
+# Functions
+#
+
+def reached(state, stage):
+    """True if a region's state says it got through stage"""
+    if 'stage' not in state:
+        return False
+    return stages.index(state['stage']) >= stages.index(stage)
+
+def load(directory, run_id):
+    """Return the Journal of an earlier run"""
+    if not isinstance(run_id, basestring) or not run_id_pattern.match(run_id):
+        raise fedora_ec2.Fedora_EC2Error('%r is not a run ID' % (run_id,))
+    path = os.path.join(directory, '%s.json' % run_id)
+    try:
+        f = open(path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError) as e:
+        raise fedora_ec2.Fedora_EC2Error('Could not read the journal of run '
+            '%s: %s' % (run_id, e))
+    return Journal(directory, run_id, job=data['job'],
+        regions=data['regions'])
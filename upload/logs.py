@@ -0,0 +1,139 @@
+#!/usr/bin/python -tt
+# Logging shared by the uploader, EC2Obj and the takedown scripts. Loggers
+# only queue their records; one thread writes them all out.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import atexit
+import logging
+import logging.handlers
+import os
+import Queue
+import sys
+import threading
+
+format = '[%(asctime)s %(name)s %(levelname)s %(region)s %(run_id)s]: ' \
+         '%(message)s'
+
+_formatter = logging.Formatter(format)
+_queue = Queue.Queue()
+# logger name -> the handlers the writer thread passes its records to
+_targets = {}
+_lock = threading.Lock()
+_writer = None
+# region and run ID of the calling thread; see tag()
+_local = threading.local()
+
+#
+# Classes
+#
+
+class ContextFilter(logging.Filter):
+    """tag each record with the region and run ID of the thread logging it"""
+
+    def filter(self, record):
+        record.region = getattr(_local, 'region', None) or '-'
+        record.run_id = getattr(_local, 'run_id', None) or '-'
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hand records to the writer thread instead of writing them here. Loggers
+    are meant to be called with arguments rather than preformatted messages,
+    so nothing is formatted for a record below the logger's level. Records
+    that pass are formatted before they are queued, as their arguments may
+    change once the caller goes on.
+    """
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = _formatter.formatException(record.exc_info)
+                record.exc_info = None
+            _queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+_handler = QueueHandler()
+_handler.addFilter(ContextFilter())
+
+#
+# Functions
+#
+
+def _write():
+    while True:
+        record = _queue.get()
+        if record is None:
+            return
+        for handler in _targets.get(record.name, ()):
+            try:
+                handler.handle(record)
+            except Exception:
+                handler.handleError(record)
+
+def _start():
+    global _writer
+    if _writer is not None:
+        return
+    _writer = threading.Thread(target=_write, name='log-writer')
+    _writer.daemon = True
+    _writer.start()
+    atexit.register(stop)
+
+def stop():
+    """write out whatever is still queued and stop the writer thread"""
+    global _writer
+    _lock.acquire()
+    try:
+        if _writer is None:
+            return
+        _queue.put(None)
+        _writer.join()
+        _writer = None
+    finally:
+        _lock.release()
+
+def get_logger(name, logfile, debug=False, quiet=True):
+    """
+    Return the logger called name, writing to logfile and, unless quiet, to
+    stdout. Log files are appended to, never removed, and reopened when
+    logrotate moves them. Asking for a logger set up earlier hands it back
+    with only its level changed, so EC2Objs made again for the same region
+    do not add handlers.
+    """
+    logger = logging.getLogger(name)
+    _lock.acquire()
+    try:
+        if name not in _targets:
+            logdir = os.path.dirname(logfile)
+            if logdir != '' and not os.path.exists(logdir):
+                os.makedirs(logdir)
+            handlers = [logging.handlers.WatchedFileHandler(logfile)]
+            if not quiet:
+                handlers.append(logging.StreamHandler(sys.stdout))
+            for handler in handlers:
+                handler.setFormatter(_formatter)
+            _targets[name] = handlers
+            logger.addHandler(_handler)
+            _start()
+    finally:
+        _lock.release()
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+    return logger
+
+def tag(region=None, run_id=None):
+    """
+    Tag what the calling thread logs from now on with region and run ID;
+    call with neither to stop
+    """
+    _local.region = region
+    _local.run_id = run_id
@@ -0,0 +1,202 @@
+#!/usr/bin/python -tt
+# EC2 API call metrics: latency histograms and counters per action and region.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import os
+import threading
+import time
+
+import timeline
+
+# upper bounds in seconds of the latency histogram buckets
+buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+# EC2 error codes that mean we are being rate limited
+throttle_codes = ('RequestLimitExceeded', 'Throttling')
+
+#
+# Classes
+#
+
+class Registry(object):
+    """
+    Call statistics keyed by (action, region). For each key we keep the
+    number of calls, errors and throttled calls, the total latency, and a
+    count per latency bucket.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def observe(self, action, region, seconds, error=None):
+        """record one call of action in region that took seconds"""
+        self.lock.acquire()
+        try:
+            st = self.stats.get((action, region))
+            if st is None:
+                st = {'calls': 0, 'errors': 0, 'throttles': 0, 'sum': 0.0,
+                      'buckets': [0] * len(buckets)}
+                self.stats[(action, region)] = st
+            st['calls'] += 1
+            st['sum'] += seconds
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    st['buckets'][i] += 1
+                    break
+            if error is not None:
+                st['errors'] += 1
+                if getattr(error, 'error_code', None) in throttle_codes:
+                    st['throttles'] += 1
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """return a copy of the statistics that is safe to read"""
+        self.lock.acquire()
+        try:
+            return dict([(k, dict(v, buckets=list(v['buckets'])))
+                         for k, v in self.stats.items()])
+        finally:
+            self.lock.release()
+
+    def prometheus(self):
+        """Return the statistics in the Prometheus text exposition format"""
+        stats = self.snapshot()
+        keys = sorted(stats)
+        lines = [
+            '# HELP ec2_api_call_seconds Latency of EC2 API calls.',
+            '# TYPE ec2_api_call_seconds histogram']
+        for action, region in keys:
+            st = stats[(action, region)]
+            labels = 'action="%s",region="%s"' % (action, region)
+            total = 0
+            for bound, n in zip(buckets, st['buckets']):
+                total += n
+                if bound == float('inf'):
+                    le = '+Inf'
+                else:
+                    le = repr(bound)
+                lines.append('ec2_api_call_seconds_bucket{%s,le="%s"} %d' %
+                    (labels, le, total))
+            lines.append('ec2_api_call_seconds_sum{%s} %f' % (labels, st['sum']))
+            lines.append('ec2_api_call_seconds_count{%s} %d' %
+                (labels, st['calls']))
+        for name, field, desc in (
+                ('ec2_api_errors_total', 'errors', 'EC2 API calls that failed.'),
+                ('ec2_api_throttles_total', 'throttles',
+                 'EC2 API calls refused for exceeding the request limit.')):
+            lines.append('# HELP %s %s' % (name, desc))
+            lines.append('# TYPE %s counter' % name)
+            for action, region in keys:
+                lines.append('%s{action="%s",region="%s"} %d' %
+                    (name, action, region, stats[(action, region)][field]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """write the Prometheus text to path, replacing it atomically"""
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            f.write(self.prometheus())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def summary(self):
+        """
+        Return a text table of the calls made, busiest first, with the mean
+        and an estimated 95th percentile latency.
+        """
+        stats = self.snapshot()
+        lines = [['action', 'region', 'calls', 'errors', 'throttled',
+                  'mean', 'p95']]
+        for (action, region), st in sorted(stats.items(),
+                key=lambda kv: -kv[1]['calls']):
+            lines.append([action, region, str(st['calls']), str(st['errors']),
+                str(st['throttles']), '%.3f' % (st['sum'] / st['calls']),
+                percentile(st, 0.95)])
+        widths = [max([len(l[i]) for l in lines]) for i in range(len(lines[0]))]
+        return '\n'.join(['  '.join([c.rjust(w) for c, w in zip(l, widths)])
+                          for l in lines])
+
+
+class InstrumentedConnection(timeline.TracedConnection):
+    """
+    A TracedConnection that also times every call into a Registry, labelled
+    with the API method called and the region of the connection.
+    """
+
+    def __init__(self, conn, region, registry=None):
+        timeline.TracedConnection.__init__(self, conn)
+        self._region = region
+        self._registry = registry or default_registry
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            timeline.count_call()
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._registry.observe(name, self._region,
+                    time.time() - start, e)
+                raise
+            self._registry.observe(name, self._region, time.time() - start)
+            return self._rebind(result)
+        return call
+
+
+class MetricsWriter(object):
+    """Rewrite the Prometheus text file every interval seconds"""
+
+    def __init__(self, path, interval=15, registry=None, logger=None):
+        self.path = path
+        self.interval = interval
+        self.registry = registry or default_registry
+        self.logger = logger
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                self.registry.write_prometheus(self.path)
+            except (IOError, OSError) as e:
+                if self.logger is not None:
+                    self.logger.error('Could not write metrics to %s: %s',
+                        self.path, e)
+            if self._stop.is_set():
+                return
+            self._stop.wait(self.interval)
+
+#
+# Functions
+#
+
+def percentile(st, q):
+    """estimate a latency percentile from the histogram buckets"""
+    want = q * st['calls']
+    seen = 0
+    for bound, n in zip(buckets, st['buckets']):
+        seen += n
+        if seen >= want:
+            if bound == float('inf'):
+                return '>%s' % buckets[-2]
+            return '<=%s' % bound
+    return '-'
+
+# shared by every EC2Obj in the process
+default_registry = Registry()
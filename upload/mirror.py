@@ -0,0 +1,261 @@
+#!/usr/bin/python -tt
+# Put finished images on the mirror, with a CHECKSUM manifest, copying them
+# as cheaply as the filesystems involved allow.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+
+import analysis
+from reader import ImageReader
+
+# the manifest in each mirror directory, in the format of Fedora's
+manifest_name = 'CHECKSUM'
+manifest_line = re.compile(r'^SHA256 \((.+)\) = ([0-9a-f]{64})$')
+
+# ioctl cloning a whole file on btrfs, XFS and friends (linux/fs.h)
+FICLONE = 0x40049409
+
+# bytes handed to each copy_file_range() call, and read and written at a
+# time when we have to copy ourselves
+copy_size = 1073741824
+block = 16777216
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+        use_errno=True)
+    _copy_file_range = _libc.copy_file_range
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+except (OSError, AttributeError):
+    # glibc older than 2.27; we copy ourselves
+    _copy_file_range = None
+
+# errors meaning a way of copying does not work between these two files,
+# rather than that something is wrong with them
+_unsupported = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EBADF)
+
+#
+# Functions
+#
+
+def clone(src, dst):
+    """make dst share src's blocks; False if the filesystem can not"""
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except IOError as e:
+        if e.errno in _unsupported:
+            return False
+        raise
+    return True
+
+def copy_range(src, dst, size):
+    """
+    Copy size bytes from src to dst inside the kernel, which may also let
+    the filesystem or NFS server copy them without moving any data. False if
+    it can not be done between these files and nothing was copied.
+    """
+    if _copy_file_range is None:
+        return False
+    done = 0
+    while done < size:
+        n = _copy_file_range(src.fileno(), None, dst.fileno(), None,
+            min(copy_size, size - done), 0)
+        if n < 0:
+            e = ctypes.get_errno()
+            if done == 0 and e in _unsupported:
+                return False
+            raise OSError(e, os.strerror(e))
+        if n == 0:
+            break
+        done += n
+    if done != size:
+        raise IOError('%s shrank while it was copied' % src.name)
+    return True
+
+def copy_hashing(path, dst):
+    """copy path to dst ourselves, hashing it on the way; returns the digest"""
+    h = hashlib.sha256()
+    f = ImageReader(path, block=block)
+    try:
+        while True:
+            buf = f.read()
+            if not len(buf):
+                break
+            h.update(buf)
+            while len(buf):
+                buf = buf[os.write(dst.fileno(), buf):]
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def publish_file(path, directory, move=True, logger=None, analysis_dir=None,
+                 chunk=analysis.default_chunk):
+    """
+    Put the file at path into directory under the same name, moving it if
+    move, and return (its SHA-256, how it got there). The new file only
+    appears once it is complete and on disk. analysis_dir and chunk are
+    those of uploader.conf, so the uploader's sidecar is found.
+
+    On the same filesystem the file is renamed, or hard linked when not
+    moving. Otherwise it is cloned (reflink) if the filesystems share
+    storage, or else copied inside the kernel with copy_file_range(). The
+    digest comes from the image's analysis sidecar. Without one, a file
+    that has to be copied is copied here and hashed in the same pass, so it
+    is only ever read once; one that is renamed or cloned is analyzed.
+    """
+    logger = logger or logging.getLogger('upload')
+    name = os.path.basename(path)
+    dst = os.path.join(directory, name)
+    known = analysis.cached(path, analysis_dir, chunk)
+    if os.stat(path).st_dev == os.stat(directory).st_dev:
+        digest = (known or analysis.analyze(path, analysis_dir, chunk,
+            logger)).digest
+        if move:
+            os.rename(path, dst)
+            how = 'rename'
+        else:
+            tmp = os.path.join(directory, '.%s.%s.tmp' % (name, os.getpid()))
+            os.link(path, tmp)
+            os.rename(tmp, dst)
+            how = 'link'
+        fsync_dir(directory)
+        return digest, how
+    tmp = os.path.join(directory, '.%s.%s.tmp' % (name, os.getpid()))
+    src = open(path, 'rb')
+    out = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                            0644), 'wb')
+    try:
+        try:
+            size = os.fstat(src.fileno()).st_size
+            if clone(src, out):
+                how = 'reflink'
+                known = known or analysis.analyze(path, analysis_dir, chunk,
+                    logger)
+                digest = known.digest
+            elif known is not None and copy_range(src, out, size):
+                how = 'copy_file_range'
+                digest = known.digest
+            else:
+                how = 'copy'
+                digest = copy_hashing(path, out)
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+            src.close()
+        shutil.copystat(path, tmp)
+        os.rename(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    fsync_dir(directory)
+    if move:
+        os.unlink(path)
+    logger.debug('%s published to %s by %s', path, directory, how)
+    return digest, how
+
+def write_manifest(directory, digests):
+    """
+    Add or update the CHECKSUM entries of the files in digests, a dict of
+    name to SHA-256, keeping the others. Writers are serialized by a lock on
+    the directory, so nothing but the manifest ends up on the mirror, and it
+    is replaced in one rename.
+    """
+    path = os.path.join(directory, manifest_name)
+    lock = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = {}
+        try:
+            for line in open(path):
+                m = manifest_line.match(line.strip())
+                if m:
+                    entries[m.group(1)] = m.group(2)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        entries.update(digests)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            for name in sorted(entries):
+                f.write('SHA256 (%s) = %s\n' % (name, entries[name]))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+        fsync_dir(directory)
+    finally:
+        os.close(lock)
+
+def publish(paths, directory, move=True, jobs=4, logger=None,
+            analysis_dir=None, chunk=analysis.default_chunk):
+    """
+    Publish several files of one compose to directory at once, then add
+    them all to its CHECKSUM in one go. Returns ({name: SHA-256} of those
+    published, {path: error} of those that failed); the manifest only lists
+    the former. analysis_dir and chunk are passed on to publish_file().
+    """
+    logger = logger or logging.getLogger('upload')
+    digests = {}
+    errors = {}
+    lock = threading.Lock()
+    pending = list(paths)
+
+    def worker():
+        while True:
+            lock.acquire()
+            if not pending:
+                lock.release()
+                return
+            path = pending.pop(0)
+            lock.release()
+            try:
+                digest, how = publish_file(path, directory, move, logger,
+                    analysis_dir, chunk)
+            except (IOError, OSError) as e:
+                logger.error('Could not publish %s to %s: %s', path,
+                    directory, e)
+                lock.acquire()
+                errors[path] = e
+                lock.release()
+                continue
+            logger.info('Published %s to %s (%s), sha256 %s', path,
+                directory, how, digest)
+            lock.acquire()
+            digests[os.path.basename(path)] = digest
+            lock.release()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(jobs, len(pending)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if digests:
+        write_manifest(directory, digests)
+    return digests, errors
@@ -0,0 +1,253 @@
+#!/usr/bin/python -tt
+# Plan and pace batches of uploads across images, regions and the account
+# limits of each region.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import glob
+import json
+import os
+import threading
+
+# what we guess for a region we have no history of: seconds spent outside
+# the transfer (boot, volume, snapshot, ...) and bytes per second sent
+default_overhead = 900.0
+default_rate = 10485760.0
+
+# how many of the latest runs of a region the estimates are taken from
+history_runs = 20
+
+#
+# Classes
+#
+
+class Entry(object):
+    """one image uploaded to one region, as planned"""
+    __slots__ = ('job', 'region', 'slot', 'start', 'end')
+
+    def __init__(self, job, region, slot, start, end):
+        self.job = job
+        self.region = region
+        self.slot = slot
+        self.start = start
+        self.end = end
+
+
+class Plan(object):
+    """
+    When each image is expected to be uploaded to each region. Every region
+    has as many slots as its limits allow uploads at once; each upload
+    takes one slot for overhead + size / rate seconds of that region.
+    """
+
+    def __init__(self, entries, limits, estimates):
+        self.entries = entries
+        self.limits = limits
+        self.estimates = estimates
+
+    def makespan(self):
+        """predicted seconds until the last upload is done"""
+        return max([e.end for e in self.entries] or [0])
+
+    def order(self, region):
+        """the run IDs of the jobs for region, in the order they start"""
+        return [e.job.run_id for e in sorted(self.entries,
+                key=lambda e: (e.start, e.slot)) if e.region == region]
+
+    def summary(self):
+        """Return text tables of the plan by region and by image"""
+        lines = [['region', 'slots', 'uploads', 'overhead', 'MB/s', 'done at']]
+        for region in sorted(self.limits):
+            mine = [e for e in self.entries if e.region == region]
+            overhead, rate = self.estimates[region]
+            lines.append([region, str(self.limits[region]), str(len(mine)),
+                '%.0f' % overhead, '%.1f' % (rate / 1048576.0),
+                _clock(max([e.end for e in mine] or [0]))])
+        text = _table(lines)
+        lines = [['image', 'MB', 'first AMI', 'all AMIs']]
+        jobs = []
+        for e in self.entries:
+            if e.job not in jobs:
+                jobs.append(e.job)
+        for job in jobs:
+            ends = [e.end for e in self.entries if e.job is job]
+            lines.append([job.name, '%.0f' % (_image_size(job) / 1048576.0),
+                _clock(min(ends)), _clock(max(ends))])
+        return '%s\n\n%s\n\npredicted makespan: %s' % (text, _table(lines),
+            _clock(self.makespan()))
+
+
+class Admission(object):
+    """
+    Lets uploads into each region one after the other while the region has
+    the instances and volumes for them; limits maps each region to the
+    (instances, volumes) it may hold at once. With a Plan, each region
+    takes its uploads in the planned order; otherwise, as for the daemon,
+    in the order they ask. An upload that finishes early or fails gives
+    back what it held for the next one right away.
+    """
+
+    def __init__(self, limits, plan=None):
+        self.limits = dict(limits)
+        self.free = dict([(r, list(limits[r])) for r in limits])
+        self.queues = dict([(r, plan and plan.order(r) or [])
+                            for r in limits])
+        self.cond = threading.Condition()
+
+    def enter(self, region, run_id, instances=1):
+        """
+        block until run_id may start uploading to region, holding a volume
+        and instances instances there; a ValueError if it never could
+        """
+        if region not in self.limits:
+            raise ValueError('%s has no upload limits' % region)
+        self.cond.acquire()
+        try:
+            queue = self.queues[region]
+            free = self.free[region]
+            if instances > self.limits[region][0] or \
+                    self.limits[region][1] < 1:
+                # the uploads planned after this one must not wait for it
+                if run_id in queue:
+                    queue.remove(run_id)
+                    self.cond.notify_all()
+                raise ValueError('an upload to %s needs %s instance(s) and '
+                    'a volume, but its limits are %s and %s' %
+                    ((region, instances) + tuple(self.limits[region])))
+            if run_id not in queue:
+                queue.append(run_id)
+            while queue[0] != run_id or free[0] < instances or free[1] < 1:
+                self.cond.wait()
+            queue.pop(0)
+            free[0] -= instances
+            free[1] -= 1
+        finally:
+            self.cond.release()
+
+    def leave(self, region, instances=1):
+        """give back what enter() took"""
+        self.cond.acquire()
+        self.free[region][0] += instances
+        self.free[region][1] += 1
+        self.cond.notify_all()
+        self.cond.release()
+
+#
+# Functions
+#
+
+def _clock(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60,
+        seconds % 60)
+
+def _table(lines):
+    widths = [max([len(l[i]) for l in lines]) for i in range(len(lines[0]))]
+    return '\n'.join(['  '.join([c.rjust(w) for c, w in zip(l, widths)])
+                      for l in lines])
+
+def _image_size(job):
+    return os.path.getsize(job.image)
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) // 2]
+
+def history(logdir):
+    """
+    Return {region: (overhead seconds, bytes per second)} from what earlier
+    runs left in logdir: how long their traces show each region took from
+    start to end less its transfer, and the rates in throughput.jsonl. Each
+    is the median of the latest history_runs runs of the region. Stages
+    overlap (cleanup runs alongside registration, verifier boots alongside
+    each other), so they are not added up; regions that failed are left
+    out.
+    """
+    overheads = {}
+    traces = glob.glob(os.path.join(logdir, 'trace-*.json'))
+    traces.sort(key=os.path.getmtime)
+    for path in traces:
+        try:
+            f = open(path)
+            try:
+                events = json.load(f)['traceEvents']
+            finally:
+                f.close()
+        except (IOError, ValueError, KeyError):
+            continue
+        regions = dict([(e['tid'], e['args']['name']) for e in events
+                        if e.get('ph') == 'M'])
+        total = {}
+        sent = {}
+        for e in events:
+            if e.get('ph') != 'X':
+                continue
+            region = regions.get(e['tid'])
+            seconds = e['dur'] / 1000000.0
+            if e['name'] == 'upload' and 'error' not in e.get('args', {}):
+                total[region] = seconds
+            elif e['name'] == 'transfer':
+                sent[region] = sent.get(region, 0) + seconds
+        for region, seconds in total.items():
+            overheads.setdefault(region, []).append(
+                max(seconds - sent.get(region, 0), 0))
+    rates = {}
+    try:
+        f = open(os.path.join(logdir, 'throughput.jsonl'))
+    except IOError:
+        f = None
+    if f is not None:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('rate'):
+                    rates.setdefault(record['region'], []).append(
+                        record['rate'])
+        finally:
+            f.close()
+    estimates = {}
+    for region in set(overheads) | set(rates):
+        estimates[region] = (
+            _median(overheads.get(region, [])[-history_runs:]),
+            _median(rates.get(region, [])[-history_runs:]))
+    return estimates
+
+def plan(jobs, limits, estimates=None, bandwidth=0):
+    """
+    Plan uploading each job to each of its regions. limits maps each region
+    to how many uploads it can take at once; estimates is what history()
+    returns, with defaults for regions it lacks. With a bandwidth budget in
+    bytes per second, no single transfer is expected to beat it.
+
+    Images go biggest first, in the same order in every region, each to
+    whichever of the region's slots frees up first. As every upload of a
+    region takes overhead + size / rate, this is longest-job-first, which
+    keeps the makespan close to the best possible, and an image's regions
+    finish close together.
+    """
+    estimates = estimates or {}
+    used = {}
+    for region in limits:
+        overhead, rate = estimates.get(region, (None, None))
+        rate = rate or default_rate
+        if bandwidth:
+            rate = min(rate, bandwidth)
+        used[region] = (overhead or default_overhead, rate)
+    entries = []
+    slots = dict([(r, [0.0] * limits[r]) for r in limits])
+    for job in sorted(jobs, key=_image_size, reverse=True):
+        size = _image_size(job)
+        for region in job.regions:
+            overhead, rate = used[region]
+            free = slots[region]
+            slot = free.index(min(free))
+            start = free[slot]
+            free[slot] = start + overhead + size / rate
+            entries.append(Entry(job, region, slot, start, free[slot]))
+    return Plan(entries, limits, used)
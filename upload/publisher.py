@@ -0,0 +1,85 @@
+#!/usr/bin/python -tt
+# Long-lived fedmsg publisher for the uploader.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import logging
+import Queue
+import threading
+
+modname = 'cloud-image-uploader'
+
+class Publisher(object):
+    """
+    Publish fedmsg messages from a single background thread. Region threads
+    hand messages over with publish() and carry on; the publisher thread
+    drains everything queued at each wakeup and sends it in one go. fedmsg
+    is only imported and initialized once, by the publisher thread, since its
+    zmq socket must not be shared between threads.
+
+    The queue is bounded so a stuck bus can not grow us without limit; if it
+    stays full for longer than timeout the message is dropped and logged.
+    """
+
+    def __init__(self, maxsize=100, timeout=10, batch=20, logger=None):
+        self.queue = Queue.Queue(maxsize)
+        self.timeout = timeout
+        self.batch = batch
+        self.logger = logger or logging.getLogger('upload')
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='publisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, topic, msg):
+        """queue a message; never blocks for longer than timeout"""
+        try:
+            self.queue.put((topic, msg), timeout=self.timeout)
+        except Queue.Full:
+            self.dropped += 1
+            self.logger.error('fedmsg queue full, dropped %s: %s', topic, msg)
+
+    def close(self, timeout=60):
+        """send whatever is still queued, then stop the publisher thread"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            # the publisher is stuck or gone; do not hang shutdown on it
+            self.logger.error('fedmsg queue still full after %s seconds, '
+                'dropping %s message(s)', timeout, self.queue.qsize())
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.logger.error('fedmsg publisher did not drain in %s seconds',
+                timeout)
+
+    def _run(self):
+        try:
+            import fedmsg
+        except ImportError:
+            self.logger.error('fedmsg is not installed, nothing will be published')
+            fedmsg = None
+        done = False
+        while not done:
+            pending = [self.queue.get()]
+            while len(pending) < self.batch:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            sent = 0
+            for item in pending:
+                if item is None:
+                    done = True
+                    continue
+                topic, msg = item
+                if fedmsg is None:
+                    continue
+                try:
+                    fedmsg.publish(topic=topic, modname=modname, msg=msg)
+                    sent += 1
+                except Exception:
+                    self.logger.exception('Could not publish %s', topic)
+            self.logger.debug('published %s fedmsg message(s)', sent)
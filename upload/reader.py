@@ -0,0 +1,131 @@
+#!/usr/bin/python -tt
+# Read big images in large blocks without pushing everything else on the
+# host out of the page cache.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import ctypes
+import ctypes.util
+import io
+import os
+import threading
+
+# posix_fadvise() advice values, the same on every Linux architecture
+FADV_SEQUENTIAL = 2
+FADV_WILLNEED = 3
+FADV_DONTNEED = 4
+
+# what is read ahead of the reader, and how much has to be left behind by
+# every reader of an image before it is dropped from the page cache
+readahead = 67108864
+drop_step = 67108864
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+        use_errno=True)
+    _fadvise = getattr(_libc, 'posix_fadvise64', None) or _libc.posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                         ctypes.c_int]
+except (OSError, AttributeError):
+    # no libc to ask; reads work the same, only without the hints
+    _fadvise = None
+
+# realpath -> {reader: the byte it has read up to}, and realpath -> the byte
+# below which the page cache was already dropped
+_positions = {}
+_dropped = {}
+_lock = threading.Lock()
+
+#
+# Classes
+#
+
+class ImageReader(object):
+    """
+    Read length bytes of an image from offset on, block bytes per read()
+    system call, into one buffer that is reused for every read. The kernel
+    is told the reads are sequential and asked to read readahead bytes
+    ahead of us. What every ImageReader of the same image in this process
+    has read past is dropped from the page cache, so regions sending the
+    same image at once share the cache between them but a multi-GB image
+    does not evict the rest of the host.
+
+    read() hands back a memoryview of the buffer, which stays valid until
+    the next read(). reads and bytes count the system calls made and what
+    they returned.
+    """
+
+    def __init__(self, path, offset=0, length=None, block=16777216):
+        self.path = os.path.realpath(path)
+        self.file = io.open(self.path, 'rb', buffering=0)
+        if length is None:
+            length = os.fstat(self.file.fileno()).st_size - offset
+        self.end = offset + length
+        self.pos = offset
+        self.buf = bytearray(block)
+        self.view = memoryview(self.buf)
+        self.reads = 0
+        self.bytes = 0
+        self.ahead = offset
+        self.file.seek(offset)
+        fadvise(self.file.fileno(), offset, length, FADV_SEQUENTIAL)
+        _lock.acquire()
+        _positions.setdefault(self.path, {})[self] = offset
+        _lock.release()
+
+    def read(self, size=None):
+        """read up to size bytes, at most a block; empty at the end"""
+        size = min(size or len(self.buf), len(self.buf), self.end - self.pos)
+        if size <= 0:
+            return self.view[:0]
+        if self.pos + size > self.ahead:
+            self.ahead = min(self.pos + size + readahead, self.end)
+            fadvise(self.file.fileno(), self.pos, self.ahead - self.pos,
+                FADV_WILLNEED)
+        n = self.file.readinto(self.view[:size]) or 0
+        self.reads += 1
+        self.bytes += n
+        self.pos += n
+        self._behind()
+        return self.view[:n]
+
+    def close(self):
+        """stop reading; the image is dropped if no one else is reading it"""
+        if self.file.closed:
+            return
+        _lock.acquire()
+        try:
+            readers = _positions.get(self.path, {})
+            readers.pop(self, None)
+            if not readers:
+                _positions.pop(self.path, None)
+                _dropped.pop(self.path, None)
+                fadvise(self.file.fileno(), 0, 0, FADV_DONTNEED)
+        finally:
+            _lock.release()
+        self.file.close()
+
+    def _behind(self):
+        """drop what every reader of the image is done with"""
+        _lock.acquire()
+        try:
+            readers = _positions[self.path]
+            readers[self] = self.pos
+            low = min(readers.values())
+            start = _dropped.get(self.path, 0)
+            if low - start >= drop_step:
+                fadvise(self.file.fileno(), start, low - start, FADV_DONTNEED)
+                _dropped[self.path] = low
+        finally:
+            _lock.release()
+
+#
+# Functions
+#
+
+def fadvise(fd, offset, length, advice):
+    """posix_fadvise(), if there is one; a hint, so failures are ignored"""
+    if _fadvise is not None:
+        _fadvise(fd, offset, length, advice)
@@ -0,0 +1,230 @@
+#!/usr/bin/python -tt
+# Per-stage timing for uploads, exported as a Chrome trace.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import json
+import threading
+import time
+
+# the timeline, region and open spans of the calling thread; see activate()
+_local = threading.local()
+
+# stage columns of the summary table, in the order they happen
+stages = ('boot', 'volume_create', 'attach', 'ssh_wait', 'transfer',
+          'detach', 'snapshot', 'register', 'verify', 'grant', 'cleanup')
+
+#
+# Classes
+#
+
+class Span(object):
+    """One timed stage of one region's upload"""
+    __slots__ = ('name', 'region', 'start', 'end', 'bytes', 'calls', 'reads',
+                 'read_bytes', 'args')
+
+    def __init__(self, name, region, args):
+        self.name = name
+        self.region = region
+        self.start = time.time()
+        self.end = None
+        self.bytes = 0
+        self.calls = 0
+        # read system calls made for the stage, and the bytes they returned
+        self.reads = 0
+        self.read_bytes = 0
+        self.args = args
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+class Timeline(object):
+    """
+    All spans recorded during one run. Region threads record into it through
+    the module level span() after calling activate(), so code deep inside
+    EC2Obj does not need a timeline handed to it.
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.start = time.time()
+        self.spans = []
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        self.lock.acquire()
+        self.spans.append(span)
+        self.lock.release()
+
+    def count_call(self, region):
+        self.lock.acquire()
+        self.calls[region] = self.calls.get(region, 0) + 1
+        self.lock.release()
+
+    def chrome_trace(self):
+        """
+        Return the run as a Chrome trace-event dict, loadable in
+        chrome://tracing or Perfetto. Each region gets its own row.
+        """
+        self.lock.acquire()
+        spans = list(self.spans)
+        self.lock.release()
+        regions = sorted(set([s.region for s in spans]))
+        tids = dict([(r, i + 1) for i, r in enumerate(regions)])
+        events = []
+        for region in regions:
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                'tid': tids[region], 'args': {'name': region}})
+        for s in spans:
+            args = dict(s.args)
+            args.update(bytes=s.bytes, calls=s.calls)
+            if s.reads:
+                args.update(reads=s.reads, read_bytes=s.read_bytes)
+            events.append({'name': s.name, 'cat': 'upload', 'ph': 'X',
+                'pid': 1, 'tid': tids[s.region],
+                'ts': int((s.start - self.start) * 1000000),
+                'dur': int(s.duration() * 1000000), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'run_id': self.run_id}}
+
+    def write_trace(self, path):
+        """write the Chrome trace for this run to path"""
+        f = open(path, 'w')
+        try:
+            json.dump(self.chrome_trace(), f)
+        finally:
+            f.close()
+
+    def summary(self):
+        """
+        Return a text table of seconds spent per stage in each region, with
+        the KB each read system call returned on average
+        """
+        self.lock.acquire()
+        spans = list(self.spans)
+        self.lock.release()
+        rows = {}
+        for s in spans:
+            row = rows.setdefault(s.region, {'bytes': 0, 'reads': 0,
+                'read_bytes': 0})
+            row[s.name] = row.get(s.name, 0) + s.duration()
+            row['bytes'] += s.bytes
+            row['reads'] += s.reads
+            row['read_bytes'] += s.read_bytes
+        cols = [c for c in stages if [r for r in rows.values() if c in r]]
+        header = ['region'] + list(cols) + ['total', 'MB', 'KB/read', 'calls']
+        lines = [header]
+        for region in sorted(rows):
+            row = rows[region]
+            lines.append([region] +
+                ['%.1f' % row[c] if c in row else '-' for c in cols] +
+                ['%.1f' % row.get('upload', 0),
+                 '%.1f' % (row['bytes'] / 1048576.0),
+                 row['reads'] and '%.0f' % (row['read_bytes'] / 1024.0 /
+                                            row['reads']) or '-',
+                 str(self.calls.get(region, 0))])
+        widths = [max([len(l[i]) for l in lines]) for i in range(len(header))]
+        return '\n'.join(['  '.join([c.rjust(w) for c, w in zip(l, widths)])
+                          for l in lines])
+
+
+class _NullSpan(object):
+    """stands in for a Span when no timeline is active"""
+    bytes = 0
+    calls = 0
+    reads = 0
+    read_bytes = 0
+
+
+class TracedConnection(object):
+    """
+    Wrap an EC2Connection so that every API call is counted against the
+    active span. boto objects handed back (volumes, instances, snapshots)
+    have their connection pointed at us too, so the update() calls in the
+    wait loops get counted as well.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            count_call()
+            return self._rebind(attr(*args, **kwargs))
+        return call
+
+    def _rebind(self, result):
+        if isinstance(result, list):
+            for item in result:
+                self._rebind(item)
+        elif hasattr(result, 'connection'):
+            result.connection = self
+            for inst in getattr(result, 'instances', None) or []:
+                self._rebind(inst)
+        return result
+
+#
+# Functions
+#
+
+def activate(timeline, region):
+    """record spans made by this thread into timeline, under region"""
+    _local.timeline = timeline
+    _local.region = region
+    _local.stack = []
+
+def deactivate():
+    _local.timeline = None
+
+def active():
+    """return the timeline this thread records into, or None"""
+    return getattr(_local, 'timeline', None)
+
+class span(object):
+    """
+    Time a stage of the upload running on this thread:
+
+        with timeline.span('transfer') as s:
+            s.bytes = copied
+
+    Does nothing if the thread has no active timeline.
+    """
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.span = None
+
+    def __enter__(self):
+        tl = active()
+        if tl is None:
+            return _NullSpan()
+        self.span = Span(self.name, _local.region, self.args)
+        _local.stack.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        self.span.end = time.time()
+        if exc_type is not None:
+            self.span.args['error'] = str(exc)
+        _local.stack.remove(self.span)
+        _local.timeline.add(self.span)
+        return False
+
+def count_call():
+    """count an API call against the innermost open span on this thread"""
+    tl = active()
+    if tl is None:
+        return
+    if _local.stack:
+        _local.stack[-1].calls += 1
+    tl.count_call(_local.region)
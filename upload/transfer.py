@@ -0,0 +1,514 @@
+#!/usr/bin/python -tt
+# Stream disk images to a stager, with progress and stall detection.
+# Authors: Jay Greguske <jgregusk@redhat.com>,
+#          Andrew Thomas <anthomas@redhat.com>
+#          Sam Kottler <shk@redhat.com>
+#
+
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+import fedora_ec2
+from reader import ImageReader
+
+# Receiver run on the stager when verifying: writes stdin to the device
+# given as argv[1] starting at byte argv[2], and prints the SHA-256 of each
+# argv[3] byte chunk ("<index> <digest>") and of the whole stream
+# ("-1 <digest>") once everything is on disk; what can not be synced (EINVAL,
+# e.g. /dev/null) is taken as on disk. It has to survive being put
+# inside the double quotes of an ssh command line, so it uses no quotes,
+# dollar signs or backslashes.
+receiver_script = """import sys,os,hashlib
+d=os.open(sys.argv[1],os.O_WRONLY|os.O_CREAT)
+c=int(sys.argv[3]);b=int(sys.argv[4])
+os.lseek(d,int(sys.argv[2]),0)
+t=hashlib.sha256();h=hashlib.sha256();i=0;m=0
+while 1:
+ x=os.read(0,b)
+ if not x:break
+ t.update(x)
+ y=x
+ while y:y=y[os.write(d,y):]
+ while x:
+  k=min(len(x),c-m);h.update(x[:k]);x=x[k:];m+=k
+  if m==c:sys.stdout.write(str(i)+chr(32)+h.hexdigest()+chr(10));h=hashlib.sha256();i+=1;m=0
+if m:sys.stdout.write(str(i)+chr(32)+h.hexdigest()+chr(10))
+try:os.fsync(d)
+except OSError as e:
+ if e.errno!=22:raise
+sys.stdout.write(str(-1)+chr(32)+t.hexdigest()+chr(10))
+"""
+
+# Run on the stager to check what an earlier, interrupted transfer left on
+# the device argv[1]: prints the SHA-256 of each argv[4] byte chunk of the
+# argv[3] bytes from argv[2] on, in the receiver's format. Quote-free for
+# the same reason.
+hasher_script = """import sys,os,hashlib
+d=os.open(sys.argv[1],os.O_RDONLY)
+n=int(sys.argv[3]);c=int(sys.argv[4]);b=int(sys.argv[5])
+os.lseek(d,int(sys.argv[2]),0)
+i=0
+while n>0:
+ h=hashlib.sha256();m=min(c,n);n-=m
+ while m>0:
+  x=os.read(d,min(b,m))
+  if not x:break
+  h.update(x);m-=len(x)
+ sys.stdout.write(str(i)+chr(32)+h.hexdigest()+chr(10));i+=1
+"""
+
+digest_line = re.compile(r'^(-?\d+) ([0-9a-f]{64})$', re.M)
+
+#
+# Classes
+#
+
+class Bandwidth(object):
+    """
+    An upload budget of rate bytes per second shared by all the transfers
+    given a flow() of it. Bytes are handed out in weighted fair queueing
+    order: while several flows want to send, each gets a share of the
+    budget in proportion to its weight, so a region weighted 4 finishes
+    well before four regions weighted 1. Whatever a flow does not use,
+    because it is idle, slow on its own or finished, goes to the others.
+    A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate, burst=0.25):
+        self.rate = rate
+        self.burst = burst
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.seq = itertools.count()
+        self.vtime = 0.0
+        self.free_at = 0.0
+
+    def flow(self, weight=1):
+        """a new flow of this budget"""
+        return Flow(self, weight)
+
+    def _take(self, flow, nbytes):
+        if not self.rate:
+            return
+        self.cond.acquire()
+        try:
+            # the flow's virtual finish time; idle flows bank no credit
+            tag = max(flow.vtime, self.vtime) + nbytes / float(flow.weight)
+            flow.vtime = tag
+            entry = (tag, self.seq.next())
+            heapq.heappush(self.waiting, entry)
+            start = flow.since = time.time()
+            while True:
+                now = time.time()
+                if self.waiting[0] == entry and now >= self.free_at:
+                    break
+                if self.waiting[0] == entry:
+                    self.cond.wait(self.free_at - now)
+                else:
+                    self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.vtime = tag
+            # up to burst seconds of unused budget may be caught up on
+            self.free_at = max(now - self.burst, self.free_at) + \
+                nbytes / float(self.rate)
+            flow.total_waited += now - start
+            flow.since = None
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+class Flow(object):
+    """
+    One transfer's claim on a Bandwidth. take(n) blocks until n bytes may
+    be sent; waited() adds up the seconds spent blocked so far.
+    """
+
+    def __init__(self, bandwidth, weight=1):
+        if weight <= 0:
+            raise fedora_ec2.Fedora_EC2Error('Bandwidth weights must be '
+                'positive')
+        self.bandwidth = bandwidth
+        self.weight = weight
+        self.vtime = 0.0
+        self.total_waited = 0.0
+        self.since = None
+
+    def take(self, nbytes):
+        self.bandwidth._take(self, nbytes)
+
+    def waited(self):
+        since = self.since
+        if since is None:
+            return self.total_waited
+        return self.total_waited + time.time() - since
+
+class Transfer(object):
+    """
+    Send a local image to the stdin of a receiving command, normally
+    ssh ... "dd of=<device>". The image is read and written here rather than
+    by a local dd so we know exactly how many bytes went out.
+
+    A watchdog thread reports progress every interval seconds through
+    progress(sent, total, rate, eta) and kills the receiver if fewer than
+    stall_floor bytes per second went out over the last stall_time seconds.
+    A killed or failed stream is retried up to retries times. Each retry
+    sends the whole range again, since we can not know how much of it the
+    receiver managed to write.
+
+    The receiver's output is drained as it comes so it can never fill the
+    pipe and wedge the transfer.
+
+    offset and length restrict the transfer to one byte range of the image,
+    for sending an image as several stripes. Any {offset} in command is
+    replaced with the first byte being sent, and the receiver has to write
+    there (dd seek={offset} oflag=seek_bytes, or receiver_cmd()).
+
+    With verify, command must be a receiver_cmd(). Every chunk bytes of the
+    stream are hashed here as they are read and on the stager as they are
+    written, in the same pass. Chunks whose digests differ are sent again on
+    their own (counting against retries), and the transfer fails if they
+    still differ.
+
+    Given a flow of a Bandwidth, every block waits its turn in that budget
+    before going out. Time spent waiting does not count towards a stall.
+
+    The image is read through an ImageReader, block bytes per system call
+    into one buffer that is written to the receiver as it is, and kept out
+    of the page cache once every region is past it.
+    """
+
+    def __init__(self, path, command, block=4194304, interval=30,
+                 stall_floor=65536, stall_time=120, retries=3, progress=None,
+                 logger=None, offset=0, length=None, verify=False,
+                 chunk=268435456, flow=None):
+        self.path = path
+        self.command = command
+        self.offset = offset
+        self.block = block
+        self.interval = interval
+        self.stall_floor = stall_floor
+        self.stall_time = stall_time
+        self.retries = retries
+        self.progress = progress
+        self.logger = logger or logging.getLogger('upload')
+        if length is None:
+            length = os.path.getsize(path) - offset
+        self.total = length
+        self.verify = verify
+        self.chunk = chunk
+        self.flow = flow
+        self.digest = None
+        self.length = length
+        self.sent = 0
+        self.start = offset
+        self.stalled = False
+        self.reads = 0
+        self.read_bytes = 0
+
+    def position(self):
+        """the byte of the image the current attempt has sent up to"""
+        return self.start + self.sent
+
+    def run(self):
+        """
+        Send the image, retrying as needed. Returns a dict of the bytes in
+        the range, seconds taken, average bytes per second, retries used and
+        bytes sent again because they failed verification, the read system
+        calls made and the bytes they returned, plus the SHA-256 of the
+        range if verifying and the seconds spent waiting on the bandwidth
+        budget if there is one.
+        """
+        attempt = 0
+        resent = 0
+        pending = [(self.offset, self.total)]
+        start = time.time()
+        while pending:
+            offset, length = pending[0]
+            try:
+                bad = self._attempt(offset, length)
+            except fedora_ec2.Fedora_EC2Error as e:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.logger.warning('%s; retrying (%s of %s)',
+                    e, attempt, self.retries)
+                continue
+            pending.pop(0)
+            if not bad:
+                continue
+            ranges = ', '.join(['%s-%s' % (o, o + l - 1) for o, l in bad])
+            if attempt >= self.retries or '{offset}' not in self.command:
+                raise fedora_ec2.Fedora_EC2Error('%s does not match what the '
+                    'stager wrote in bytes %s' % (self.path, ranges))
+            attempt += 1
+            self.logger.warning('%s does not match what the stager wrote in '
+                'bytes %s; sending them again (%s of %s)',
+                self.path, ranges, attempt, self.retries)
+            pending.extend(bad)
+            resent += sum([l for o, l in bad])
+        seconds = time.time() - start
+        stats = {'bytes': self.total, 'seconds': seconds,
+                 'rate': self.total / max(seconds, 0.001),
+                 'retries': attempt, 'resent': resent, 'reads': self.reads,
+                 'read_bytes': self.read_bytes}
+        if self.digest is not None:
+            stats['sha256'] = self.digest
+        if self.flow is not None:
+            stats['throttled'] = self.flow.waited()
+        return stats
+
+    def _attempt(self, offset, length):
+        """
+        Send length bytes from offset once. Returns the (offset, length)
+        ranges that failed verification.
+        """
+        self.sent = 0
+        self.start = offset
+        self.length = length
+        self.stalled = False
+        command = self.command.replace('{offset}', str(offset))
+        self.logger.debug('Command: %s', command)
+        # own process group, so a stall kills ssh and not just the shell
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True,
+            preexec_fn=os.setsid)
+        output = []
+        reader = threading.Thread(target=self._drain, args=(proc, output))
+        reader.daemon = True
+        reader.start()
+        done = threading.Event()
+        watchdog = threading.Thread(target=self._watch, args=(proc, done))
+        watchdog.daemon = True
+        watchdog.start()
+
+        digests = []
+        whole = hashlib.sha256()
+        part = hashlib.sha256()
+        in_chunk = 0
+        image = ImageReader(self.path, offset, length, self.block)
+        try:
+            try:
+                while self.sent < length:
+                    want = min(self.block, length - self.sent)
+                    if self.verify:
+                        want = min(want, self.chunk - in_chunk)
+                    buf = image.read(want)
+                    if not len(buf):
+                        break
+                    if self.flow is not None:
+                        self.flow.take(len(buf))
+                    proc.stdin.write(buf)
+                    self.sent += len(buf)
+                    if self.verify:
+                        whole.update(buf)
+                        part.update(buf)
+                        in_chunk += len(buf)
+                        if in_chunk == self.chunk:
+                            digests.append(part.hexdigest())
+                            part = hashlib.sha256()
+                            in_chunk = 0
+                proc.stdin.close()
+            except IOError as e:
+                # the receiver went away; its exit code says why below
+                self.logger.debug('Write to receiver failed: %s', e)
+                proc.stdin.close()
+            ret = proc.wait()
+        finally:
+            image.close()
+            self.reads += image.reads
+            self.read_bytes += image.bytes
+            done.set()
+            watchdog.join()
+            reader.join()
+        if in_chunk:
+            digests.append(part.hexdigest())
+
+        output = ''.join(output).strip()
+        self.logger.debug('Return code: %s', ret)
+        self.logger.debug('Output: %s', output)
+        if self.stalled:
+            raise fedora_ec2.Fedora_EC2Error('Transfer of %s stalled at %s bytes'
+                % (self.path, offset + self.sent))
+        if ret != 0 or self.sent != length:
+            self.logger.error('Transfer exited with %s after %s of %s bytes',
+                ret, self.sent, length)
+            self.logger.error('Command run: %s', command)
+            self.logger.error('Output:\n%s', output)
+            raise fedora_ec2.Fedora_EC2Error('Transfer failed, see logs for output')
+        if not self.verify:
+            return []
+        if offset == self.offset and length == self.total:
+            self.digest = whole.hexdigest()
+        return self._compare(offset, length, digests, whole.hexdigest(), output)
+
+    def _compare(self, offset, length, digests, whole, output):
+        """return the ranges where the receiver's digests differ from ours"""
+        theirs = dict([(int(i), d) for i, d in digest_line.findall(output)])
+        if theirs.get(-1) == whole and len(theirs) == len(digests) + 1:
+            self.logger.debug('Stager wrote bytes %s-%s intact, sha256 %s',
+                offset, offset + length - 1, whole)
+            return []
+        bad = []
+        for i, digest in enumerate(digests):
+            if theirs.get(i) != digest:
+                start = offset + i * self.chunk
+                bad.append((start, min(self.chunk, offset + length - start)))
+        if not bad:
+            # every chunk matched but the totals did not; trust nothing
+            bad = [(offset, length)]
+        return bad
+
+    def _waited(self):
+        if self.flow is None:
+            return 0.0
+        return self.flow.waited()
+
+    def _drain(self, proc, output):
+        """keep reading the receiver's output so it never blocks on us"""
+        while True:
+            data = proc.stdout.read(4096)
+            if not data:
+                return
+            output.append(data)
+            # only the tail is interesting if it fails
+            if len(output) > 16:
+                del output[0]
+
+    def _watch(self, proc, done):
+        """report progress and kill the receiver if the stream stalls"""
+        start = time.time()
+        last_report = start
+        samples = [(start, 0, self._waited())]
+        while not done.is_set():
+            done.wait(1)
+            now = time.time()
+            sent = self.sent
+            samples.append((now, sent, self._waited()))
+            while len(samples) > 1 and now - samples[1][0] >= self.stall_time:
+                samples.pop(0)
+            if now - last_report >= self.interval:
+                last_report = now
+                rate = sent / max(now - start, 0.001)
+                if rate > 0:
+                    eta = (self.length - sent) / rate
+                else:
+                    eta = None
+                if self.progress is not None:
+                    self.progress(sent, self.length, rate, eta)
+            # only judge once a whole stall_time window has been seen
+            if now - start >= self.stall_time and not done.is_set():
+                moved = sent - samples[0][1]
+                # waiting for our share of the bandwidth is not stalling
+                busy = now - samples[0][0] - (samples[-1][2] - samples[0][2])
+                if moved < self.stall_floor * busy:
+                    self.logger.error('Only %s bytes sent in the last %s '
+                        'seconds, killing the transfer',
+                        moved, int(now - samples[0][0]))
+                    self.stalled = True
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                    return
+
+#
+# Functions
+#
+
+def receiver_cmd(device, chunk=268435456, block=4194304, python='python'):
+    """
+    Return the command to run on the stager to write a verified transfer to
+    device; see receiver_script. The write offset is left as {offset} for
+    Transfer to fill in.
+    """
+    return "%s -c '%s' %s {offset} %s %s" % (python, receiver_script, device,
+        chunk, block)
+
+def hasher_cmd(device, offset, length, chunk=268435456, block=4194304,
+               python='python'):
+    """Return the command to run on the stager for check_range()"""
+    return "%s -c '%s' %s %s %s %s %s" % (python, hasher_script, device,
+        offset, length, chunk, block)
+
+def chunk_digests(path, offset, length, chunk=268435456, block=4194304):
+    """the SHA-256 of each chunk bytes of a range of a local file"""
+    digests = []
+    f = ImageReader(path, offset, length, block)
+    try:
+        while length > 0:
+            h = hashlib.sha256()
+            left = min(chunk, length)
+            length -= left
+            while left > 0:
+                buf = f.read(left)
+                if not len(buf):
+                    break
+                h.update(buf)
+                left -= len(buf)
+            digests.append(h.hexdigest())
+    finally:
+        f.close()
+    return digests
+
+def check_range(path, command, offset, length, chunk=268435456,
+                block=4194304, logger=None, digests=None):
+    """
+    Compare a range of a local image with what is already on the stager,
+    by running command, a hasher_cmd(), there. Returns the (offset, length)
+    ranges that differ, so only those need sending again. digests are the
+    chunk digests of the range if they are known already, e.g. from
+    analysis.analyze(); otherwise the range is read to get them.
+    """
+    logger = logger or logging.getLogger('upload')
+    logger.debug('Command: %s', command)
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        logger.error('Output:\n%s', output[-4096:])
+        raise fedora_ec2.Fedora_EC2Error('Could not hash what the stager '
+            'already has, see logs for output')
+    theirs = dict([(int(i), d) for i, d in digest_line.findall(output)])
+    if digests is None:
+        digests = chunk_digests(path, offset, length, chunk, block)
+    bad = []
+    for i, digest in enumerate(digests):
+        if theirs.get(i) != digest:
+            start = offset + i * chunk
+            bad.append((start, min(chunk, offset + length - start)))
+    return bad
+
+def file_digest(path, block=4194304):
+    """the SHA-256 of a whole local file"""
+    h = hashlib.sha256()
+    f = ImageReader(path, block=block)
+    try:
+        while True:
+            buf = f.read()
+            if not len(buf):
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def record_throughput(path, **fields):
+    """
+    Append the figures of one finished transfer to a JSON-lines history file
+    so throughput can be compared across runs.
+    """
+    fields.setdefault('time', int(time.time()))
+    f = open(path, 'a')
+    try:
+        f.write(json.dumps(fields, sort_keys=True) + '\n')
+    finally:
+        f.close()
@@ -5,25 +5,221 @@
 #          Sam Kottler <shk@redhat.com>
 #
 
-import logging
 import math
 import ConfigParser
+import json
 from optparse import OptionParser
 import os
+import re
+import socket
+import SocketServer
 import subprocess
 import sys
 import threading
+import time
+import uuid
 
+import analysis
 import fedora_ec2
+import grants
+import journal
+import logs
+import metrics
+import planner
+from publisher import Publisher
+import timeline
+import transfer
 
 #
 # Constants
 #
 
-results = {}
-result_lock = threading.Lock()
 mainlog = None
 opts = None
+publisher = None
+# the upload budget all transfers share, see transfer.Bandwidth
+bandwidth = None
+# what the daemon's jobs may hold in each region, shared by all of them
+daemon_admission = None
+socket_path = '/var/run/cloud-uploader/uploader.sock'
+
+# bytes of a transfer that may still be in pipes and socket buffers rather
+# than on the stager's disk; a resumed transfer goes back this far
+resume_margin = 67108864
+
+# options that have to be numbers, checked by preflight()
+numeric_opts = ('transfer_block', 'progress_interval', 'stall_floor',
+    'stall_time', 'bandwidth', 'bandwidth_weight', 'transfer_retries',
+    'verify_chunk', 'scratch_ttl', 'verify_boot_timeout')
+# and those that have to be whole numbers of at least 1
+count_opts = ('instance_limit', 'volume_limit')
+
+# EC2Objs by region, kept for the life of the process so the daemon does not
+# reconnect and look regions up again for every image
+ec2_cache = {}
+ec2_lock = threading.Lock()
+
+#
+# Classes
+#
+
+class UploadJob(object):
+    """
+    One image to be uploaded to one or more regions. upload_region reads the
+    image settings from here rather than from opts so that the daemon can run
+    several jobs side by side. Per-region results end up in results, failures
+    in errors, and each progress event is handed to listener. Stage timings
+    are recorded in timeline under a run ID unique to this job, and how far
+    each region got in its journal. A job resuming an earlier run is given
+    that run's journal as run_journal, see resume_job().
+    """
+
+    def __init__(self, image, name=None, size=0, description=None,
+                 keep=False, regions=None, listener=None, run_journal=None,
+                 variants=None):
+        self.image = os.path.abspath(image)
+        self.name, self.matcher, self.size = check_image(image, name, size)
+        self.description = description
+        self.keep = keep
+        self.regions = regions or []
+        if variants is None:
+            variants = config_variants()
+        self.variants = variants
+        self.parsed_variants = parse_variants(variants)
+        self.listener = listener
+        self.results = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        if run_journal is None:
+            self.run_id = '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'),
+                uuid.uuid4().hex[:8])
+            run_journal = journal.Journal(get_opt('journal_dir'),
+                self.run_id, job=self.describe(size))
+        else:
+            self.run_id = run_journal.run_id
+        self.journal = run_journal
+        self.timeline = timeline.Timeline(self.run_id)
+
+    def describe(self, size):
+        """what resume_job() needs to build this job again"""
+        info = os.stat(self.image)
+        return {'image': self.image, 'name': self.name, 'size': size,
+            'description': self.description, 'keep': self.keep,
+            'regions': self.regions, 'variants': self.variants,
+            'image_size': info.st_size,
+            'image_mtime': int(info.st_mtime)}
+
+    def emit(self, event, region=None, **fields):
+        """pass a progress event on to the listener, if there is one"""
+        if self.listener is None:
+            return
+        fields.update(event=event, region=region, name=self.name)
+        self.listener(fields)
+
+    def add_result(self, region, amis, verified_after=None):
+        """
+        record the AMIs a region produced, by variant; ami is the one of the
+        first variant. verified_after is how many seconds into the region
+        its AMIs were seen to boot, if they were tried.
+        """
+        ami_id = amis[self.parsed_variants[0]['name']]
+        self.lock.acquire()
+        self.results[region] = {'region': region, 'ami': ami_id,
+            'arch': self.matcher.group('arch'), 'name': self.name,
+            'variants': amis, 'verified_after': verified_after}
+        self.lock.release()
+        self.emit('complete', region, ami=ami_id, variants=amis,
+            verified_after=verified_after)
+
+    def add_error(self, region, error):
+        """record why a region failed"""
+        self.lock.acquire()
+        self.errors[region] = str(error)
+        self.lock.release()
+        self.emit('failed', region, error=str(error))
+
+
+class UploadHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve one daemon client. The client writes a single JSON object on one
+    line describing the job:
+        {"image": path, "name": ..., "size": ..., "description": ...,
+         "keep": ..., "regions": [...], "variants": [...]}
+    Only image is required. We answer with one JSON object per line for each
+    progress event, and finish with a "done" event carrying the results and
+    errors by region, or an "error" event if the job could not be set up or
+    run at all.
+
+    {"resume": run ID} instead picks up an earlier run where it stopped.
+    A client may also send {"command": "metrics"} to get the EC2 API call
+    metrics back in the Prometheus text format.
+    """
+
+    def handle(self):
+        write_lock = threading.Lock()
+        state = {'connected': True}
+
+        def send(event):
+            write_lock.acquire()
+            try:
+                if state['connected']:
+                    self.wfile.write(json.dumps(event) + '\n')
+                    self.wfile.flush()
+            except (IOError, socket.error):
+                # the job carries on without anyone listening
+                state['connected'] = False
+            write_lock.release()
+
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get('command') == 'metrics':
+                send({'event': 'metrics',
+                      'text': metrics.default_registry.prometheus()})
+                return
+            if request.get('resume'):
+                job = resume_job(request['resume'], listener=send)
+            else:
+                job = UploadJob(request['image'], name=request.get('name'),
+                    size=int(request.get('size', 0)),
+                    description=request.get('description'),
+                    keep=bool(request.get('keep', False)),
+                    regions=request.get('regions') or opts.regions,
+                    variants=request.get('variants'), listener=send)
+        except (ValueError, KeyError, fedora_ec2.Fedora_EC2Error) as e:
+            mainlog.error('Rejected job: %s', e)
+            send({'event': 'error', 'error': str(e)})
+            return
+        except Exception as e:
+            # e.g. a missing image or journal; the client must still hear
+            mainlog.exception('Could not set up job')
+            send({'event': 'error', 'error': str(e)})
+            return
+        problems = preflight(job.regions, job.parsed_variants)
+        if problems:
+            text = '; '.join(['%s: %s' % (r, ', '.join(problems[r]))
+                              for r in sorted(problems)])
+            mainlog.error('Rejected job for %s, preflight failed: %s',
+                job.image, text)
+            send({'event': 'error', 'name': job.name,
+                  'error': 'preflight failed: %s' % text,
+                  'problems': problems})
+            return
+        mainlog.info('accepted job for %s', job.image)
+        send({'event': 'accepted', 'name': job.name, 'regions': job.regions})
+        try:
+            upload_all(job, daemon_admission)
+        except Exception as e:
+            mainlog.exception('Job for %s failed', job.image)
+            send({'event': 'error', 'name': job.name, 'error': str(e)})
+            return
+        send({'event': 'done', 'name': job.name, 'results': job.results,
+              'errors': job.errors})
+
+
+class UploadServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Unix socket server handing each client its own thread"""
+    daemon_threads = True
+
 
 #
 # Functions
@@ -38,80 +234,183 @@ def get_options():
     each region we want to upload to. Usually, image file names are of the form:
     Fedora-Release-VariantName-Arch.raw
 
-    Usage: %prog [options] path-to-image"""
+    With --daemon no image is given; instead we listen on a Unix socket and
+    take upload jobs from it, keeping EC2 connections around between jobs.
+
+    Every run has an ID and a journal of how far each region got. If an
+    upload is killed, --resume with its run ID carries on from there.
+
+    Several images, such as all those of a compose, may be given at once.
+    They are planned together: every region takes at most as many uploads
+    at a time as its instance_limit and volume_limit allow, biggest images
+    first, using how long earlier runs took in each region. --plan only
+    prints that plan and when everything is expected to be done.
+
+    Usage: %prog [options] path-to-image ...
+           %prog [options] --resume run-ID
+           %prog [options] --daemon"""
     parser = OptionParser(usage=usage)
     parser.add_option('-a', '--all', help='Upload to all regions',
         action='store_true', default=False)
     parser.add_option('-c', '--config', help='Add a config file',
         default=['/etc/uploader.conf'], action='append')
+    parser.add_option('-d', '--daemon', action='store_true', default=False,
+        help='Run as a daemon taking upload jobs over a Unix socket')
     parser.add_option('-e', '--description', default=None,
         help='Give a description of this image'),
     parser.add_option('-k', '--keep', help='Keep tmp instance/volumes around',
         action='store_true', default=False)
     parser.add_option('-n', '--name', default=False,
         help='Override the image name. The default is the disk image name.')
+    parser.add_option('-p', '--plan', action='store_true', default=False,
+        help='Only print the upload plan and its predicted makespan')
     parser.add_option('-r', '--region', action='append', default=[], dest='regions',
         help='Only upload to a specific region. May be used more than once.')
+    parser.add_option('--resume', metavar='RUN', help='Pick up an earlier run '
+        'where each region stopped, using what it already made')
     parser.add_option('-s', '--size', type='int', default=0,
         help='Customize size of image')
+    parser.add_option('-V', '--variant', action='append', default=None,
+        dest='variants', help='Register an AMI variant, '
+        'name:layout[:aki[:virt]]. May be used more than once; overrides '
+        'the variants option of the config.')
+    parser.add_option('--socket', default=socket_path,
+        help='Unix socket the daemon listens on (default: %default)')
     global opts
     opts, args = parser.parse_args()
-    if len(args) != 1:
+    if opts.daemon:
+        if len(args) != 0:
+            parser.error('An image can not be given with --daemon')
+        if opts.plan:
+            parser.error('--plan needs images, it can not be used with '
+                '--daemon')
+        parse_config()
+        if os.getuid() != 0:
+            parser.error('You have to be root to upload a partition image')
+        return opts, None
+    if opts.resume:
+        if len(args) != 0:
+            parser.error('An image can not be given with --resume')
+    elif len(args) == 0:
         parser.error('Please specify a path to an image')
-    image = args[0]
+    elif len(args) > 1 and opts.name:
+        parser.error('--name can only be used with a single image')
     parse_config()
-    if not os.path.exists(image):
-        parser.error('Could not find an image to upload at %s' % image)
-    size = os.stat(image).st_size
-    if os.getuid() != 0:
+    if os.getuid() != 0 and not opts.plan:
         parser.error('You have to be root to upload a partition image')
-    size = int(math.ceil(size / 1024.0 / 1024.0 / 1024.0))
-    if opts.size != 0:
-        if opts.size <= size:
-            parser.error('Can only make size larger, not smaller.')
+    try:
+        if opts.resume:
+            jobs = [resume_job(opts.resume)]
+        else:
+            jobs = [UploadJob(image, name=opts.name, size=opts.size,
+                description=opts.description, keep=opts.keep,
+                regions=opts.regions, variants=opts.variants)
+                for image in args]
+    except fedora_ec2.Fedora_EC2Error as e:
+        parser.error(str(e))
+    return opts, jobs
+
+def resume_job(run_id, listener=None):
+    """
+    Build the UploadJob of an earlier run again from its journal, so its
+    regions carry on where they stopped
+    """
+    run_journal = journal.load(get_opt('journal_dir'), run_id)
+    info = run_journal.job
+    if not os.path.exists(info['image']):
+        raise fedora_ec2.Fedora_EC2Error('The image of run %s, %s, is gone' %
+            (run_id, info['image']))
+    stat = os.stat(info['image'])
+    if (stat.st_size, int(stat.st_mtime)) != (info['image_size'],
+                                              info['image_mtime']):
+        raise fedora_ec2.Fedora_EC2Error('%s changed since run %s' %
+            (info['image'], run_id))
+    return UploadJob(info['image'], name=info['name'], size=info['size'],
+        description=info['description'], keep=info['keep'],
+        regions=info['regions'], listener=listener, run_journal=run_journal,
+        variants=info.get('variants', []))
+
+def check_image(image, name=None, size=0):
+    """
+    Validate an image we were asked to upload. Returns the AMI name, the
+    check_name match for it and the volume size in GB to use.
+    """
+    if not os.path.exists(image):
+        raise fedora_ec2.Fedora_EC2Error(
+            'Could not find an image to upload at %s' % image)
+    min_size = int(math.ceil(os.stat(image).st_size / 1024.0 / 1024.0 / 1024.0))
+    if size != 0:
+        if size <= min_size:
+            raise fedora_ec2.Fedora_EC2Error(
+                'Can only make size larger, not smaller.')
     else:
-        opts.size = size
-    if not opts.name:
+        size = min_size
+    if not name:
         if not image.endswith('.raw'):
-            parser.error('Not a .RAW file')
-        opts.name = os.path.basename(image)[:-4] # chop off .raw
-    m = fedora_ec2.check_name(opts.name)
+            raise fedora_ec2.Fedora_EC2Error('Not a .RAW file')
+        name = os.path.basename(image)[:-4] # chop off .raw
+    m = fedora_ec2.check_name(name)
     if not m:
-        parser.error(fedora_ec2.format_error)
+        raise fedora_ec2.Fedora_EC2Error(fedora_ec2.format_error)
 
     if m.group('arch') not in (
         'i386',
-        'x86_64'
+        'x86_64',
         'sparc',
         's390'
     ):
-        parser.error('The arch must be i386 or x86_64')
-    opts.matcher = m
-    return opts, image
+        raise fedora_ec2.Fedora_EC2Error('The arch must be i386 or x86_64')
+    return name, m, size
+
+def parse_variants(specs):
+    """
+    Turn variant specs, name:layout[:aki[:virt]], into dicts of the
+    register_snap arguments. layout is partition or disk, virt paravirtual
+    or hvm; an empty aki means the aki option of the region, or none for
+    hvm. No specs means the one AMI we always made: partition layout, the
+    region's aki, and no name suffix.
+    """
+    if not specs:
+        return [{'name': '', 'disk': False, 'aki': '', 'virt': None}]
+    variants = []
+    for spec in specs:
+        fields = [f.strip() for f in spec.split(':')]
+        fields += [''] * (4 - len(fields))
+        name, layout, aki, virt = fields[:4]
+        if len(fields) > 4 or not re.match(r'[a-z][a-z0-9]*$', name):
+            raise fedora_ec2.Fedora_EC2Error('Bad variant %r; give '
+                'name:layout[:aki[:virt]], name in lower case' % spec)
+        if layout not in ('partition', 'disk'):
+            raise fedora_ec2.Fedora_EC2Error('Variant %s: layout must be '
+                'partition or disk' % name)
+        if virt not in ('', 'paravirtual', 'hvm'):
+            raise fedora_ec2.Fedora_EC2Error('Variant %s: virt must be '
+                'paravirtual or hvm' % name)
+        if name in [v['name'] for v in variants]:
+            raise fedora_ec2.Fedora_EC2Error('Variant %s given twice' % name)
+        variants.append({'name': name, 'disk': layout == 'disk', 'aki': aki,
+            'virt': virt or None})
+    return variants
+
+def config_variants():
+    """the variant specs of the variants option"""
+    return [v for v in get_opt('variants').split(',') if v.strip()]
+
+def variant_aki(variant, region):
+    """the AKI a variant is registered with in region, or None"""
+    if variant['aki']:
+        return variant['aki']
+    if variant['virt'] == 'hvm':
+        return None
+    return get_opt('aki', region)
 
 def setup_log():
     """set up the main logger"""
     global mainlog
-    format = logging.Formatter("[%(asctime)s %(name)s %(levelname)s]: %(message)s")
     logname = 'upload'
-    logdir = get_opt('logdir')
-    if not os.path.exists(logdir):
-        os.makedirs(logdir)
-    #Theres a way to do this I think through the logging module
-    if os.path.exists(os.path.join(logdir, logname + '.log')):
-        os.remove(os.path.join(logdir, logname + '.log'))
-    mainlog = logging.getLogger(logname)
-    if get_opt('debug') == 'True':
-        mainlog.setLevel(logging.DEBUG)
-    else:
-        mainlog.setLevel(logging.INFO)
-    file_handler = logging.FileHandler(os.path.join(logdir, logname + '.log'))
-    file_handler.setFormatter(format)
-    mainlog.addHandler(file_handler)
-    if not get_opt('quiet') == 'True':
-        stdout_handler = logging.StreamHandler(sys.stdout)
-        stdout_handler.setFormatter(format)
-        mainlog.addHandler(stdout_handler)
+    mainlog = logs.get_logger(logname, os.path.join(get_opt('logdir'),
+        logname + '.log'), debug=get_opt('debug') == 'True',
+        quiet=get_opt('quiet') == 'True')
 
 def parse_config():
     config = ConfigParser.ConfigParser()
@@ -143,104 +442,810 @@ def get_opt(name, region='DEFAULT'):
 
 def run_cmd(cmd, wait=True):
     """run an external command"""
-    mainlog.debug('Command: %s' % cmd)
+    mainlog.debug('Command: %s', cmd)
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT, shell=True)
     if not wait:
         return
     ret = proc.wait()
     output = proc.stdout.read().strip()
-    mainlog.debug('Return code: %s' % ret)
-    mainlog.debug('Output: %s' % output)
+    mainlog.debug('Return code: %s', ret)
+    mainlog.debug('Output: %s', output)
     if ret != 0:
-        mainlog.error('Command had a bad exit code: %s' % ret)
-        mainlog.error('Command run: %s' % cmd)
-        mainlog.error('Output:\n%s' % output)
+        mainlog.error('Command had a bad exit code: %s', ret)
+        mainlog.error('Command run: %s', cmd)
+        mainlog.error('Output:\n%s', output)
         raise fedora_ec2.Fedora_EC2Error('Command failed, see logs for output')
     return output, ret
 
-def upload_region(region, image_path):
-    """Upload an image to a region"""
-    # start the Stager instance
-    ec2 = fedora_ec2.EC2Obj(region=region, debug=get_opt('debug'),
-        logfile=os.path.join(get_opt('logdir'), 'upload-%s.log' % region),
-        quiet=get_opt('quiet'))
-    mainlog.info('beginning process for %s to %s' % (image_path, ec2.region))
+def get_ec2(region):
+    """Return the EC2Obj for a region, creating it the first time it is used"""
+    ec2_lock.acquire()
+    ec2 = ec2_cache.get(region)
+    ec2_lock.release()
+    if ec2 is None:
+        ec2 = fedora_ec2.EC2Obj(region=region, debug=get_opt('debug'),
+            logfile=os.path.join(get_opt('logdir'), 'upload-%s.log' % region),
+            quiet=get_opt('quiet'))
+        ec2_lock.acquire()
+        ec2 = ec2_cache.setdefault(region, ec2)
+        ec2_lock.release()
+    return ec2
+
+def check_config(region):
+    """
+    Return a list of what is wrong with the settings of a region, going by
+    the config alone
+    """
+    problems = []
+
+    def opt(name):
+        try:
+            return get_opt(name, region).strip()
+        except fedora_ec2.Fedora_EC2Error as e:
+            problems.append(str(e))
+            return None
+
+    if not opts.config.has_section(region):
+        return ['there is no [%s] section in the config' % region]
+    for name, prefix in (('stage_ami', 'ami-'), ('aki', 'aki-')):
+        value = opt(name)
+        if value is not None and not value.startswith(prefix):
+            problems.append('%s is %r, not an ID starting with %s' %
+                (name, value, prefix))
+    if opt('sshkey') == '':
+        problems.append('no sshkey given')
+    path = opt('sshpath')
+    if path is not None and not os.path.isfile(path):
+        problems.append('sshpath %r is not a file' % path)
+    if opt('sec_group') == '':
+        problems.append('no sec_group given')
+    ids = opt('ids')
+    if ids == '':
+        problems.append('ids is empty; give AWS account IDs or "public"')
+    elif ids is not None and ids != 'public':
+        bad = [i for i in ids.split(',') if not re.match(r'\d{12}$', i.strip())]
+        if bad:
+            problems.append('ids has %s, which are not AWS account IDs' %
+                ', '.join([repr(i) for i in bad]))
+    for name in numeric_opts:
+        value = opt(name)
+        try:
+            if value is not None:
+                float(value)
+        except ValueError:
+            problems.append('%s is %r, not a number' % (name, value))
+    for name in count_opts:
+        value = opt(name)
+        if value is not None and not re.match(r'[1-9]\d*$', value):
+            problems.append('%s is %r, not a whole number of at least 1' %
+                (name, value))
+    value = opt('variants')
+    if value is not None:
+        try:
+            parse_variants([v for v in value.split(',') if v.strip()])
+        except fedora_ec2.Fedora_EC2Error as e:
+            problems.append(str(e))
+    return problems
+
+def check_region(region, variants=()):
+    """
+    Return a list of what is wrong with a region: its settings, then the
+    stager AMI, AKIs (including those of variants), key pair and security
+    groups they name, looked up in EC2 with one call each
+    """
+    problems = check_config(region)
+    if problems:
+        return problems
+    need = upload_instances(region, variants)
+    if need > int(get_opt('instance_limit', region)):
+        return ['an upload with verify_boot and %s variant(s) holds %s '
+            'instances, more than instance_limit' % (len(variants), need)]
+    ec2 = get_ec2(region)
+    if ec2.region != region:
+        return ['%s is not a region fedora_ec2 knows' % region]
+    stage_ami = get_opt('stage_ami', region).strip()
+    refs = [('stage_ami', stage_ami), ('aki', get_opt('aki', region).strip())]
+    for variant in variants:
+        aki = variant_aki(variant, region)
+        if aki is not None and aki not in [r[1] for r in refs]:
+            refs.append(('aki of variant %s' % variant['name'], aki))
+    images = ec2.find_images([r[1] for r in refs])
+    for name, image in refs:
+        if image not in images:
+            problems.append('%s %s does not exist' % (name, image))
+        elif images[image] != 'available':
+            problems.append('%s %s is %s' % (name, image, images[image]))
+    keypair = get_opt('sshkey', region).strip()
+    if keypair not in ec2.find_keypairs([keypair]):
+        problems.append('key pair %s does not exist' % keypair)
+    groups = [g.strip() for g in get_opt('sec_group', region).split(',')]
+    missing = set(groups) - ec2.find_groups(groups)
+    if missing:
+        problems.append('security group(s) %s do not exist' %
+            ', '.join(sorted(missing)))
+    return problems
+
+def preflight(regions, variants=()):
+    """
+    Check every region, and the AMI variants to register there, before
+    anything is started in any of them, all regions at once. Returns
+    {region: [problem, ...]} for the regions that would fail.
+    """
+    found = {}
+
+    def check(region):
+        logs.tag(region)
+        try:
+            problems = check_region(region, variants)
+        except Exception as e:
+            problems = ['could not be checked: %s' % e]
+        if problems:
+            found[region] = problems
+
+    threads = [threading.Thread(target=check, args=(r,), name=r)
+               for r in regions]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return found
+
+def upload_region(region, job):
+    """
+    Upload an image to a region. Each stage is noted in the job's journal
+    as it completes; when resuming a run, stages already done are skipped
+    and the stager, volume, snapshot and AMI they made are used again.
+    """
+    image_path = job.image
+    ec2 = get_ec2(region)
+    state = job.journal.state(region)
+
+    def done(stage):
+        return journal.reached(state, stage)
+
+    def record(stage, **fields):
+        state.update(fields)
+        state['stage'] = stage
+        job.journal.record(region, stage, **fields)
+
+    if done('done'):
+        mainlog.info('[%s] was finished by an earlier attempt of run %s',
+            region, job.run_id)
+        if not job.keep and state.get('cleaned') is False:
+            record('done', cleaned=cleanup(region, ec2, state['instance'],
+                state['volume']))
+        job.add_result(region, region_amis(job, state),
+            state.get('verified_after'))
+        return
+    started = time.time()
+    mainlog.info('beginning process for %s to %s', image_path, ec2.region)
+    job.emit('started', region)
     if get_opt('avail_zone', region) == '':
         zone = ec2.region
     else:
         zone = ec2.region+get_opt('avail_zone', region)
-    inst_info = ec2.start_ami(get_opt('stage_ami', region), zone=zone,
-        group=get_opt('sec_group',region).split(','),
-        keypair=get_opt('sshkey',region), wait=True)
+    # the stager and volume are scratch; if we die they are swept up later
+    expires = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() +
+        3600 * float(get_opt('scratch_ttl', region))))
+
+    # the stager is only needed until the image is on the volume
+    inst_info = None
+    if done('booted') and not done('transferred'):
+        inst_info = reuse_stager(ec2, state['instance'])
+        if inst_info is None:
+            mainlog.warning('[%s] stager %s of the earlier attempt is gone, '
+                'starting the region over', region, state['instance'])
+            job.journal.reset(region)
+            state.clear()
+    if not done('booted'):
+        # start the Stager instance
+        inst_info = ec2.start_ami(get_opt('stage_ami', region), zone=zone,
+            group=get_opt('sec_group',region).split(','),
+            keypair=get_opt('sshkey',region), wait=True,
+            tags=run_tags(job, 'stager', expires))
+        record('booted', instance=inst_info['id'])
+    job.emit('stager', region, instance=state['instance'])
 
     # create and attach volumes
-    mainlog.info('[%s] creating EBS volume we will snapshot' % ec2.region)
-    ebs_vol_info = ec2.create_vol(opts.size, wait=True, zone=zone)
-    ebs_vol_info = ec2.attach_vol(inst_info['id'], ebs_vol_info['id'],
-        wait=True)
+    if not done('volume'):
+        mainlog.info('[%s] creating EBS volume we will snapshot', ec2.region)
+        ebs_vol_info = ec2.create_vol(job.size, wait=True, zone=zone,
+            tags=run_tags(job, 'target', expires))
+        record('volume', volume=ebs_vol_info['id'])
+    if not done('attached'):
+        ebs_vol_info = ec2.attach_vol(state['instance'], state['volume'],
+            wait=True)
+        record('attached', device=ebs_vol_info['device'])
+    job.emit('volume', region, volume=state['volume'])
 
     # prep the temporary volume and upload to it
-    ec2.wait_ssh(inst_info, path=get_opt('sshpath', region))
-    mainlog.info('[%s] uploading image %s to EBS volume %s' %
-        (ec2.region, image_path, ebs_vol_info['device']))
-    run_cmd('dd if=%s bs=4096 | ssh %s -C root@%s "dd of=%s bs=4096"' %
-        (image_path, ec2.get_ssh_opts(path=get_opt('sshpath', region)), inst_info['dns_name'],
-        ebs_vol_info['device']))
+    if not done('transferred'):
+        ec2.wait_ssh(inst_info, path=get_opt('sshpath', region))
+        offset = 0
+        if done('transferring'):
+            offset = state['offset']
+        mainlog.info('[%s] uploading image %s to EBS volume %s from byte %s',
+            ec2.region, image_path, state['device'], offset)
+        job.emit('transfer', region, offset=offset)
+        with timeline.span('transfer') as s:
+            stats = send_image(region, job, ec2, inst_info, state['device'],
+                offset, lambda at: record('transferring', offset=at))
+            s.bytes = stats['bytes']
+            s.reads = stats['reads']
+            s.read_bytes = stats['read_bytes']
+        record('transferred', sha256=stats.get('sha256'))
 
     # detach the two EBS volumes, snapshot the one we dd'd the disk image to,
     # and register it as an AMI
-    ec2.detach_vol(inst_info['id'], ebs_vol_info['id'], wait=True)
-    snap_info = ec2.take_snap(ebs_vol_info['id'], wait=True)
-    AMI_ID = ec2.register_snap(snap_info['id'], opts.matcher.group('arch'),
-            opts.name, aki=get_opt('aki', region), desc=opts.description)
-
-    # grant access to the new AMIs
-    mainlog.info('[%s] granting access to the AMI(s)' % ec2.region)
-    ID = get_opt('ids', region)
-    if ID == '':
-        raise fedora_ec2.Fedora_EC2Error('Insert AWS IDs or "public"')
-    elif ID == 'public':
-        ec2.make_public(AMI_ID)
-        mainlog.info('Making public')
-    else:
-        ID = ID.split(',')
-        ec2.grant_access(AMI_ID, ID)
+    if not done('detached'):
+        if ec2.vol_info(state['volume'])['status'] == 'in-use':
+            # picked up from an earlier attempt, if we did not attach it
+            ec2.claim_dev(state['instance'], state['volume'], state['device'])
+            ec2.detach_vol(state['instance'], state['volume'], wait=True)
+        record('detached')
+    if not done('snapshotted'):
+        job.emit('snapshot', region)
+        snap_info = ec2.take_snap(state['volume'], wait=True,
+            tags=run_tags(job, 'snapshot'))
+        record('snapshotted', snapshot=snap_info['id'])
 
-    # cleanup
-    if not opts.keep:
-        mainlog.info('[%s] cleaning up' % ec2.region)
-        ec2.delete_vol(ebs_vol_info['id'])
-        ec2.kill_inst(inst_info['id'])
-    mainlog.info('%s is complete' % ec2.region)
-    mainlog.info('[%s] Cloud AMI ID: %s' % (ec2.region, AMI_ID))
+    # the stager and volume are done with once the snapshot is, so they go
+    # while the AMIs are registered, booted and granted
+    cleaner = None
+    cleaned = []
+    if not job.keep and not state.get('cleaned'):
+        cleaner = threading.Thread(target=cleanup_thread, name=region,
+            args=(region, job, ec2, state['instance'], state['volume'],
+            cleaned))
+        cleaner.start()
+    try:
+        amis = publish_region(region, job, ec2, state, done, record, zone,
+            expires, started)
+    finally:
+        if cleaner is not None:
+            cleaner.join()
+            # a failed cleanup is tried again by --resume
+            record(state['stage'], cleaned=cleaned == [True])
+    record('done')
+    mainlog.info('%s is complete', ec2.region)
+    for variant in job.parsed_variants:
+        mainlog.info('[%s] Cloud AMI ID: %s', ec2.region,
+            amis[variant['name']])
 
     # maintain results
-    result_lock.acquire()
-    results[AMI_ID] = 'Cloud Access offering in %s for %s' %\
-            (ec2.region, opts.matcher.group('arch'))
-    result_lock.release()
+    job.add_result(region, amis, state.get('verified_after'))
 
-if __name__ == '__main__':
-    opts, ipath = get_options()
-    setup_log()
+def publish_region(region, job, ec2, state, done, record, zone, expires,
+                   started):
+    """
+    Register the AMIs of a region from its snapshot and, with verify_boot
+    set, see each of them boot before anyone is given them or told about
+    them. Returns them by variant.
+    """
+    if not done('registered'):
+        amis = register_variants(region, job, ec2, state, record)
+        record('registered', amis=amis,
+            ami=amis[job.parsed_variants[0]['name']])
+        if state.get('sha256'):
+            # lets the inventory find copies of the same image by digest
+            ec2.add_tags(amis.values() + [state['snapshot']],
+                {'sha256': state['sha256']})
+    amis = region_amis(job, state)
+    AMI_ID = state['ami']
+    job.emit('registered', region, ami=AMI_ID, variants=amis)
+
+    if get_opt('verify_boot', region) == 'True' and not done('verified'):
+        verify_amis(region, job, ec2, amis, zone, expires)
+        seconds = int(time.time() - started)
+        record('verified', verified_after=seconds)
+        mainlog.info('[%s] AMI(s) verified %s seconds into the region',
+            region, seconds)
+        job.emit('verified', region, seconds=seconds)
+
+    if not done('granted'):
+        # grant access to the new AMIs; the snapshot is shared, so its
+        # permissions are set along with the first one only
+        mainlog.info('[%s] granting access to the AMI(s)', ec2.region)
+        users, groups = grants.wanted(get_opt('ids', region))
+        snaps = [state['snapshot']]
+        for variant in job.parsed_variants:
+            grants.set_perms(ec2, amis[variant['name']], snaps, users,
+                groups)
+            snaps = []
+
+        # the AMIs are usable now, so the sweeper must leave them and their
+        # snapshot be
+        ec2.add_tags(amis.values() + [state['snapshot']],
+            {fedora_ec2.complete_tag: 'True'})
+
+        # tell the world without waiting on other regions
+        for variant in job.parsed_variants:
+            publisher.publish('image.ec2.complete', {
+                'ami': amis[variant['name']], 'region': ec2.region,
+                'arch': job.matcher.group('arch'),
+                'name': ami_name(job, variant), 'variant': variant['name'],
+                'image': os.path.basename(job.image),
+                'verified': state.get('verified_after') is not None})
+        record('granted')
+    return amis
 
+def cleanup(region, ec2, inst_id, vol_id):
+    """
+    Delete a region's scratch volume and stager. Returns True if both are
+    gone, including when an earlier attempt already got rid of them.
+    """
+    mainlog.info('[%s] cleaning up', region)
+    ok = True
+    with timeline.span('cleanup'):
+        for delete, res_id in ((ec2.delete_vol, vol_id),
+                               (ec2.kill_inst, inst_id)):
+            try:
+                delete(res_id)
+            except Exception as e:
+                if str(getattr(e, 'error_code', '')).endswith('.NotFound'):
+                    continue
+                # the AMI is fine; what is left is tagged for the sweeper
+                mainlog.warning('[%s] could not clean up %s, leaving it to '
+                    '--resume or sweep_orphans.py: %s', region, res_id, e)
+                ok = False
+    return ok
+
+def cleanup_thread(region, job, ec2, inst_id, vol_id, result):
+    """thread body for cleanup; appends whether it succeeded to result"""
+    logs.tag(region, job.run_id)
+    timeline.activate(job.timeline, region)
+    try:
+        result.append(cleanup(region, ec2, inst_id, vol_id))
+    finally:
+        timeline.deactivate()
+        logs.tag()
+
+def verify_amis(region, job, ec2, amis, zone, expires):
+    """
+    Boot every variant of a region's AMIs at once and wait until each is up,
+    terminating them again either way. Raises a Fedora_EC2Error naming the
+    variants that did not boot.
+    """
+    failed = []
+    timeout = int(get_opt('verify_boot_timeout', region))
+
+    def verify(variant):
+        logs.tag(region, job.run_id)
+        timeline.activate(job.timeline, region)
+        inst_info = None
+        try:
+            inst_info = ec2.start_ami(amis[variant['name']], zone=zone,
+                group=get_opt('sec_group', region).split(','),
+                keypair=get_opt('sshkey', region), wait=True,
+                tags=run_tags(job, 'verifier', expires), span='verify')
+            how = ec2.wait_boot(inst_info, timeout)
+            mainlog.info('[%s] %s booted (%s)', region,
+                amis[variant['name']], how)
+        except Exception:
+            mainlog.exception('[%s] %s did not boot', region,
+                amis[variant['name']])
+            failed.append(variant['name'] or ami_name(job, variant))
+        finally:
+            if inst_info is not None:
+                try:
+                    ec2.kill_inst(inst_info['id'])
+                except Exception as e:
+                    mainlog.warning('[%s] could not terminate %s, leaving '
+                        'it to sweep_orphans.py: %s', region,
+                        inst_info['id'], e)
+            timeline.deactivate()
+            logs.tag()
+
+    mainlog.info('[%s] booting the AMI(s) to verify them', region)
+    threads = [threading.Thread(target=verify, args=(v,))
+               for v in job.parsed_variants]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failed:
+        raise fedora_ec2.Fedora_EC2Error('%s: did not boot: %s' %
+            (region, ', '.join(failed)))
+
+def ami_name(job, variant):
+    """the name of a job's AMI of variant"""
+    if variant['name']:
+        return '%s-%s' % (job.name, variant['name'])
+    return job.name
+
+def region_amis(job, state):
+    """the AMIs a region's journal state holds, by variant"""
+    # runs journalled before variants only have the one
+    return state.get('amis') or {job.parsed_variants[0]['name']: state['ami']}
+
+def register_variants(region, job, ec2, state, record):
+    """
+    Register an AMI of every variant of job from the region's snapshot, all
+    at once, and return them by variant. Each one is journalled as soon as
+    it exists, so a resumed run only registers those still missing.
+    """
+    amis = dict(state.get('amis') or {})
+    lock = threading.Lock()
+    failed = []
+
+    def register(variant):
+        logs.tag(region, job.run_id)
+        timeline.activate(job.timeline, region)
+        try:
+            ami = ec2.register_snap(state['snapshot'],
+                job.matcher.group('arch'), ami_name(job, variant),
+                aki=variant_aki(variant, region), desc=job.description,
+                disk=variant['disk'], virt=variant['virt'],
+                tags=run_tags(job, 'image', variant=variant['name']))
+            lock.acquire()
+            try:
+                amis[variant['name']] = ami
+                record('snapshotted', amis=dict(amis))
+            finally:
+                lock.release()
+        except Exception as e:
+            mainlog.exception('[%s] could not register variant %s', region,
+                variant['name'] or ami_name(job, variant))
+            failed.append(e)
+        finally:
+            timeline.deactivate()
+            logs.tag()
+
+    threads = [threading.Thread(target=register, args=(v,))
+               for v in job.parsed_variants if v['name'] not in amis]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failed:
+        raise failed[0]
+    return amis
+
+def reuse_stager(ec2, inst_id):
+    """
+    Return the inst_info of an earlier attempt's stager once it is running,
+    or None if it is gone
+    """
+    try:
+        return ec2.wait_inst_status(inst_id, 'running', tries=15)
+    except Exception as e:
+        mainlog.debug('[%s] can not use %s again: %s',
+            ec2.region, inst_id, e)
+        return None
+
+def run_tags(job, role, expires=None, variant=None):
+    """
+    Tags for what job creates in a region: its run ID, what it is for and,
+    for scratch resources, when sweep_orphans.py may reclaim them; AMIs of
+    a named variant carry its name too
+    """
+    tags = {fedora_ec2.run_tag: job.run_id, fedora_ec2.role_tag: role}
+    if expires is not None:
+        tags[fedora_ec2.expires_tag] = expires
+    if variant:
+        tags[fedora_ec2.variant_tag] = variant
+    return tags
+
+def send_image(region, job, ec2, inst_info, device, offset=0,
+               checkpoint=None):
+    """
+    Stream the image of a job onto device on the stager, reporting progress
+    as we go, and add the figures to the throughput history in the logdir.
+    With verify set, the stager hashes what it writes and a mismatch fails
+    the region here, before anything is snapshotted.
+
+    Sending starts at byte offset, where an interrupted attempt got to; with
+    verify, what that attempt left is hashed on the stager and only chunks
+    that differ are sent again. checkpoint(offset) is called with each
+    progress report, with a byte offset it is safe to resume from.
+    """
+    def report(sent, total, rate, eta):
+        if eta is None:
+            left = 'unknown'
+        else:
+            left = '%ds' % eta
+        mainlog.info('[%s] sent %d of %d MB at %.1f MB/s, %s left',
+            region, sent / 1048576, total / 1048576, rate / 1048576.0, left)
+        job.emit('progress', region, bytes=sent, total=total, rate=rate,
+            eta=eta)
+        if checkpoint is not None:
+            # what is still in pipes and socket buffers is not on disk yet
+            at = max(xfer.position() - resume_margin, 0)
+            checkpoint(at // step * step)
+
+    block = int(get_opt('transfer_block', region))
+    verify = get_opt('verify', region) == 'True'
+    chunk = int(get_opt('verify_chunk', region))
+    # resume points fall on chunk boundaries so the chunks line up again
+    step = block
+    if verify:
+        step = chunk
+    sshpath = get_opt('sshpath', region)
+    if verify:
+        receiver = transfer.receiver_cmd(device, chunk, block)
+    elif offset:
+        receiver = 'dd of=%s bs=%s iflag=fullblock seek={offset} ' \
+            'oflag=seek_bytes' % (device, block)
+    else:
+        receiver = 'dd of=%s bs=%s iflag=fullblock' % (device, block)
+    cmd = ec2.ssh_cmd(inst_info, receiver, path=sshpath)
+    flow = None
+    if bandwidth is not None:
+        flow = bandwidth.flow(float(get_opt('bandwidth_weight', region)))
+    xfer = transfer.Transfer(job.image, cmd, block=block, verify=verify,
+        chunk=chunk, flow=flow,
+        interval=int(get_opt('progress_interval', region)),
+        stall_floor=int(get_opt('stall_floor', region)) * 1024,
+        stall_time=int(get_opt('stall_time', region)),
+        retries=int(get_opt('transfer_retries', region)),
+        progress=report, logger=mainlog, offset=offset)
+    stats = xfer.run()
+    known = image_analysis(job, region)
+    if offset and verify:
+        # the range sent now was verified as it went; check what the
+        # earlier attempt wrote and mend it
+        bad = transfer.check_range(job.image, ec2.ssh_cmd(inst_info,
+            transfer.hasher_cmd(device, 0, offset, chunk, block),
+            path=sshpath), 0, offset, chunk, block, logger=mainlog,
+            digests=known.chunk_digests(0, offset))
+        for start, length in bad:
+            mainlog.warning('[%s] bytes %s-%s of the earlier attempt differ, '
+                'sending them again', region, start, start + length - 1)
+            mended = transfer.Transfer(job.image, cmd, block=block,
+                verify=True, chunk=chunk, logger=mainlog, flow=flow,
+                retries=int(get_opt('transfer_retries', region)),
+                offset=start, length=length).run()
+            stats['resent'] += mended['bytes']
+            stats['reads'] += mended['reads']
+            stats['read_bytes'] += mended['read_bytes']
+    elif verify and stats['sha256'] != known.digest:
+        raise fedora_ec2.Fedora_EC2Error('%s changed while it was being '
+            'sent' % job.image)
+    stats['sha256'] = known.digest
+    mainlog.info('[%s] sent %s bytes in %ds (%.1f MB/s, %s retries, %d KB '
+        'per read)', region, stats['bytes'], stats['seconds'],
+        stats['rate'] / 1048576.0, stats['retries'],
+        stats['read_bytes'] / 1024 / max(stats['reads'], 1))
+    if verify:
+        mainlog.info('[%s] stager wrote the image intact, sha256 %s',
+            region, stats['sha256'])
+        job.emit('verified', region, sha256=stats['sha256'])
+    try:
+        transfer.record_throughput(os.path.join(get_opt('logdir'),
+            'throughput.jsonl'), run_id=job.run_id, region=region,
+            name=job.name, **stats)
+    except IOError as e:
+        mainlog.error('Could not record throughput: %s', e)
+    return stats
+
+def image_analysis(job, region='DEFAULT'):
+    """
+    The analysis of a job's image, in verify_chunk chunks of region: made
+    once and shared by every region and run until the image changes
+    """
+    return analysis.analyze(job.image, get_opt('analysis_dir'),
+        int(get_opt('verify_chunk', region)), logger=mainlog)
+
+def analysis_thread(jobs):
+    """
+    thread body analyzing the images of jobs one after the other, so it is
+    done by the time their transfers finish and the disk is read in order
+    """
+    for job in jobs:
+        try:
+            # regions sharing a verify_chunk get the same analysis back
+            for region in job.regions:
+                image_analysis(job, region)
+        except Exception:
+            mainlog.exception('Could not analyze %s', job.image)
+
+def start_analysis(jobs):
+    t = threading.Thread(target=analysis_thread, args=(jobs,),
+        name='analysis')
+    t.daemon = True
+    t.start()
+
+def upload_thread(region, job, admission=None):
+    """
+    thread body for upload_region; a failed region must not go unnoticed.
+    With an admission, the region is only started once it has the
+    instances and volume for it, and in its turn.
+    """
+    logs.tag(region, job.run_id)
+    timeline.activate(job.timeline, region)
+    instances = upload_instances(region, job.parsed_variants)
+    admitted = False
+    try:
+        try:
+            if admission is not None:
+                admission.enter(region, job.run_id, instances)
+                admitted = True
+                mainlog.debug('[%s] admitted run %s', region, job.run_id)
+            with timeline.span('upload'):
+                upload_region(region, job)
+        except Exception as e:
+            mainlog.exception('[%s] upload failed', region)
+            job.add_error(region, e)
+    finally:
+        timeline.deactivate()
+        logs.tag()
+        if admitted:
+            admission.leave(region, instances)
+
+def upload_all(job, admission=None, analyze=True):
+    """
+    Upload a job to all of its regions in parallel and wait for them. A
+    batch has its images analyzed by upload_batch instead.
+    """
+    if analyze:
+        start_analysis([job])
     threads = []
+    for region in job.regions:
+        mainlog.info('spawning thread for %s', region)
+        threads.append(threading.Thread(target=upload_thread,
+            args=(region, job, admission), name=region))
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    write_timeline(job)
+    if get_opt('fedmsg_summary') == 'True':
+        publisher.publish('image.ec2.summary', {'name': job.name,
+            'image': os.path.basename(job.image),
+            'amis': dict([(r, v['ami']) for r, v in job.results.items()]),
+            'variants': dict([(r, v['variants'])
+                for r, v in job.results.items()]),
+            'verified_after': dict([(r, v['verified_after'])
+                for r, v in job.results.items()]),
+            'errors': job.errors})
+    return job.results
+
+def region_limits(regions):
+    """the (instances, volumes) uploads may hold at once in each region"""
+    return dict([(r, (int(get_opt('instance_limit', r)),
+        int(get_opt('volume_limit', r)))) for r in regions])
+
+def upload_instances(region, variants):
+    """
+    The most instances one upload of variants holds in region at once: its
+    stager and, with verify_boot set, a verifier per variant, which boot
+    while the stager may still be being cleaned up
+    """
+    if get_opt('verify_boot', region) == 'True':
+        return 1 + len(variants)
+    return 1
+
+def region_slots(jobs):
+    """
+    How many of jobs each region can upload at once: every upload holds a
+    volume and upload_instances() instances until it is done. Raises a
+    Fedora_EC2Error for a region that can not take even one.
+    """
+    slots = {}
+    for region, (instances, volumes) in region_limits(
+            job_regions(jobs)).items():
+        need = max([upload_instances(region, j.parsed_variants)
+                    for j in jobs if region in j.regions])
+        slots[region] = min(instances // need, volumes)
+        if slots[region] < 1:
+            raise fedora_ec2.Fedora_EC2Error('%s can not take an upload: it '
+                'needs %s instance(s) and a volume, instance_limit is %s and '
+                'volume_limit %s' % (region, need, instances, volumes))
+    return slots
+
+def job_regions(jobs):
+    """all regions any of jobs uploads to"""
+    regions = []
+    for job in jobs:
+        regions.extend([r for r in job.regions if r not in regions])
+    return regions
 
-    for region in opts.regions:
-        mainlog.info('spawning thread for %s' % region)
-        threads.append(threading.Thread(target=upload_region,
-            args=(region, ipath), name=region))
+def plan_jobs(jobs):
+    """Return the planner.Plan for uploading jobs, from the runs in logdir"""
+    return planner.plan(jobs, region_slots(jobs),
+        planner.history(get_opt('logdir')),
+        bandwidth=int(get_opt('bandwidth')) * 1024)
 
+def upload_batch(jobs, plan):
+    """
+    Upload several jobs at once, each region taking them in the order and
+    no more at a time than plan says, and wait for all of them
+    """
+    admission = planner.Admission(region_limits(plan.limits), plan)
+    start_analysis(sorted(jobs, key=lambda j: min([e.start
+        for e in plan.entries if e.job is j])))
+    threads = []
+    for job in jobs:
+        threads.append(threading.Thread(target=upload_all,
+            args=(job, admission, False), name=job.name))
     for t in threads:
         t.start()
     for t in threads:
         t.join()
-    mainlog.info('Results of all uploads follow this line\n')
-    mainlog.info('\n'.join(['%s : %s' % (k, v) for k, v in results.items()]))
 
-    #This is to broadcast new AMI's
-    import fedmsg
-    for k,v in results.items():
-        fedmsg.publish(topic='image.ec2.complete', modname='cloud-image-uploader', msg={'%s  : %s' % (k,v)})
+def write_timeline(job):
+    """save the Chrome trace of a job in the logdir and log its summary"""
+    path = os.path.join(get_opt('logdir'), 'trace-%s-%s.json' %
+        (job.name, job.run_id))
+    try:
+        job.timeline.write_trace(path)
+    except IOError as e:
+        mainlog.error('Could not write trace %s: %s', path, e)
+    else:
+        mainlog.info('Wrote timeline of run %s to %s', job.run_id, path)
+    mainlog.info('Seconds per stage for %s:\n%s',
+        job.name, job.timeline.summary())
+
+def serve(path):
+    """Take upload jobs over a Unix socket at path until we are killed"""
+    sockdir = os.path.dirname(path)
+    if sockdir != '' and not os.path.exists(sockdir):
+        os.makedirs(sockdir)
+    if os.path.exists(path):
+        # left over from an earlier daemon
+        os.remove(path)
+    server = UploadServer(path, UploadHandler)
+    os.chmod(path, 0660)
+    mainlog.info('listening for upload jobs on %s', path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+if __name__ == '__main__':
+    opts, jobs = get_options()
+    if opts.plan:
+        print plan_jobs(jobs).summary()
+        sys.exit(0)
+    setup_log()
+    # a bad setting in any region stops us before a stager is booted
+    if opts.daemon:
+        regions = opts.regions
+        variants = parse_variants(config_variants())
+    else:
+        regions = job_regions(jobs)
+        variants = []
+        for job in jobs:
+            variants.extend([v for v in job.parsed_variants
+                             if v not in variants])
+    problems = preflight(regions, variants)
+    if problems:
+        for region in sorted(problems):
+            for problem in problems[region]:
+                mainlog.error('[%s] preflight: %s', region, problem)
+        sys.exit('Preflight failed for %s, see %s' % (', '.join(sorted(
+            problems)), os.path.join(get_opt('logdir'), 'upload.log')))
+    publisher = Publisher(maxsize=int(get_opt('fedmsg_queue')), logger=mainlog)
+    bandwidth = transfer.Bandwidth(int(get_opt('bandwidth')) * 1024)
 
+    if opts.daemon:
+        writer = None
+        # the limits hold across all jobs; regions whose settings are
+        # broken fail each job's preflight instead
+        daemon_admission = planner.Admission(region_limits([r for r in
+            opts.config.sections() if not check_config(r)]))
+        if get_opt('metrics_file') != '':
+            writer = metrics.MetricsWriter(get_opt('metrics_file'),
+                logger=mainlog)
+        try:
+            serve(opts.socket)
+        finally:
+            publisher.close()
+            if writer is not None:
+                writer.stop()
+        sys.exit(0)
+
+    plan = plan_jobs(jobs)
+    mainlog.info('Upload plan:\n%s', plan.summary())
+    upload_batch(jobs, plan)
+    publisher.close()
+    mainlog.info('EC2 API calls made:\n%s',
+        metrics.default_registry.summary())
+    mainlog.info('Results of all uploads follow this line\n')
+    mainlog.info('\n'.join(['%s : Cloud Access offering in %s for %s%s' %
+        (ami, v['region'], v['arch'], variant and ' (%s)' % variant or '')
+        for job in jobs for v in job.results.values()
+        for variant, ami in sorted(v['variants'].items())]))